@@ -0,0 +1,298 @@
+## Asyncio runner for the inference scripts.
+## Keeps N requirements in flight instead of one, so the time is spent waiting on the
+## backend and not on the Python loop:
+##   - the task functions of the scripts (process_requirement, process_requirements,
+##     process_multi_agent_requirement) run unchanged in a thread pool
+##   - StagePipe caps the concurrent calls of each agent/stage and applies a token-bucket
+##     rate limit to the calls that actually reach the model (cache hits are free)
+##   - CallBatcher merges the concurrent calls into padded batches for in-process models
+##   - results go through a bounded queue to the writer: when writing falls behind, no
+##     new requirement is started (backpressure)
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket: `rate` tokens per second, at most `burst` stored.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, tokens=1):
+        '''
+        Takes `tokens` (a batch pays one per conversation). A request larger than the
+        capacity waits for a full bucket and leaves it in debt, so the rate still holds.
+        '''
+        needed = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class StagePipe:
+    '''
+    Pipeline wrapper with a concurrency limit per stage and an optional rate limit.
+    The stage of a call is found from its system prompt (`stages`: prompt -> name);
+    stages without an entry in `stage_limits` use `default_limit` (None = unlimited).
+    A batch mixing stages (e.g. a SCAP wave) is split by stage: every sub-batch takes
+    a slot of its own stage, and the sub-batches run concurrently.
+    '''
+
+    def __init__(self, pipe, stages=None, stage_limits=None, default_limit=None, rate_limiter=None):
+        self.pipe = pipe
+        self.stages = stages or {}
+        self.stage_limits = stage_limits or {}
+        self.default_limit = default_limit
+        self.rate_limiter = rate_limiter
+        self.semaphores = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _stage(self, messages):
+        if messages and messages[0].get("role") == "system":
+            return self.stages.get(messages[0]["content"], "default")
+        return "default"
+
+    def _semaphore(self, stage):
+        with self.lock:
+            if stage not in self.semaphores:
+                limit = self.stage_limits.get(stage, self.default_limit)
+                self.semaphores[stage] = threading.BoundedSemaphore(limit) if limit else None
+            return self.semaphores[stage]
+
+    def _call_stage(self, stage, conversations, gen_kwargs):
+        semaphore = self._semaphore(stage)
+        with self.lock:
+            self.calls[stage] = self.calls.get(stage, 0) + len(conversations)
+
+        if "batch_size" in gen_kwargs:
+            gen_kwargs = {**gen_kwargs, "batch_size": len(conversations)}
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(len(conversations))
+        if semaphore is None:
+            return self.pipe(conversations, **gen_kwargs)
+        with semaphore:
+            return self.pipe(conversations, **gen_kwargs)
+
+    def __call__(self, inputs, **gen_kwargs):
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+        if not conversations:
+            return self.pipe(inputs, **gen_kwargs)
+
+        groups = {}  # stage -> indices of its conversations
+        for i, messages in enumerate(conversations):
+            groups.setdefault(self._stage(messages), []).append(i)
+
+        if len(groups) == 1:
+            outputs = self._call_stage(next(iter(groups)), conversations, gen_kwargs)
+        else:
+            outputs = [None] * len(conversations)
+            with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+                futures = {stage: pool.submit(self._call_stage, stage,
+                                              [conversations[i] for i in indices], gen_kwargs)
+                           for stage, indices in groups.items()}
+                for stage, future in futures.items():
+                    for i, output in zip(groups[stage], future.result()):
+                        outputs[i] = output
+        return outputs[0] if single else outputs
+
+    def stats(self):
+        return {"calls_per_stage": dict(self.calls)}
+
+
+class _Slot:
+    def __init__(self, messages, gen_kwargs):
+        self.messages = messages
+        self.gen_kwargs = gen_kwargs
+        self.key = tuple(sorted((k, repr(v)) for k, v in gen_kwargs.items()))
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CallBatcher:
+    '''
+    Merges the calls made concurrently from several threads into one padded batch
+    (at most `max_batch` conversations, waiting up to `max_wait` seconds for more).
+    A single dispatcher thread talks to the wrapped pipeline, so in-process models,
+    stopping criteria and KV-caches are never used from two threads at once.
+    '''
+
+    def __init__(self, pipe, max_batch=16, max_wait=0.01):
+        self.pipe = pipe
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.batches = 0
+        self.conversations = 0
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+            self.thread.start()
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            # Only conversations with the same generation settings share a batch
+            key = self.pending[0].key
+            batch = [slot for slot in self.pending if slot.key == key][:self.max_batch]
+            taken = set(map(id, batch))
+            self.pending = [slot for slot in self.pending if id(slot) not in taken]
+            return batch
+
+    def _dispatch_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = self.pipe([slot.messages for slot in batch], batch_size=len(batch),
+                                    **batch[0].gen_kwargs)
+                for slot, output in zip(batch, outputs):
+                    slot.result = output
+            except Exception as e:
+                for slot in batch:
+                    slot.error = e
+            self.batches += 1
+            self.conversations += len(batch)
+            for slot in batch:
+                slot.event.set()
+
+    def __call__(self, inputs, **gen_kwargs):
+        gen_kwargs.pop("batch_size", None)
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        slots = [_Slot(messages, gen_kwargs) for messages in ([inputs] if single else inputs)]
+
+        self._start()
+        with self.cond:
+            self.pending.extend(slots)
+            self.cond.notify_all()
+
+        for slot in slots:
+            slot.event.wait()
+            if slot.error is not None:
+                raise slot.error
+        results = [slot.result for slot in slots]
+        return results[0] if single else results
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "conversations": self.conversations,
+            "mean_batch_size": self.conversations / self.batches if self.batches > 0 else 0,
+        }
+
+
+def make_runner_pipe(pipe, coalesce=False, max_batch=16, stages=None, stage_limits=None,
+                     default_limit=None, rate=None, burst=None):
+    '''
+    Wraps the generating pipeline for concurrent use by the runner
+    (pass it as `wrap` to Backends.build_pipeline_stack, below the inference cache).
+    '''
+    if coalesce:
+        pipe = CallBatcher(pipe, max_batch=max_batch)
+    rate_limiter = TokenBucket(rate, burst) if rate else None
+    return StagePipe(pipe, stages, stage_limits, default_limit, rate_limiter)
+
+
+class AsyncRequirementRunner:
+    '''
+    Runs `task(entry) -> record` over the entries with at most `max_in_flight` tasks
+    at once and streams the records to `writer` (anything with a write(record) method).
+    Entries whose task raises are reported and not written, so a rerun retries them.
+    '''
+
+    def __init__(self, task, max_in_flight=8, queue_size=None, progress=True):
+        self.task = task
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size or 2 * max_in_flight
+        self.progress = progress
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.elapsed = 0.0
+
+    async def _worker(self, entries, results, pool, bar):
+        loop = asyncio.get_running_loop()
+        for entry in entries:
+            try:
+                record = await loop.run_in_executor(pool, self.task, entry)
+            except Exception as e:
+                print(f"Error on requirement {entry.get('id', 'unknown')}: {e}")
+                self.failed += 1
+                record = None
+            if bar is not None:
+                bar.update(1)
+            if record is not None:
+                # Blocks while the writer is behind: no new requirement starts meanwhile
+                await results.put(record)
+                self.max_queue_depth = max(self.max_queue_depth, results.qsize())
+
+    async def _writer(self, writer, results):
+        while True:
+            record = await results.get()
+            if record is None:
+                return
+            await asyncio.to_thread(writer.write, record)
+            self.completed += 1
+
+    async def run(self, entries, writer):
+        start_time = time.time()
+        entries_iter = iter(entries)  # Shared by the workers: each entry is taken once
+        results = asyncio.Queue(maxsize=self.queue_size)
+        bar = tqdm(total=len(entries)) if self.progress and hasattr(entries, "__len__") else None
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            writer_task = asyncio.create_task(self._writer(writer, results))
+            await asyncio.gather(*[self._worker(entries_iter, results, pool, bar)
+                                   for _ in range(self.max_in_flight)])
+            await results.put(None)
+            await writer_task
+
+        if bar is not None:
+            bar.close()
+        self.elapsed = time.time() - start_time
+        return self.stats()
+
+    def run_sync(self, entries, writer):
+        return asyncio.run(self.run(entries, writer))
+
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "elapsed_s": self.elapsed,
+            "requirements_per_s": self.completed / self.elapsed if self.elapsed > 0 else 0,
+            "max_queue_depth": self.max_queue_depth,
+        }
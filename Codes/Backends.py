@@ -0,0 +1,506 @@
+## Inference backends shared by all the pipelines.
+## Every backend is called exactly like the transformers text-generation pipeline
+## (one conversation -> [{"generated_text": ...}], a list -> one such list each), so the
+## pipelines and the wrappers around them (prefix cache, prompt lookup, inference cache)
+## do not depend on where the model runs:
+##   - "transformers": the in-process 4-bit Llama pipeline used so far (CUDA)
+##   - "cpu": the same pipeline on CPU with int8 dynamic quantization
+##   - "gguf": a GGUF model through llama.cpp (CPU)
+##   - "http": an asyncio client for an OpenAI-compatible server (vLLM, TGI, llama.cpp...)
+##   - "daemon": the model already loaded by Extraction_daemon.py
+##   - "fake": deterministic answers with a configurable latency (benchmarks, tests)
+
+import asyncio
+import atexit
+import inspect
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from Instrumentation import TRACER, InstrumentedPipe, PhaseTimer, generation_output
+
+MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+SERVER_URL = "http://localhost:8000/v1"
+
+
+class InferenceBackend:
+    '''
+    Base class: subclasses implement generate_batch(conversations, **gen_kwargs) -> [text].
+    '''
+
+    model_id = None
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        raise NotImplementedError
+
+    async def agenerate(self, messages, **gen_kwargs):
+        '''
+        Async generation of one conversation (runs the blocking call in a thread by default).
+        '''
+        texts = await asyncio.to_thread(self.generate_batch, [messages], **gen_kwargs)
+        return texts[0]
+
+    def generate_with_usage(self, conversations, **gen_kwargs):
+        '''
+        (texts, usage): usage[i] is (prompt tokens, generated tokens) as counted by the
+        model, or usage is None when the backend does not report it.
+        '''
+        return self.generate_batch(conversations, **gen_kwargs), None
+
+    def quantization(self):
+        return None
+
+    def __call__(self, inputs, **gen_kwargs):
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+        texts, usage = self.generate_with_usage(conversations, **gen_kwargs)
+        usage = usage or [(None, None)] * len(texts)
+        results = [[generation_output(text, *counts)] for text, counts in zip(texts, usage)]
+        return results[0] if single else results
+
+    def close(self):
+        pass
+
+
+class TransformersBackend(InferenceBackend):
+    '''
+    In-process Llama 3 with 4-bit quantization (the original setup of the scripts).
+    Subclasses change how the weights are loaded by overriding load_model().
+    '''
+
+    def __init__(self, model_id=MODEL_ID, hf_token=None, max_new_tokens=512, stop_at_json=True):
+        from huggingface_hub import login
+        from transformers import AutoTokenizer, pipeline
+        from Json_stopping import json_stopping_criteria
+
+        self.model_id = model_id
+        self.stop_at_json = stop_at_json
+        if hf_token and not os.path.isdir(model_id):
+            login(token=hf_token)
+
+        tokenizer = AutoTokenizer.from_pretrained(model_id, token=hf_token)
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+        # Decoder-only models must be padded on the left when batching
+        tokenizer.padding_side = "left"
+
+        model = self.load_model(model_id, hf_token)
+        model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+        extra = {"stopping_criteria": json_stopping_criteria(tokenizer)} if stop_at_json else {}
+        self.pipe = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,       # Deterministic
+            return_full_text=False,
+            **extra
+        )
+        self.model = model
+        self.tokenizer = tokenizer
+
+    def load_model(self, model_id, hf_token):
+        import torch
+        from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+        print(f"Load the {model_id} in 4-bit...")
+
+        # 4-bit Quantization
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+
+        return AutoModelForCausalLM.from_pretrained(
+            model_id,
+            quantization_config=bnb_config,
+            device_map="auto",
+            token=hf_token
+        )
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        if TRACER.enabled:
+            # Prefill/decode split of every generate() call (a batch at a time)
+            gen_kwargs.setdefault("streamer", PhaseTimer(agent="batch"))
+        outputs = self.pipe(conversations, **gen_kwargs)
+        return [output[0]['generated_text'] for output in outputs]
+
+    def quantization(self):
+        from Inference_cache import describe_quantization
+        return describe_quantization(self.model)
+
+
+class CpuBackend(TransformersBackend):
+    '''
+    Same pipeline on a machine without GPU: fp32 weights with the Linear layers
+    quantized to int8 (torch dynamic quantization). `threads` sets the torch intra-op
+    threads (None = all cores), `batch_size` the conversations decoded together.
+    '''
+
+    def __init__(self, model_id=MODEL_ID, hf_token=None, max_new_tokens=512, stop_at_json=True,
+                 threads=None, batch_size=4, quantize=True):
+        import torch
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.batch_size = batch_size
+        self.quantize = quantize
+        super().__init__(model_id, hf_token, max_new_tokens, stop_at_json)
+
+    def load_model(self, model_id, hf_token):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        print(f"Load the {model_id} on CPU ({'int8' if self.quantize else 'fp32'}, "
+              f"{torch.get_num_threads()} threads)...")
+        model = AutoModelForCausalLM.from_pretrained(model_id, dtype=torch.float32, token=hf_token)
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        gen_kwargs.setdefault("batch_size", self.batch_size)
+        return super().generate_batch(conversations, **gen_kwargs)
+
+    def quantization(self):
+        return {"method": "torch_dynamic", "dtype": "qint8"} if self.quantize else None
+
+
+class LlamaCppBackend(InferenceBackend):
+    '''
+    GGUF model through the llama.cpp bindings (llama-cpp-python), CPU only.
+    Answers are constrained to a JSON object, so generation ends when it closes.
+    '''
+
+    def __init__(self, model_path, model_id=MODEL_ID, max_new_tokens=512, threads=None,
+                 n_batch=512, n_ctx=4096):
+        from llama_cpp import Llama
+
+        print(f"Load {model_path} with llama.cpp...")
+        self.model_path = model_path
+        self.model_id = model_id
+        self.max_new_tokens = max_new_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_batch=n_batch,
+                         n_threads=threads, verbose=False)
+
+    def generate_with_usage(self, conversations, **gen_kwargs):
+        texts, usage = [], []
+        for messages in conversations:
+            response = self.llm.create_chat_completion(
+                messages=messages,
+                max_tokens=gen_kwargs.get("max_new_tokens", self.max_new_tokens),
+                temperature=0,
+                response_format={"type": "json_object"})
+            texts.append(response["choices"][0]["message"]["content"] or "")
+            counts = response.get("usage") or {}
+            usage.append((counts.get("prompt_tokens"), counts.get("completion_tokens")))
+        return texts, usage
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        return self.generate_with_usage(conversations, **gen_kwargs)[0]
+
+    def quantization(self):
+        return {"method": "gguf", "file": os.path.basename(self.model_path)}
+
+
+class AsyncHttpBackend(InferenceBackend):
+    '''
+    Client for an OpenAI-compatible /chat/completions endpoint.
+    One pooled aiohttp session lives on a background event loop; a semaphore bounds the
+    requests in flight, and failed requests (timeouts, connection errors, 429/5xx) are
+    retried with exponential backoff and jitter.
+    Usable synchronously (pipeline-style calls send a whole batch concurrently) or with
+    `await backend.agenerate(messages)` from any event loop.
+    '''
+
+    RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, base_url=SERVER_URL, model_id=MODEL_ID, api_key=None, max_concurrency=32,
+                 timeout=120, max_retries=4, backoff=0.5, max_new_tokens=512):
+        self.base_url = base_url.rstrip('/')
+        self.model_id = model_id
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_new_tokens = max_new_tokens
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = None
+        self.semaphore = None
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+        atexit.register(self.close)
+
+    async def _open(self):
+        import aiohttp
+
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        self.session = aiohttp.ClientSession(
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _payload(self, messages, gen_kwargs):
+        payload = {
+            "model": self.model_id,
+            "messages": messages,
+            "max_tokens": gen_kwargs.get("max_new_tokens", self.max_new_tokens),
+        }
+        if not gen_kwargs.get("do_sample", False):
+            payload["temperature"] = 0
+        elif "temperature" in gen_kwargs:
+            payload["temperature"] = gen_kwargs["temperature"]
+        return payload
+
+    async def _request(self, messages, gen_kwargs):
+        return (await self._request_with_usage(messages, gen_kwargs))[0]
+
+    async def _request_with_usage(self, messages, gen_kwargs):
+        '''
+        (text, (prompt tokens, generated tokens)) of one conversation, from the "usage"
+        of the response (None counts when the server does not send it).
+        '''
+        import aiohttp
+
+        payload = self._payload(messages, gen_kwargs)
+        url = f"{self.base_url}/chat/completions"
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    async with self.session.post(url, json=payload) as response:
+                        if response.status == 200:
+                            data = await response.json()
+                            counts = data.get("usage") or {}
+                            return (data["choices"][0]["message"]["content"] or "",
+                                    (counts.get("prompt_tokens"), counts.get("completion_tokens")))
+                        body = await response.text()
+                        if response.status not in self.RETRY_STATUSES:
+                            raise RuntimeError(f"HTTP {response.status}: {body[:200]}")
+                        error = RuntimeError(f"HTTP {response.status}: {body[:200]}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    async def _gather(self, conversations, gen_kwargs):
+        return await asyncio.gather(*[self._request_with_usage(messages, gen_kwargs)
+                                      for messages in conversations])
+
+    def generate_with_usage(self, conversations, **gen_kwargs):
+        future = asyncio.run_coroutine_threadsafe(self._gather(conversations, gen_kwargs), self.loop)
+        results = future.result()
+        return [text for text, _ in results], [counts for _, counts in results]
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        return self.generate_with_usage(conversations, **gen_kwargs)[0]
+
+    async def agenerate(self, messages, **gen_kwargs):
+        future = asyncio.run_coroutine_threadsafe(self._request(messages, gen_kwargs), self.loop)
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class DaemonBackend(InferenceBackend):
+    '''
+    The model resident in the extraction daemon (Extraction_daemon.py): no load at all.
+    '''
+
+    def __init__(self, socket_path=None):
+        from Daemon_client import DaemonClient, DEFAULT_SOCKET_PATH
+
+        self.client = DaemonClient(socket_path or DEFAULT_SOCKET_PATH)
+        status = self.client.status()
+        self.model_id = status["model_id"]
+        self._quantization = status["quantization"]
+        print(f"Using the daemon model {self.model_id} ({self.client.socket_path})")
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        return self.client.generate(conversations, **gen_kwargs)
+
+    def quantization(self):
+        return self._quantization
+
+
+def approx_tokens(text):
+    '''
+    Rough token count (~4 characters per token) for backends without a tokenizer.
+    '''
+    return max(1, len(text) // 4)
+
+
+class FakeBackend(InferenceBackend):
+    '''
+    Deterministic stand-in for the model, for benchmarks and tests: every field of the
+    answer gets words of the user turn, and each call sleeps like a batched decoder
+    (`prefill_latency` per prompt token + `token_latency` per token of the longest answer).
+    '''
+
+    FIELDS = ["Main_actor", "Entity", "Action", "System_response",
+              "Condition", "Precondition", "Trigger", "Purpose"]
+
+    def __init__(self, model_id="fake", token_latency=0.02, prefill_latency=0.0002, max_new_tokens=512):
+        self.model_id = model_id
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.max_new_tokens = max_new_tokens
+
+    def answer(self, messages):
+        words = re.findall(r"[A-Za-z]+", messages[-1]["content"]) or ["system"]
+        return json.dumps({field: [" ".join(words[i % len(words):i % len(words) + 2])]
+                           for i, field in enumerate(self.FIELDS)})
+
+    def generate_with_usage(self, conversations, **gen_kwargs):
+        texts = [self.answer(messages) for messages in conversations]
+        max_new_tokens = gen_kwargs.get("max_new_tokens", self.max_new_tokens)
+        usage = [(sum(approx_tokens(m["content"]) for m in messages), min(approx_tokens(text), max_new_tokens))
+                 for messages, text in zip(conversations, texts)]
+        prompt_tokens = sum(prompt for prompt, _ in usage)
+        output_tokens = max((generated for _, generated in usage), default=0)
+        time.sleep(self.prefill_latency * prompt_tokens + self.token_latency * output_tokens)
+        return texts, usage
+
+    def generate_batch(self, conversations, **gen_kwargs):
+        return self.generate_with_usage(conversations, **gen_kwargs)[0]
+
+
+BACKENDS = {
+    "transformers": TransformersBackend,
+    "cpu": CpuBackend,
+    "gguf": LlamaCppBackend,
+    "http": AsyncHttpBackend,
+    "daemon": DaemonBackend,
+    "fake": FakeBackend,
+}
+
+
+def load_backend(kind="transformers", **options):
+    '''
+    Single entry point used by the scripts to get a backend by name.
+    Options that the chosen backend does not take are ignored, so the scripts can pass
+    all their settings in one call.
+    '''
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown backend: {kind}")
+    backend_class = BACKENDS[kind]
+    accepted = inspect.signature(backend_class.__init__).parameters
+    return backend_class(**{name: value for name, value in options.items() if name in accepted})
+
+
+def build_pipeline_stack(backend, prompt_module, max_new_tokens=512, prefix_cache=False,
+                         prompt_lookup=False, inference_cache=True, wrap=None, agents=None,
+                         compiled_templates=False, token_budget=None):
+    '''
+    Wraps a backend with the optional layers, innermost first:
+    pre-tokenized templates / prefix KV-cache -> prompt-lookup decoding -> length-bucketed
+    batches -> wrap(pipe) -> instrumentation -> persistent inference cache. The first three
+    need the model in-process (transformers backend only); with the caches, the templates
+    only build their prompts. `token_budget` (padded prompt tokens per batch) turns on the
+    length buckets. `wrap` is applied to the generating pipe, e.g. the limits of the async
+    runner. `agents` ({system prompt: agent name}) labels the calls recorded by
+    Instrumentation.TRACER.
+    '''
+    pipe = backend
+    if prefix_cache or prompt_lookup or compiled_templates:
+        if not isinstance(backend, TransformersBackend):
+            raise ValueError("Prefix cache, prompt lookup and compiled templates need the in-process "
+                             "transformers backend")
+
+    templates = None
+    if compiled_templates:
+        from Prompt_templates import TemplateCompiler, CompiledTemplatePipe
+        from Json_stopping import json_stopping_criteria
+        templates = TemplateCompiler(backend.tokenizer)
+        if not (prefix_cache or prompt_lookup):
+            stopping = json_stopping_criteria(backend.tokenizer) if backend.stop_at_json else None
+            pipe = CompiledTemplatePipe(backend.model, backend.tokenizer, templates,
+                                        max_new_tokens=max_new_tokens, stopping_criteria=stopping,
+                                        batch_size=getattr(backend, "batch_size", 8))
+    if prefix_cache:
+        from Prefix_cache import PrefixKVCache
+        from Json_stopping import json_stopping_criteria
+        stopping = json_stopping_criteria(backend.tokenizer) if backend.stop_at_json else None
+        pipe = PrefixKVCache(backend.model, backend.tokenizer, max_new_tokens=max_new_tokens,
+                             stopping_criteria=stopping, templates=templates)
+    if prompt_lookup:
+        from Prompt_lookup import PromptLookupDecoder
+        pipe = PromptLookupDecoder(backend.model, backend.tokenizer, max_new_tokens=max_new_tokens,
+                                   stop_at_json=backend.stop_at_json,
+                                   prefix_cache=pipe if prefix_cache else None, templates=templates)
+    if token_budget:
+        from Length_scheduler import LengthBucketedPipe
+        pipe = LengthBucketedPipe(pipe, prompt_length(backend, templates), token_budget,
+                                  max_batch=getattr(backend, "batch_size", None))
+    if wrap is not None:
+        pipe = wrap(pipe)
+    if agents is not None:
+        pipe = InstrumentedPipe(pipe, TRACER, agents)
+    if inference_cache:
+        pipe = with_inference_cache(pipe, backend, prompt_module, max_new_tokens)
+    return pipe
+
+
+def prompt_length(backend, templates=None):
+    '''
+    Function giving the prompt tokens of a conversation: exact with the model tokenizer
+    (cheap with pre-tokenized templates), approximate for remote backends.
+    '''
+    if templates is not None:
+        return lambda messages: len(templates.encode(messages))
+    tokenizer = getattr(backend, "tokenizer", None)
+    if tokenizer is not None:
+        def length(messages):
+            text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            return len(tokenizer(text, add_special_tokens=False).input_ids)
+        return length
+    return lambda messages: sum(approx_tokens(m["content"]) for m in messages)
+
+
+def with_inference_cache(pipe, backend, prompt_module, max_new_tokens=512, cache=None):
+    '''
+    Adds the persistent inference cache on top of a pipe, keyed on the current
+    version of the prompt module and on the early stopping of the backend.
+    '''
+    from Inference_cache import InferenceCache, CachedPipeline, prompt_module_version
+    stopping = "json_object" if getattr(backend, "stop_at_json", False) else None
+    return CachedPipeline(pipe, cache or InferenceCache(), backend.model_id,
+                          quantization=backend.quantization(),
+                          prompt_version=prompt_module_version(prompt_module),
+                          max_new_tokens=max_new_tokens, do_sample=False, stopping=stopping)
+
+
+def pipeline_stats(pipe):
+    '''
+    Collects the statistics of every layer of a pipeline stack (and of the pre-tokenized
+    templates, shared by the in-process layers, as "TemplateCompiler").
+    '''
+    stats = {}
+    while pipe is not None:
+        name = type(pipe).__name__
+        if hasattr(pipe, "cache") and hasattr(pipe.cache, "stats"):
+            stats[name] = pipe.cache.stats()
+        elif hasattr(pipe, "stats"):
+            stats[name] = pipe.stats() if callable(pipe.stats) else pipe.stats.as_dict()
+        if getattr(pipe, "templates", None) is not None:
+            stats.setdefault("TemplateCompiler", pipe.templates.stats())
+        pipe = getattr(pipe, "pipe", None) if not isinstance(pipe, TransformersBackend) else None
+    return stats
@@ -0,0 +1,274 @@
+## Reproducible latency/throughput benchmark of the extraction strategies.
+## Runs each strategy on the first N requirements of Dataset_50 / Dataset_250, against the
+## real model or the deterministic fake backend (fixed latency per token), and reports
+## per-requirement latency percentiles, throughput, LLM calls and tokens per requirement.
+## Results are saved as JSON and compared with a stored baseline: metrics that got worse
+## by more than the tolerance are flagged (exit code 1).
+##
+## Usage (from the repository root):
+##   python Codes/Benchmark.py --limit 20 --save-baseline benchmark_results/baseline.json
+##   python Codes/Benchmark.py --limit 20 --baseline benchmark_results/baseline.json
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from Async_runner import AsyncRequirementRunner
+from Backends import BACKENDS, approx_tokens, load_backend
+from Extraction_daemon import ExtractionService
+from Instrumentation import TRACER
+from Strategies import STRATEGIES
+
+HF_TOKEN = '< YOUR TOKEN >'
+
+MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+OUTPUT_FILE = "benchmark_results/latest.json"
+SERVER_URL = "http://localhost:8000/v1"
+CPU_THREADS = None
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+
+DATASETS = {
+    "Dataset_50": "Datasets/Dataset_50/cleaned_requirements_final.json",
+    "Dataset_250": "Datasets/Dataset_250/requirements.json",
+}
+
+# Direction in which each metric gets better
+METRICS = {
+    "p50_ms": "lower",
+    "p95_ms": "lower",
+    "p99_ms": "lower",
+    "requirements_per_s": "higher",
+    "calls_per_requirement": "lower",
+    "tokens_in_per_requirement": "lower",
+    "tokens_out_per_requirement": "lower",
+}
+
+
+class CallCounter:
+    '''
+    Pipeline wrapper counting the LLM calls and the prompt/generated tokens
+    (with the model tokenizer when there is one, approximately otherwise).
+    '''
+
+    def __init__(self, pipe, tokenizer=None):
+        self.pipe = pipe
+        self.tokenizer = tokenizer
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def _count(self, text):
+        if self.tokenizer is None:
+            return approx_tokens(text)
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def _prompt_tokens(self, messages):
+        if self.tokenizer is None:
+            return sum(approx_tokens(m["content"]) for m in messages)
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return self._count(text)
+
+    def __call__(self, inputs, **gen_kwargs):
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+        tokens_in = sum(self._prompt_tokens(messages) for messages in conversations)
+
+        outputs = self.pipe(inputs, **gen_kwargs)
+        texts = [outputs[0]['generated_text']] if single else [o[0]['generated_text'] for o in outputs]
+        tokens_out = sum(self._count(text) for text in texts)
+
+        with self.lock:
+            self.calls += len(conversations)
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+        return outputs
+
+
+class _RecordSink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+def benchmark_strategy(service, counter, strategy, entries, max_in_flight=1, warmup=1, input_file=None):
+    '''
+    Runs one strategy requirement by requirement and returns its metrics.
+    '''
+    for entry in entries[:warmup]:
+        service.extract(strategy, [entry], input_file)
+    counter.reset()
+
+    latencies = []
+
+    def task(entry):
+        start = time.perf_counter()
+        record = service.extract(strategy, [entry], input_file)[0]
+        latencies.append(time.perf_counter() - start)
+        return record
+
+    sink = _RecordSink()
+    runner = AsyncRequirementRunner(task, max_in_flight=max_in_flight, progress=False)
+    stats = runner.run_sync(entries, sink)
+
+    n = max(1, len(latencies))
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "requirements": len(latencies),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "requirements_per_s": stats["requirements_per_s"],
+        "calls_per_requirement": counter.calls / n,
+        "tokens_in_per_requirement": counter.tokens_in / n,
+        "tokens_out_per_requirement": counter.tokens_out / n,
+        "error_records": sum(1 for record in sink.records if "error" in record),
+        "failed": stats["failed"],
+    }
+
+
+def run_benchmark(service, counter, datasets, strategies, limit=20, max_in_flight=1, warmup=1):
+    results = {}
+    for dataset in datasets:
+        with open(DATASETS[dataset], 'r', encoding='utf-8') as f:
+            entries = json.load(f)[:limit]
+
+        results[dataset] = {}
+        for strategy in strategies:
+            print(f"[{dataset}] {strategy} on {len(entries)} requirements...")
+            results[dataset][strategy] = benchmark_strategy(service, counter, strategy, entries,
+                                                            max_in_flight, warmup, DATASETS[dataset])
+
+        # Relative cost of each strategy (e.g. SCAP vs one-shot)
+        if "one_shot" in results[dataset]:
+            base = results[dataset]["one_shot"]["p50_ms"]
+            for metrics in results[dataset].values():
+                metrics["p50_vs_one_shot"] = metrics["p50_ms"] / base if base > 0 else 0
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=0.10):
+    '''
+    Returns the metrics that are worse than in the baseline by more than `tolerance`.
+    '''
+    regressions = []
+    for dataset, strategies in results.items():
+        for strategy, metrics in strategies.items():
+            old = baseline.get(dataset, {}).get(strategy)
+            if old is None:
+                continue
+            for metric, better in METRICS.items():
+                if metric not in old or old[metric] == 0:
+                    continue
+                change = (metrics[metric] - old[metric]) / old[metric]
+                if (better == "lower" and change > tolerance) or (better == "higher" and change < -tolerance):
+                    regressions.append({"dataset": dataset, "strategy": strategy, "metric": metric,
+                                        "baseline": old[metric], "current": metrics[metric],
+                                        "change": change})
+    return regressions
+
+
+def print_results(results):
+    header = f"{'strategy':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>7} {'calls':>6} {'tok in':>8} {'tok out':>8}"
+    for dataset, strategies in results.items():
+        print(f"\n{dataset}")
+        print(header)
+        for strategy, m in strategies.items():
+            print(f"{strategy:<10} {m['p50_ms']:>9.1f} {m['p95_ms']:>9.1f} {m['p99_ms']:>9.1f} "
+                  f"{m['requirements_per_s']:>7.2f} {m['calls_per_requirement']:>6.1f} "
+                  f"{m['tokens_in_per_requirement']:>8.0f} {m['tokens_out_per_requirement']:>8.0f}")
+
+
+def save_json(data, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency/throughput benchmark of the extraction strategies.")
+    parser.add_argument("--dataset", action="append", choices=sorted(DATASETS),
+                        help="Dataset to use (repeatable, default: all)")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument("--limit", type=int, default=20, help="Requirements per dataset")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="fake")
+    parser.add_argument("--model-id", default=MODEL_ID)
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Fake backend: seconds per generated token")
+    parser.add_argument("--prefill-latency", type=float, default=0.0002, help="Fake backend: seconds per prompt token")
+    parser.add_argument("--max-in-flight", type=int, default=1, help="Requirements at once (1 = pure latency)")
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=1, help="Requirements run before measuring")
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    parser.add_argument("--baseline", help="Baseline JSON to compare with")
+    parser.add_argument("--save-baseline", help="Also save these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    parser.add_argument("--trace", help="Per-agent JSON trace of the run (Instrumentation.py)")
+    parser.add_argument("--metrics", help="Prometheus textfile of the run")
+    args = parser.parse_args()
+
+    backend = load_backend(args.backend, model_id=args.model_id if args.backend != "fake" else "fake",
+                           hf_token=HF_TOKEN, base_url=SERVER_URL, threads=CPU_THREADS,
+                           model_path=GGUF_PATH, token_latency=args.token_latency,
+                           prefill_latency=args.prefill_latency)
+    counters = []
+
+    def add_counter(pipe):
+        counters.append(CallCounter(pipe, getattr(backend, "tokenizer", None)))
+        return counters[-1]
+
+    # No inference cache: every call has to reach the backend
+    service = ExtractionService(backend, args.max_batch, inference_cache=False,
+                                max_wait=0.01 if args.max_in_flight > 1 else 0, wrap=add_counter)
+
+    if args.trace or args.metrics:
+        TRACER.enable()
+    results = run_benchmark(service, counters[0], args.dataset or list(DATASETS), args.strategies,
+                            args.limit, args.max_in_flight, args.warmup)
+    report = {
+        "config": {
+            "backend": args.backend,
+            "model_id": backend.model_id,
+            "token_latency": args.token_latency if args.backend == "fake" else None,
+            "prefill_latency": args.prefill_latency if args.backend == "fake" else None,
+            "limit": args.limit,
+            "max_in_flight": args.max_in_flight,
+            "max_batch": args.max_batch,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    save_json(report, args.output)
+    if args.save_baseline:
+        save_json(report, args.save_baseline)
+
+    print_results(results)
+    print(f"\nResults saved in: {args.output}")
+    TRACER.export(args.trace, args.metrics)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.baseline}:")
+            for r in regressions:
+                print(f"  [{r['dataset']}] {r['strategy']} {r['metric']}: "
+                      f"{r['baseline']:.2f} -> {r['current']:.2f} ({r['change']:+.0%})")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
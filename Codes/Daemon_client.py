@@ -0,0 +1,111 @@
+## Thin client of the extraction daemon (Extraction_daemon.py).
+## The scripts use it through BACKEND = "daemon" (raw generation on the resident model);
+## from the command line it runs a whole strategy on a dataset:
+##   python Codes/Daemon_client.py extract --strategy few_shot --input Datasets/Dataset_250/requirements.json --output few_shot_predictions.json
+##   python Codes/Daemon_client.py status | reload | trace | shutdown
+
+import argparse
+import json
+import os
+import socket
+
+from tqdm import tqdm
+
+from Results_writer import JsonlResultWriter, RunFingerprint, load_done_ids, compact_jsonl
+
+DEFAULT_SOCKET_PATH = "/tmp/requirements_extraction.sock"
+
+
+class DaemonClient:
+    '''
+    One JSON request per line over the Unix socket, one JSON response per line.
+    Each request opens its own connection, so the client can be shared by threads.
+    '''
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, op, **payload):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps({"op": op, **payload}) + "\n").encode("utf-8"))
+
+            with sock.makefile("r", encoding="utf-8") as stream:
+                line = stream.readline()
+        if not line:
+            raise RuntimeError("The daemon closed the connection without answering")
+
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise RuntimeError(f"Daemon error: {response.get('error')}")
+        return response
+
+    def status(self):
+        return self.request("status")
+
+    def reload(self):
+        return self.request("reload")["reloaded"]
+
+    def generate(self, conversations, **gen_kwargs):
+        return self.request("generate", conversations=conversations, gen_kwargs=gen_kwargs)["texts"]
+
+    def extract(self, strategy, requirements, input_file=None, training_file=None):
+        options = {key: value for key, value in (("input_file", input_file), ("training_file", training_file))
+                   if value is not None}
+        return self.request("extract", strategy=strategy, requirements=requirements, **options)["records"]
+
+    def shutdown(self):
+        return self.request("shutdown")
+
+
+def extract_dataset(client, strategy, input_file, output_file, chunk_size=16, training_file=None):
+    '''
+    Runs a strategy on a dataset through the daemon, with the resumable JSONL stream
+    of the scripts next to the output file. The daemon gets the (absolute) input path,
+    so mia_gated adds it (and `training_file`) to the labelled requirements of its gate.
+    '''
+    with open(input_file, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    # Same prompt module file as the daemon (it reloads the module when the file changes)
+    prompt_module = client.status()["prompt_modules"][strategy]
+    fingerprint = RunFingerprint(strategy, prompt_module)
+    expected = fingerprint.of_entries(dataset)
+
+    stream_file = output_file + "l" if output_file.endswith(".json") else output_file + ".jsonl"
+    done_ids = load_done_ids(stream_file, expected)
+    pending = [entry for entry in dataset if entry.get("id", "unknown") not in done_ids]
+    print(f"Processing {len(pending)} requirements ({len(done_ids)} already done)...")
+
+    with JsonlResultWriter(stream_file, flush_every=chunk_size, fingerprint=fingerprint) as writer:
+        for start in tqdm(range(0, len(pending), chunk_size)):
+            for record in client.extract(strategy, pending[start:start + chunk_size],
+                                         os.path.abspath(input_file),
+                                         os.path.abspath(training_file) if training_file else None):
+                writer.write(record)
+
+    return compact_jsonl(stream_file, output_file, [entry.get("id", "unknown") for entry in dataset], expected)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client of the extraction daemon")
+    parser.add_argument("command", choices=["status", "reload", "trace", "shutdown", "extract"])
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--strategy", help="zero_shot, one_shot, few_shot, scap, mia or mia_gated")
+    parser.add_argument("--input", default='Datasets/Dataset_250/requirements.json')
+    parser.add_argument("--output")
+    parser.add_argument("--training-file", help="Extra labelled dataset for the mia_gated gate")
+    parser.add_argument("--chunk-size", type=int, default=16)
+    args = parser.parse_args()
+
+    client = DaemonClient(args.socket)
+    if args.command == "extract":
+        if not args.strategy:
+            parser.error("extract needs --strategy")
+        output = args.output or f"{args.strategy}_predictions.json"
+        count = extract_dataset(client, args.strategy, args.input, output, args.chunk_size, args.training_file)
+        print(f"{count} records saved in: {output}")
+    else:
+        print(json.dumps(client.request(args.command), indent=4))
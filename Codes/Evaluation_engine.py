@@ -0,0 +1,636 @@
+## Headless evaluation engine (the code behind Evaluation.ipynb, no Colab needed).
+## The notebook imports its loaders, embedding store and matching code from here.
+## Runs the `potential_models` comparison for one or more datasets on a plain CPU box:
+## the (model x category) work is spread over a process pool, every worker keeps one
+## SBERT model, and the metrics are written to JSON/CSV.
+##
+## Usage (from the repository root):
+##   python Codes/Evaluation_engine.py --dataset Dataset_250 --dataset Dataset_50 --workers 4
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+SBERT_MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_STORE_DIR = "embedding_store"
+OUTPUT_DIR = "results_cli"
+
+TARGET_COLUMNS = [
+    'Purpose', 'Condition', 'Main_actor', 'Entity',
+    'System_response', 'Action', 'Precondition', 'Trigger'
+]
+
+DATASETS = {
+    "Dataset_250": {"dir": "Datasets/Dataset_250", "ground_truth": "requirements.json", "prefix": ""},
+    "Dataset_50": {"dir": "Datasets/Dataset_50", "ground_truth": "cleaned_requirements_final.json", "prefix": "clean_"},
+}
+
+# Same models and file names as the notebook and Strategies.STRATEGIES;
+# the order is the fallback chain used to tune the threshold
+POTENTIAL_MODELS = [
+    {"id": "multi_agent_1", "file": "multi_agent_predictions_8.json",
+     "name": "Llama-3 Multi-Agent_1", "strategy": "Agentic Workflow"},
+    {"id": "multi_agent", "file": "multi_agent_predictions_3.json",
+     "name": "Llama-3 Multi-Agent", "strategy": "Agentic Workflow"},
+    {"id": "few_shot", "file": "few_shot_predictions.json",
+     "name": "Llama-3 Few-Shot", "strategy": "In-Context (5-Shot)"},
+    {"id": "one_shot", "file": "one_shot_predictions.json",
+     "name": "Llama-3 One-Shot", "strategy": "In-Context Learning"},
+    {"id": "zero_shot", "file": "zero_shot_predictions.json",
+     "name": "Llama-3 Zero-Shot", "strategy": "Baseline"},
+    {"id": "multi_agent_gated", "file": "multi_agent_predictions_8_gated.json",
+     "name": "Llama-3 Multi-Agent_1 Gated", "strategy": "Agentic Workflow"},
+]
+
+SWEEP_THRESHOLDS = np.linspace(0.15, 0.99, 500)
+DEFAULT_THRESHOLD = 0.70
+
+
+# --- Loaders ---
+
+# id(data) -> (data, sha256 of the file it was loaded from), filled once per load
+LOADED_HASHES = {}
+
+def register_loaded(data, raw):
+    LOADED_HASHES[id(data)] = (data, hashlib.sha256(raw).hexdigest())
+    return data
+
+def content_hash(data):
+    '''
+    Hash of a dataset: the file hash recorded by the loader, so a lookup costs a dict access.
+    Data built elsewhere is hashed once and recorded the same way.
+    '''
+    entry = LOADED_HASHES.get(id(data))
+    if entry is None or entry[0] is not data:
+        entry = (data, hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest())
+        LOADED_HASHES[id(data)] = entry
+    return entry[1]
+
+def normalize_field(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if v and str(v).strip()]
+    if isinstance(value, str):
+        return [s.strip() for s in value.split('&-&') if s.strip()]
+    return []
+
+def load_and_normalize_ground_truth(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        data = json.loads(raw.decode('utf-8'))
+    except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError):
+        return {}
+
+    if not isinstance(data, list):
+        return {}
+
+    normalized_data = {}
+    for item in data:
+        rid = item.get('id')
+        if rid is None:
+            continue
+
+        entry = {'text': item.get('Text', '')}
+        for col in TARGET_COLUMNS:
+            entry[col] = normalize_field(item.get(col))
+        normalized_data[f"req_{rid}"] = entry
+
+    return register_loaded(normalized_data, raw)
+
+def load_predictions_json(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        data = json.loads(raw.decode('utf-8'))
+    except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError):
+        return {}
+
+    preds = {}
+    if isinstance(data, list):
+        for item in data:
+            rid = item.get('id')
+            if rid is None:
+                continue
+            source = item.get('prediction', item)
+            preds[f"req_{rid}"] = {col: normalize_field(source.get(col)) for col in TARGET_COLUMNS}
+
+    return register_loaded(preds, raw)
+
+
+# --- Embedding Store ---
+
+class EmbeddingStore:
+    '''
+    Deduplicated, persistent SBERT embeddings (same on-disk layout as the notebook):
+    a float32 matrix memory-mapped from disk plus a string -> row index.
+    A read-only store never writes: missing strings are encoded and kept in memory,
+    which lets many worker processes share the same files.
+    An already loaded SentenceTransformer can be passed as model (the notebook does).
+    '''
+
+    def __init__(self, model_name=SBERT_MODEL_NAME, store_dir=EMBEDDING_STORE_DIR, readonly=False,
+                 model=None):
+        self.model_name = model_name
+        self.readonly = readonly
+        self.model = model
+        self.dir = os.path.join(store_dir, model_name.replace('/', '_'))
+        self.matrix_path = os.path.join(self.dir, "embeddings.f32")
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.extra = {}
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        self.dim = None
+        self._open_matrix()
+
+    def _get_model(self):
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.model_name, device='cpu')
+        return self.model
+
+    def _open_matrix(self):
+        rows = len(self.index)
+        if rows == 0:
+            self.matrix = None
+            return
+        if self.dim is None:
+            self.dim = os.path.getsize(self.matrix_path) // (4 * rows)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def _encode(self, strings, batch_size):
+        vectors = self._get_model().encode(strings, batch_size=batch_size, convert_to_numpy=True,
+                                           show_progress_bar=False)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.dim = vectors.shape[1]
+        return vectors
+
+    def add(self, strings, batch_size=256):
+        new_strings = sorted({s for s in strings if s not in self.index and s not in self.extra})
+        if not new_strings:
+            return 0
+
+        vectors = self._encode(new_strings, batch_size)
+        if self.readonly:
+            self.extra.update(zip(new_strings, vectors))
+            return len(new_strings)
+
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.matrix_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        start = len(self.index)
+        for offset, s in enumerate(new_strings):
+            self.index[s] = start + offset
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+        self._open_matrix()
+        return len(new_strings)
+
+    def get_many(self, strings):
+        missing = [s for s in strings if s not in self.index and s not in self.extra]
+        if missing:
+            self.add(missing)
+        if not strings:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.stack([self.matrix[self.index[s]] if s in self.index else self.extra[s]
+                         for s in strings])
+
+def collect_unique_strings(*datasets):
+    strings = set()
+    for data in datasets:
+        for entry in data.values():
+            for col in TARGET_COLUMNS:
+                strings.update(entry.get(col, []))
+    return strings
+
+
+# --- Matching ---
+
+def similarity_matrix(store, pred_list, gt_list):
+    P = store.get_many(pred_list)
+    G = store.get_many(gt_list)
+    P = P / np.maximum(np.linalg.norm(P, axis=1, keepdims=True), 1e-12)
+    G = G / np.maximum(np.linalg.norm(G, axis=1, keepdims=True), 1e-12)
+    return P @ G.T
+
+def match_cell(gt_list, pred_list, threshold, sim):
+    '''
+    Greedy assignment of predictions to GT strings, identical to the notebook:
+    exact string matches first (similarity 1.0), otherwise the most similar GT still available.
+    Returns (tp, fp, fn, matches).
+    '''
+    if not pred_list or not gt_list:
+        return 0, len(pred_list), len(gt_list), []
+
+    exact = np.array(pred_list, dtype=object)[:, None] == np.array(gt_list, dtype=object)[None, :]
+    available = np.ones(len(gt_list), dtype=bool)
+    matches = []
+
+    for i, p in enumerate(pred_list):
+        if not available.any():
+            break
+
+        exact_row = exact[i] & available
+        if exact_row.any():
+            j = int(np.argmax(exact_row))
+            best_sim = 1.0
+        else:
+            row = np.where(available, sim[i], -np.inf)
+            j = int(np.argmax(row))
+            best_sim = float(row[j])
+
+        if best_sim >= threshold:
+            available[j] = False
+            matches.append((p, gt_list[j], best_sim))
+
+    tp = len(matches)
+    return tp, len(pred_list) - tp, len(gt_list) - tp, matches
+
+def match_strings(store, gt_list, pred_list, threshold):
+    '''
+    match_cell with the similarities taken from the store (only when both lists are non-empty).
+    '''
+    if not pred_list or not gt_list:
+        return match_cell(gt_list, pred_list, threshold, None)
+    return match_cell(gt_list, pred_list, threshold, similarity_matrix(store, pred_list, gt_list))
+
+def cell_threshold_steps(gt_list, pred_list, sim):
+    '''
+    TP of a cell as a step function of the threshold: [(upper, tp), ...].
+    '''
+    if not pred_list or not gt_list:
+        return []
+
+    steps = []
+    t = -np.inf
+    while True:
+        tp, _, _, matches = match_cell(gt_list, pred_list, t, sim)
+        if tp == 0:
+            break
+        upper = min(m[2] for m in matches)
+        steps.append((upper, tp))
+        t = np.nextafter(upper, np.inf)
+    return steps
+
+def column_steps(gt_data, pred_data, col, store):
+    '''
+    Threshold step data of one category for a whole dataset.
+    tp(t) = sum of the deltas whose upper bound is >= t.
+    '''
+    uppers, deltas = [], []
+    total_gt, total_pred = 0, 0
+
+    for req_id, gt_entry in gt_data.items():
+        gt_vals = gt_entry.get(col, [])
+        total_gt += len(gt_vals)
+        if req_id not in pred_data:
+            continue
+        pred_vals = pred_data[req_id].get(col, [])
+        total_pred += len(pred_vals)
+        if not gt_vals or not pred_vals:
+            continue
+
+        steps = cell_threshold_steps(gt_vals, pred_vals, similarity_matrix(store, pred_vals, gt_vals))
+        for k, (upper, tp) in enumerate(steps):
+            next_tp = steps[k + 1][1] if k + 1 < len(steps) else 0
+            uppers.append(upper)
+            deltas.append(tp - next_tp)
+
+    return {"uppers": uppers, "deltas": deltas, "total_gt": total_gt, "total_pred": total_pred}
+
+class ThresholdSweep:
+    '''
+    Precision/recall/F1 for any number of thresholds from the per-category step data.
+    '''
+
+    def __init__(self, steps_by_column):
+        self.columns = {}
+        for col, steps in steps_by_column.items():
+            order = np.argsort(steps["uppers"])
+            uppers = np.asarray(steps["uppers"], dtype=np.float64)[order]
+            deltas = np.asarray(steps["deltas"], dtype=np.int64)[order]
+            suffix = np.concatenate([np.cumsum(deltas[::-1])[::-1], [0]])
+            self.columns[col] = (uppers, suffix, steps["total_gt"], steps["total_pred"])
+
+    def counts(self, thresholds, columns=None):
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        tp = np.zeros(len(thresholds), dtype=np.int64)
+        total_gt, total_pred = 0, 0
+        for col in (columns or list(self.columns)):
+            uppers, suffix, n_gt, n_pred = self.columns[col]
+            tp += suffix[np.searchsorted(uppers, thresholds, side='left')]
+            total_gt += n_gt
+            total_pred += n_pred
+        return tp, total_pred - tp, total_gt - tp
+
+    def curve(self, thresholds, columns=None):
+        tp, fp, fn = self.counts(thresholds, columns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+            recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        return {"precision": precision, "recall": recall, "f1": f1}
+
+    def metrics(self, threshold, columns=None):
+        curve = self.curve([threshold], columns)
+        return {name: float(values[0]) for name, values in curve.items()}
+
+    def best_threshold(self, thresholds):
+        f1 = self.curve(thresholds)["f1"]
+        best_idx = int(np.argmax(f1))
+        return float(np.asarray(thresholds)[best_idx]), float(f1[best_idx])
+
+class MatchMemo:
+    '''
+    Per-cell match results (TP/FP/FN and matched pairs) computed once and shared by
+    every report of the notebook. Tables are keyed on the hashes of the ground truth and
+    prediction files taken at load time, so reloading a changed file invalidates them.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, kind, gt_data, pred_data, threshold, build):
+        key = (kind, content_hash(gt_data), content_hash(pred_data), float(threshold))
+        if key in self.tables:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.tables[key] = build()
+        return self.tables[key]
+
+    def table(self, gt_data, pred_data, threshold):
+        '''
+        {(req_id, col): (tp, fp, fn, matches)} for every GT requirement and column.
+        '''
+        def build():
+            table = {}
+            for req_id, gt_entry in gt_data.items():
+                for col in TARGET_COLUMNS:
+                    gt_vals = gt_entry.get(col, [])
+                    if req_id not in pred_data:
+                        table[(req_id, col)] = (0, 0, len(gt_vals), [])
+                    else:
+                        table[(req_id, col)] = match_strings(self.store, gt_vals,
+                                                             pred_data[req_id].get(col, []), threshold)
+            return table
+        return self._lookup("cells", gt_data, pred_data, threshold, build)
+
+    def pooled(self, gt_data, pred_data, threshold):
+        '''
+        {req_id: (tp, fp, fn, matches)} matching all the columns of a requirement together.
+        '''
+        def build():
+            pooled = {}
+            for req_id, gt_entry in gt_data.items():
+                if req_id not in pred_data:
+                    continue
+                gt_all = [v for col in TARGET_COLUMNS for v in gt_entry.get(col, [])]
+                pred_all = [v for col in TARGET_COLUMNS for v in pred_data[req_id].get(col, [])]
+                pooled[req_id] = match_strings(self.store, gt_all, pred_all, threshold)
+            return pooled
+        return self._lookup("pooled", gt_data, pred_data, threshold, build)
+
+    def confusion(self, gt_data, pred_data, threshold):
+        '''
+        GT category x predicted category counts (first predicted column reaching the threshold).
+        '''
+        def build():
+            cols = TARGET_COLUMNS
+            matrix = np.zeros((len(cols), len(cols)))
+            for req_id, gt_entry in gt_data.items():
+                if req_id not in pred_data:
+                    continue
+                gt_items = [(i, v) for i, col in enumerate(cols) for v in gt_entry.get(col, [])]
+                pred_items = [(j, v) for j, col in enumerate(cols) for v in pred_data[req_id].get(col, [])]
+                if not gt_items or not pred_items:
+                    continue
+
+                sim = similarity_matrix(self.store, [v for _, v in pred_items], [v for _, v in gt_items])
+                hit = sim.T >= threshold
+                for row, (i, _) in enumerate(gt_items):
+                    if hit[row].any():
+                        matrix[i, pred_items[int(np.argmax(hit[row]))][0]] += 1
+            return matrix
+        return self._lookup("confusion", gt_data, pred_data, threshold, build)
+
+    def totals(self, gt_data, pred_data, threshold, columns=None):
+        columns = columns or TARGET_COLUMNS
+        total_tp, total_fp, total_fn = 0, 0, 0
+        for (req_id, col), (tp, fp, fn, _) in self.table(gt_data, pred_data, threshold).items():
+            if col in columns:
+                total_tp += tp; total_fp += fp; total_fn += fn
+        return total_tp, total_fp, total_fn
+
+def calculate_exact_match_score(gt_data, pred_data):
+    total_tp, total_fp, total_fn = 0, 0, 0
+
+    for req_id, gt_entry in gt_data.items():
+        if req_id not in pred_data:
+            for col in TARGET_COLUMNS:
+                total_fn += len(gt_entry.get(col, []))
+            continue
+
+        pred_entry = pred_data[req_id]
+        for col in TARGET_COLUMNS:
+            gt_vals = [s.lower().strip() for s in gt_entry.get(col, [])]
+            pred_vals = [s.lower().strip() for s in pred_entry.get(col, [])]
+
+            current_tp = 0
+            for p in pred_vals[:]:
+                if p in gt_vals:
+                    current_tp += 1
+                    gt_vals.remove(p)
+                    pred_vals.remove(p)
+
+            total_tp += current_tp
+            total_fp += len(pred_vals)
+            total_fn += len(gt_vals)
+
+    precision = total_tp / (total_tp + total_fp) if (total_tp + total_fp) > 0 else 0
+    recall = total_tp / (total_tp + total_fn) if (total_tp + total_fn) > 0 else 0
+    return 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+
+
+# --- Process pool ---
+
+_worker_store = None
+_worker_data = {}
+
+def _init_worker(model_name, store_dir, threads):
+    '''
+    Runs once per worker: one read-only store (and lazily one SBERT model) per process.
+    '''
+    global _worker_store
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_store = EmbeddingStore(model_name, store_dir, readonly=True)
+
+def _load_cached(path, loader):
+    if path not in _worker_data:
+        _worker_data[path] = loader(path)
+    return _worker_data[path]
+
+def _column_task(task):
+    dataset, model_id, col, gt_path, pred_path = task
+    gt_data = _load_cached(gt_path, load_and_normalize_ground_truth)
+    pred_data = _load_cached(pred_path, load_predictions_json)
+    return dataset, model_id, col, column_steps(gt_data, pred_data, col, _worker_store)
+
+
+def evaluate_datasets(dataset_names, workers=os.cpu_count(), threshold=None,
+                      model_name=SBERT_MODEL_NAME, store_dir=EMBEDDING_STORE_DIR):
+    '''
+    Runs the model comparison for every dataset and returns the metrics as a dictionary.
+    With threshold=None the threshold is tuned on the first available model of the
+    fallback chain (as in the notebook).
+    '''
+    # 1. Load everything once and fill the shared embedding store (single writer)
+    tasks = []
+    loaded = {}
+    for name in dataset_names:
+        cfg = DATASETS[name]
+        gt_path = os.path.join(cfg["dir"], cfg["ground_truth"])
+        gt_data = load_and_normalize_ground_truth(gt_path)
+        models = []
+        for model in POTENTIAL_MODELS:
+            pred_path = os.path.join(cfg["dir"], cfg["prefix"] + model["file"])
+            pred_data = load_predictions_json(pred_path)
+            if not pred_data:
+                print(f"[{name}] No data loaded for {model['id']} ({pred_path})")
+                continue
+            models.append((model, pred_data))
+            tasks += [(name, model["id"], col, gt_path, pred_path) for col in TARGET_COLUMNS]
+        loaded[name] = (gt_data, models)
+
+    store = EmbeddingStore(model_name, store_dir)
+    all_strings = collect_unique_strings(*[d for gt, models in loaded.values()
+                                           for d in [gt] + [p for _, p in models]])
+    added = store.add(all_strings)
+    print(f"Embedding store: {len(store.index)} strings ({added} newly encoded)")
+
+    # 2. (model x category) step data, in parallel
+    steps = {}
+    if workers and workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(model_name, store_dir, threads)) as pool:
+            for dataset, model_id, col, col_steps in pool.map(_column_task, tasks):
+                steps.setdefault((dataset, model_id), {})[col] = col_steps
+    else:
+        for dataset, model_id, col, gt_path, pred_path in tasks:
+            gt_data, models = loaded[dataset]
+            pred_data = next(p for m, p in models if m["id"] == model_id)
+            steps.setdefault((dataset, model_id), {})[col] = column_steps(gt_data, pred_data, col, store)
+
+    # 3. Metrics
+    report = {}
+    for name, (gt_data, models) in loaded.items():
+        sweeps = {model["id"]: ThresholdSweep(steps[(name, model["id"])]) for model, _ in models}
+
+        best_per_model = {mid: sweep.best_threshold(SWEEP_THRESHOLDS) for mid, sweep in sweeps.items()}
+        if threshold is not None:
+            used_threshold = threshold
+        elif models:
+            used_threshold = best_per_model[models[0][0]["id"]][0]
+        else:
+            used_threshold = DEFAULT_THRESHOLD
+
+        results = []
+        for model, pred_data in models:
+            sweep = sweeps[model["id"]]
+            metrics = sweep.metrics(used_threshold)
+            results.append({
+                "id": model["id"],
+                "Model Architecture": model["name"],
+                "Strategy": model["strategy"],
+                "Precision": metrics["precision"],
+                "Recall": metrics["recall"],
+                "F1-Score": metrics["f1"],
+                "Exact-Match F1": calculate_exact_match_score(gt_data, pred_data),
+                "Optimal Threshold": best_per_model[model["id"]][0],
+                "Optimal F1": best_per_model[model["id"]][1],
+                "Category F1": {col: sweep.metrics(used_threshold, [col])["f1"] for col in TARGET_COLUMNS},
+            })
+
+        report[name] = {"threshold": used_threshold, "num_requirements": len(gt_data), "models": results}
+
+    return report
+
+def write_report(report, output_dir=OUTPUT_DIR):
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(os.path.join(output_dir, "metrics.json"), "w", encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+
+    summary_fields = ["Dataset", "Model Architecture", "Strategy", "Precision", "Recall", "F1-Score",
+                      "Exact-Match F1", "Optimal Threshold", "Optimal F1"]
+    with open(os.path.join(output_dir, "summary_metrics.csv"), "w", newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=summary_fields, extrasaction='ignore')
+        writer.writeheader()
+        for dataset, data in report.items():
+            for row in data["models"]:
+                writer.writerow({"Dataset": dataset, **row})
+
+    with open(os.path.join(output_dir, "category_breakdown.csv"), "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Dataset", "Model Architecture"] + TARGET_COLUMNS)
+        for dataset, data in report.items():
+            for row in data["models"]:
+                writer.writerow([dataset, row["Model Architecture"]] +
+                                [row["Category F1"][col] for col in TARGET_COLUMNS])
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless SBERT evaluation of the extraction strategies.")
+    parser.add_argument("--dataset", action="append", choices=sorted(DATASETS),
+                        help="Dataset to evaluate (repeatable, default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes (1 = run serially)")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="Fixed similarity threshold (default: tuned on the fallback chain)")
+    parser.add_argument("--sbert-model", default=SBERT_MODEL_NAME)
+    parser.add_argument("--store-dir", default=EMBEDDING_STORE_DIR)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    report = evaluate_datasets(args.dataset or sorted(DATASETS), workers=args.workers,
+                               threshold=args.threshold, model_name=args.sbert_model,
+                               store_dir=args.store_dir)
+    write_report(report, args.output_dir)
+
+    for dataset, data in report.items():
+        print(f"\n{dataset} (threshold {data['threshold']:.3f})")
+        for row in data["models"]:
+            print(f"  {row['Model Architecture']:<25} P={row['Precision']:.3f} "
+                  f"R={row['Recall']:.3f} F1={row['F1-Score']:.3f}")
+
+    print("-" * 30)
+    print(f"Total Time: {time.time() - start_time:.2f} seconds")
+    print(f"Metrics saved in: {args.output_dir}")
+    print("-" * 30)
+
+if __name__ == "__main__":
+    main()
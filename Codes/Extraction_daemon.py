@@ -0,0 +1,250 @@
+## Resident extraction daemon: loads the model once and serves extraction jobs over a
+## Unix socket, so one-shot, few-shot, SCAP and MIA runs no longer pay the model load
+## each. Requests from concurrent clients are merged into the same padded batches.
+## Prompt modules are reloaded when their file changes (or on a "reload" request), so
+## prompts can be edited between runs while the model stays in memory.
+## Usage: python Codes/Extraction_daemon.py, then Daemon_client.py or BACKEND = "daemon".
+##
+## Protocol: one JSON object per line, answered by one JSON object per line.
+##   {"op": "status"}
+##   {"op": "reload"}
+##   {"op": "generate", "conversations": [[messages], ...], "gen_kwargs": {...}}
+##   {"op": "extract", "strategy": "few_shot", "requirements": [{"id": ..., "Text": ...}]}
+##     (mia_gated also takes "input_file", the dataset of the requirements, and "training_file",
+##      another labelled dataset for its gate)
+##   {"op": "trace"}      (writes the trace and metrics files when TRACE is on)
+##   {"op": "shutdown"}
+
+import json
+import os
+import socketserver
+from functools import partial
+import threading
+import time
+
+from Backends import load_backend, build_pipeline_stack, pipeline_stats, with_inference_cache
+from Async_runner import CallBatcher
+from Daemon_client import DEFAULT_SOCKET_PATH
+from Inference_cache import InferenceCache, prompt_module_version
+from Instrumentation import TRACER, InstrumentedPipe
+from Strategies import STRATEGIES, PromptRegistry, gating_training_files, mia_gate
+
+HF_TOKEN = '< YOUR TOKEN >'
+
+MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+SOCKET_PATH = DEFAULT_SOCKET_PATH
+BACKEND = "transformers"   # or "cpu", "gguf", "http" (see Backends.py)
+SERVER_URL = "http://localhost:8000/v1"
+HTTP_CONCURRENCY = 32
+CPU_THREADS = None
+CPU_BATCH_SIZE = 4
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+MAX_BATCH = 16             # Conversations of concurrent jobs decoded together
+USE_PREFIX_CACHE = False
+USE_PROMPT_LOOKUP = False
+USE_COMPILED_TEMPLATES = False  # Pre-tokenized system prompts (Prompt_templates.py)
+TOKEN_BUDGET = None        # Padded prompt tokens per batch, length-bucketed (Length_scheduler.py)
+USE_INFERENCE_CACHE = True
+NEAR_DUP_THRESHOLD = None  # Reuse the records of near-duplicate requirements across jobs (Near_duplicates.py)
+TRACE = False              # Per-strategy/agent timings and tokens (Instrumentation.py)
+TRACE_FILE = 'daemon_trace.json'
+METRICS_FILE = 'daemon_metrics.prom'  # Prometheus textfile, rewritten on "trace" and at shutdown
+
+
+class ExtractionService:
+    '''
+    The loaded model plus the per-strategy pipes. Only the CallBatcher thread touches
+    the model; the inference cache of a prompt module is rebuilt when the module changes.
+    With `near_dup_threshold`, the records of a strategy are indexed and reused for the
+    near-duplicate requirements of later jobs (until its prompt module changes).
+    '''
+
+    def __init__(self, backend, max_batch=MAX_BATCH, prefix_cache=False, prompt_lookup=False,
+                 inference_cache=True, max_wait=0.01, wrap=None, compiled_templates=False,
+                 token_budget=None, near_dup_threshold=None):
+        self.backend = backend
+        self.batcher = None
+        self.instrumented = None
+
+        def add_batcher(pipe):
+            # `wrap` (e.g. call counting) and the instrumentation see the calls before they are merged
+            self.batcher = CallBatcher(pipe, max_batch, max_wait)
+            pipe = wrap(self.batcher) if wrap is not None else self.batcher
+            self.instrumented = InstrumentedPipe(pipe, TRACER)
+            return self.instrumented
+
+        self.generator = build_pipeline_stack(backend, None, max_new_tokens=512,
+                                              prefix_cache=prefix_cache,
+                                              prompt_lookup=prompt_lookup,
+                                              compiled_templates=compiled_templates,
+                                              token_budget=token_budget,
+                                              inference_cache=False,
+                                              wrap=add_batcher)
+        self.cache = InferenceCache() if inference_cache else None
+        self.lock = threading.Lock()
+        # Read and reloaded by concurrent handler threads: guarded by the service lock
+        self.prompts = PromptRegistry(self.lock)
+        self.pipes = {}  # (prompt module, max_new_tokens) -> (module version, pipe)
+        self.near_dup_threshold = near_dup_threshold
+        self.reuse = {}  # strategy -> (module version, ExtractionReuse)
+        self.started = time.time()
+        self.jobs = 0
+
+    def pipe_for(self, module_name, max_new_tokens):
+        if self.cache is None:
+            return self.generator
+        version = prompt_module_version(module_name)
+        with self.lock:
+            key = (module_name, max_new_tokens)
+            if key not in self.pipes or self.pipes[key][0] != version:
+                pipe = with_inference_cache(self.generator, self.backend, module_name,
+                                            max_new_tokens, cache=self.cache)
+                self.pipes[key] = (version, pipe)
+            return self.pipes[key][1]
+
+    def reuse_for(self, strategy, module_name):
+        if self.near_dup_threshold is None:
+            return None
+        from Near_duplicates import ExtractionReuse  # numpy, only when turned on
+        version = prompt_module_version(module_name)
+        with self.lock:
+            if strategy not in self.reuse or self.reuse[strategy][0] != version:
+                self.reuse[strategy] = (version, ExtractionReuse(self.near_dup_threshold))
+            return self.reuse[strategy][1]
+
+    def extract(self, strategy, requirements, input_file=None, training_file=None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy: {strategy} (available: {', '.join(STRATEGIES)})")
+        config = STRATEGIES[strategy]
+        run = config["run"]
+        if config.get("gated"):
+            # Cross-fitted: a labelled requirement is never gated with its own labels
+            run = partial(run, gate=mia_gate(gating_training_files(input_file, training_file)))
+        prompts = self.prompts.get(config["prompt_module"])
+        pipe = self.pipe_for(config["prompt_module"], config["max_new_tokens"])
+        agents = config["agents"](prompts) if TRACER.enabled else None
+        # Handler threads run extract() concurrently
+        with self.lock:
+            self.jobs += 1
+            if agents is not None:
+                self.instrumented.agents.update(agents)
+        reuse = self.reuse_for(strategy, config["prompt_module"])
+        with TRACER.context(strategy=strategy):
+            if reuse is not None:
+                from Near_duplicates import extract_with_reuse
+                return extract_with_reuse(reuse, requirements,
+                                          lambda entries: run(entries, pipe, prompts))
+            return run(requirements, pipe, prompts)
+
+    def export_trace(self, trace_file=TRACE_FILE, metrics_file=METRICS_FILE):
+        if not TRACER.enabled:
+            raise ValueError("Tracing is off (set TRACE = True in Extraction_daemon.py)")
+        TRACER.export_json(trace_file)
+        TRACER.export_prometheus(metrics_file)
+        return {"trace_file": trace_file, "metrics_file": metrics_file}
+
+    def generate(self, conversations, gen_kwargs):
+        outputs = self.generator(conversations, **gen_kwargs)
+        return [output[0]['generated_text'] for output in outputs]
+
+    def status(self):
+        status = {
+            "model_id": self.backend.model_id,
+            "quantization": self.backend.quantization(),
+            "strategies": list(STRATEGIES),
+            "prompt_modules": {strategy: config["prompt_module"] for strategy, config in STRATEGIES.items()},
+            "uptime_s": time.time() - self.started,
+            "jobs": self.jobs,
+            "batcher": self.batcher.stats(),
+        }
+        layers = pipeline_stats(self.generator)
+        # In-process layers under the batcher: prefix cache, prompt lookup, templates
+        status["layers"] = {name: layer for name, layer in layers.items()
+                            if name not in ("CallBatcher", "LengthBucketedPipe")}
+        if "LengthBucketedPipe" in layers:
+            status["length_buckets"] = layers["LengthBucketedPipe"]
+        if self.cache is not None:
+            status["inference_cache"] = self.cache.stats()
+        if self.reuse:
+            status["near_duplicates"] = {strategy: reuse.stats() for strategy, (_, reuse) in self.reuse.items()}
+        return status
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "status":
+            return self.status()
+        if op == "reload":
+            return {"reloaded": self.prompts.reload_all()}
+        if op == "generate":
+            return {"texts": self.generate(request["conversations"], request.get("gen_kwargs", {}))}
+        if op == "extract":
+            return {"records": self.extract(request["strategy"], request["requirements"],
+                                            request.get("input_file"), request.get("training_file"))}
+        if op == "trace":
+            return self.export_trace()
+        raise ValueError(f"Unknown op: {op}")
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get("op") == "shutdown":
+                    self._reply({"ok": True})
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                    return
+                self._reply({"ok": True, **self.server.service.handle(request)})
+            except Exception as e:
+                self._reply({"ok": False, "error": f"{type(e).__name__}: {e}"})
+
+    def _reply(self, response):
+        self.wfile.write((json.dumps(response, default=str) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # Left over by a previous daemon
+        super().__init__(socket_path, DaemonHandler)
+        self.service = service
+
+
+def serve(service, socket_path=SOCKET_PATH):
+    server = DaemonServer(socket_path, service)
+    print(f"Extraction daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("Extraction daemon stopped")
+
+
+def main():
+    if TRACE:
+        TRACER.enable()
+
+    backend = load_backend(BACKEND, model_id=MODEL_ID, hf_token=HF_TOKEN, max_new_tokens=512,
+                           base_url=SERVER_URL, max_concurrency=HTTP_CONCURRENCY,
+                           threads=CPU_THREADS, batch_size=CPU_BATCH_SIZE, model_path=GGUF_PATH)
+    service = ExtractionService(backend, MAX_BATCH, prefix_cache=USE_PREFIX_CACHE,
+                                prompt_lookup=USE_PROMPT_LOOKUP, inference_cache=USE_INFERENCE_CACHE,
+                                compiled_templates=USE_COMPILED_TEMPLATES, token_budget=TOKEN_BUDGET,
+                                near_dup_threshold=NEAR_DUP_THRESHOLD)
+    try:
+        serve(service, SOCKET_PATH)
+    finally:
+        if TRACE:
+            print(f"Trace saved in: {service.export_trace()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+## Persistent, content-addressed cache of LLM outputs shared by all the inference scripts.
+## Every call is keyed on the model, the quantization, the generation settings, the fully
+## rendered messages and the version of the prompt module, so a rerun only sends the
+## (requirement, agent) pairs that actually changed to the model.
+
+import hashlib
+import importlib.util
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = ".inference_cache/llm_cache.sqlite"
+DEFAULT_MAX_SIZE_MB = 512
+
+
+def prompt_module_version(module_name):
+    '''
+    Short hash of the source file of a prompt module (read from disk, imported or not).
+    '''
+    spec = importlib.util.find_spec(module_name)
+    with open(spec.origin, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def describe_quantization(model):
+    '''
+    Returns the quantization config of a loaded model as a plain dictionary.
+    '''
+    config = getattr(model.config, "quantization_config", None)
+    if config is None:
+        return None
+    if hasattr(config, "to_dict"):
+        return config.to_dict()
+    return dict(config)
+
+
+class InferenceCache:
+    '''
+    SQLite-backed key/value store. WAL mode and a busy timeout make it safe to use
+    from several processes at once (and a lock from several threads); when the size
+    cap is exceeded, the least recently used entries are evicted.
+    '''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.path = path
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access)")
+
+    @staticmethod
+    def make_key(model_id, quantization, gen_kwargs, messages, prompt_version):
+        payload = {
+            "model": model_id,
+            "quantization": quantization,
+            "generation": gen_kwargs,
+            "messages": messages,
+            "prompt_version": prompt_version,
+        }
+        blob = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, last_access) "
+                    "VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+                self._evict()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_size_bytes:
+            return
+
+        rows = self.conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in rows:
+            if total <= self.max_size_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", to_delete)
+
+    def stats(self):
+        with self.lock:
+            count, total = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "entries": count,
+            "size_mb": total / (1024 * 1024),
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedPipeline:
+    '''
+    Wraps a text-generation pipeline (or anything with the same call signature):
+    cached conversations are answered from disk, only the misses reach the model.
+    `default_gen_kwargs` are the settings the pipeline was built with; they are part
+    of the key but are not forwarded.
+    '''
+
+    def __init__(self, pipe, cache, model_id, quantization=None, prompt_version="", **default_gen_kwargs):
+        self.pipe = pipe
+        self.cache = cache
+        self.model_id = model_id
+        self.quantization = quantization
+        self.prompt_version = prompt_version
+        self.default_gen_kwargs = default_gen_kwargs
+
+    def __call__(self, inputs, **gen_kwargs):
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+
+        key_kwargs = {**self.default_gen_kwargs, **gen_kwargs}
+        key_kwargs.pop("batch_size", None)
+        keys = [self.cache.make_key(self.model_id, self.quantization, key_kwargs,
+                                    messages, self.prompt_version)
+                for messages in conversations]
+        texts = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if missing:
+            outputs = self.pipe([conversations[i] for i in missing], **gen_kwargs)
+            for i, output in zip(missing, outputs):
+                texts[i] = output[0]['generated_text']
+                self.cache.put(keys[i], texts[i])
+
+        results = [[{"generated_text": text}] for text in texts]
+        return results[0] if single else results
@@ -0,0 +1,257 @@
+## Hot-path instrumentation of the pipelines.
+## Spans (wall time) and counters labelled by strategy and agent, for every LLM call
+## (generation, and prefill/decode for in-process models) and every post-processing
+## step (JSON parsing, fallbacks to empty output). Token counts are the ones reported by
+## the layer that ran the model (generation_output); nothing is tokenized again to measure.
+## Exported as a per-run JSON trace and as a Prometheus textfile. When tracing is off,
+## span() returns a shared no-op context and nothing is recorded.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+METRIC_PREFIX = "requirements_extraction"
+
+_NO_SPAN = nullcontext()
+
+
+class Tracer:
+    '''
+    Collects spans and counters. Labels come from the call, the thread context
+    (context(), e.g. the strategy of a daemon job) and the run defaults, in this order.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.default_labels = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+        self.started = time.time()
+
+    def enable(self, **default_labels):
+        self.enabled = True
+        self.default_labels = default_labels
+        self.spans = []
+        self.counters = {}
+        self.started = time.time()
+
+    def disable(self):
+        self.enabled = False
+
+    def labels(self, **labels):
+        context = getattr(self.local, "labels", {})
+        return {**self.default_labels, **context, **labels}
+
+    @contextmanager
+    def context(self, **labels):
+        '''
+        Labels added to everything recorded by the current thread inside the block.
+        '''
+        previous = getattr(self.local, "labels", {})
+        self.local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def span(self, name, **labels):
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, labels)
+
+    @contextmanager
+    def _span(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **labels)
+
+    def record(self, name, duration, **labels):
+        if not self.enabled:
+            return
+        span = {"name": name, "labels": self.labels(**labels),
+                "start": time.time() - duration - self.started, "duration": duration}
+        with self.lock:
+            self.spans.append(span)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(self.labels(**labels).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        '''
+        Per (span, labels): count, total, mean and max in seconds.
+        '''
+        groups = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            key = (span["name"], tuple(sorted(span["labels"].items())))
+            groups.setdefault(key, []).append(span["duration"])
+
+        return [{"span": name, "labels": dict(labels), "count": len(durations),
+                 "total_s": sum(durations), "mean_s": sum(durations) / len(durations),
+                 "max_s": max(durations)}
+                for (name, labels), durations in sorted(groups.items())]
+
+    def export_json(self, path):
+        with self.lock:
+            counters = [{"counter": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            spans = list(self.spans)
+        trace = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_s": time.time() - self.started,
+            "summary": self.summary(),
+            "counters": counters,
+            "spans": spans,
+        }
+        _write_atomic(path, json.dumps(trace, indent=4))
+
+    def export_prometheus(self, path):
+        '''
+        Textfile in the Prometheus exposition format (node_exporter textfile collector).
+        '''
+        lines = [f"# TYPE {METRIC_PREFIX}_span_seconds summary"]
+        for row in self.summary():
+            labels = _format_labels({"span": row["span"], **row["labels"]})
+            lines.append(f"{METRIC_PREFIX}_span_seconds_sum{labels} {row['total_s']:.6f}")
+            lines.append(f"{METRIC_PREFIX}_span_seconds_count{labels} {row['count']}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            lines.append(f"{metric}{_format_labels(dict(labels))} {value}")
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+    def export(self, trace_file=None, metrics_file=None):
+        if trace_file:
+            self.export_json(trace_file)
+            print(f"Trace saved in: {trace_file}")
+        if metrics_file:
+            self.export_prometheus(metrics_file)
+            print(f"Metrics saved in: {metrics_file}")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in sorted(labels.items())]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _write_atomic(path, text):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Shared by all the modules of a run
+TRACER = Tracer()
+
+
+class PhaseTimer:
+    '''
+    Streamer for model.generate() that splits a generation into prefill (prompt up to
+    the first new token) and decode (the remaining tokens).
+    '''
+
+    def __init__(self, tracer=TRACER, **labels):
+        self.tracer = tracer
+        self.labels = labels
+        self.start = None
+        self.first_token = None
+
+    def put(self, value):
+        now = time.perf_counter()
+        if value.dim() > 1 and self.start is None:
+            self.start = now          # The prompt is sent first
+        elif self.first_token is None and self.start is not None:
+            self.first_token = now
+            self.tracer.record("prefill", now - self.start, **self.labels)
+
+    def end(self):
+        if self.first_token is not None:
+            self.tracer.record("decode", time.perf_counter() - self.first_token, **self.labels)
+        self.start = None
+        self.first_token = None
+
+
+def generation_output(text, prompt_tokens=None, generated_tokens=None):
+    '''
+    Output item of a pipeline call ({"generated_text": ...}), with the token counts of
+    the call when the layer running the model knows them (read by InstrumentedPipe).
+    '''
+    output = {"generated_text": text}
+    if prompt_tokens is not None:
+        output["prompt_tokens"] = prompt_tokens
+    if generated_tokens is not None:
+        output["generated_tokens"] = generated_tokens
+    return output
+
+
+class InstrumentedPipe:
+    '''
+    Pipeline wrapper recording, per LLM call, the generation time plus the prompt and
+    generated tokens, labelled with the agent (found from the system prompt via `agents`).
+    The token counts come from the outputs (generation_output); a layer that does not
+    report them (e.g. the transformers pipeline) gets a cheap estimate, counted as
+    prompt_tokens_estimated / generated_tokens_estimated instead.
+    '''
+
+    def __init__(self, pipe, tracer=TRACER, agents=None):
+        self.pipe = pipe
+        self.tracer = tracer
+        self.agents = agents or {}
+
+    def _agent(self, messages):
+        if messages and messages[0].get("role") == "system":
+            return self.agents.get(messages[0]["content"], "default")
+        return "default"
+
+    def _count_tokens(self, name, reported, estimate, agent):
+        if reported is not None:
+            self.tracer.count(name, reported, agent=agent)
+        else:
+            self.tracer.count(f"{name}_estimated", estimate(), agent=agent)
+
+    def __call__(self, inputs, **gen_kwargs):
+        if not self.tracer.enabled:
+            return self.pipe(inputs, **gen_kwargs)
+
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+        agents = [self._agent(messages) for messages in conversations]
+        for agent in agents:
+            self.tracer.count("llm_calls", agent=agent)
+
+        # A batch is timed once, under its agent ("mixed" when it spans several agents)
+        with self.tracer.span("generate", agent=agents[0] if len(set(agents)) == 1 else "mixed"):
+            outputs = self.pipe(inputs, **gen_kwargs)
+
+        from Backends import approx_tokens
+        items = [outputs[0]] if single else [output[0] for output in outputs]
+        for messages, item, agent in zip(conversations, items, agents):
+            self._count_tokens("prompt_tokens", item.get("prompt_tokens"),
+                               lambda: sum(approx_tokens(m["content"]) for m in messages), agent)
+            self._count_tokens("generated_tokens", item.get("generated_tokens"),
+                               lambda: approx_tokens(item["generated_text"]), agent)
+        return outputs
@@ -0,0 +1,70 @@
+## Parsing of the JSON answers of the agents, without any model dependency: the scripts,
+## the daemon and the http/llama.cpp/fake backends import it without torch or transformers.
+## JsonObjectTracker also drives the early stopping of Json_stopping.py.
+
+import json
+
+
+class JsonObjectTracker:
+    '''
+    Incremental brace/string state machine. Text before the first '{' is ignored;
+    `end` is the index (in the text fed so far) right after the closing brace.
+    '''
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.pos = 0
+        self.start = -1
+        self.end = -1
+
+    @property
+    def done(self):
+        return self.end != -1
+
+    def feed(self, text):
+        for ch in text:
+            self.pos += 1
+            if self.done:
+                continue
+            if not self.started:
+                if ch == '{':
+                    self.started = True
+                    self.start = self.pos - 1
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == '{':
+                self.depth += 1
+            elif ch == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.pos
+        return self.done
+
+
+def parse_first_json_object(text):
+    '''
+    Parses the first complete top-level JSON object in a text (None if there is none).
+    '''
+    if not text:
+        return None
+    tracker = JsonObjectTracker()
+    tracker.feed(text)
+    if not tracker.done:
+        return None
+    try:
+        return json.loads(text[tracker.start:tracker.end])
+    except json.JSONDecodeError:
+        return None
@@ -0,0 +1,53 @@
+## Early stopping for the JSON answers of the agents.
+## Generation ends as soon as the top-level JSON object is closed, instead of running
+## on into explanations or a second code block that the parsers throw away anyway.
+## The parser itself lives in Json_parsing.py (no torch needed).
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from Json_parsing import JsonObjectTracker, parse_first_json_object
+
+
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    '''
+    Stops each sequence of a (padded) batch once its top-level JSON object is complete.
+    The same instance can be reused across generate() calls: a new call is detected
+    when the prompt part of `input_ids` changes.
+    '''
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.prompt = None
+        self.last_len = 0
+        self.trackers = []
+
+    def _start(self, input_ids):
+        # First call of a generation: one token has been generated so far
+        start = input_ids.shape[1] - 1
+        self.prompt = input_ids[:, :start].clone()
+        self.last_len = start
+        self.trackers = [JsonObjectTracker() for _ in range(input_ids.shape[0])]
+
+    def _same_generation(self, input_ids):
+        if self.prompt is None or input_ids.shape[0] != self.prompt.shape[0]:
+            return False
+        if input_ids.shape[1] <= self.last_len:
+            return False
+        return torch.equal(input_ids[:, :self.prompt.shape[1]], self.prompt)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if not self._same_generation(input_ids):
+            self._start(input_ids)
+
+        new_tokens = input_ids[:, self.last_len:]
+        for row, tracker in enumerate(self.trackers):
+            if not tracker.done:
+                tracker.feed(self.tokenizer.decode(new_tokens[row], skip_special_tokens=True))
+        self.last_len = input_ids.shape[1]
+
+        return torch.tensor([t.done for t in self.trackers], dtype=torch.bool, device=input_ids.device)
+
+
+def json_stopping_criteria(tokenizer):
+    return StoppingCriteriaList([JsonObjectStoppingCriteria(tokenizer)])
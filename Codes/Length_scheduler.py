@@ -0,0 +1,146 @@
+## Length-bucketed scheduling of batched calls.
+## The requirements range from one short clause to long paragraphs, and the system prompts
+## of the strategies and agents differ in length too: in a padded batch every prompt is
+## padded to the longest one. The conversations of a call are sorted into token-length
+## buckets and cut into batches under a token budget (padded prompt tokens), instead of a
+## fixed count in arrival order; the outputs are put back in the order of the call.
+## The padding efficiency (real / padded prompt tokens) is reported next to the one of the
+## arrival-order batches, to tune BUCKET_BOUNDARIES and the budget.
+## The scripts call the pipe on chunks of requirements (resumable writes), so they also sort
+## the whole pending set by length first (sort_by_length): the buckets of a call are then
+## filled with requirements of similar length instead of the few of one arrival-order chunk.
+
+import threading
+
+# Upper bounds (prompt tokens) of the buckets; longer prompts go in a last bucket
+BUCKET_BOUNDARIES = [256, 512, 1024, 2048, 4096]
+
+
+def bucket_of(length, boundaries=BUCKET_BOUNDARIES):
+    for index, bound in enumerate(boundaries):
+        if length <= bound:
+            return index
+    return len(boundaries)
+
+
+def plan_batches(lengths, token_budget, max_batch=None, boundaries=BUCKET_BOUNDARIES):
+    '''
+    Splits the indexes of `lengths` into batches: sorted by (bucket, length), a batch
+    never crosses a bucket and its padded size (count x longest) stays within
+    `token_budget` (a prompt longer than the budget gets a batch of its own).
+    '''
+    order = sorted(range(len(lengths)), key=lambda i: (bucket_of(lengths[i], boundaries), lengths[i]))
+    batches = []
+    batch, batch_bucket = [], None
+    for index in order:
+        bucket = bucket_of(lengths[index], boundaries)
+        # Sorted ascending: the new prompt is the longest of the batch
+        fits = (len(batch) + 1) * lengths[index] <= token_budget
+        if batch and (bucket != batch_bucket or not fits or (max_batch and len(batch) >= max_batch)):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+        batch_bucket = bucket
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padded_tokens(lengths, batches):
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches if batch)
+
+
+class PaddingStats:
+
+    def __init__(self, boundaries=BUCKET_BOUNDARIES):
+        self.boundaries = boundaries
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.batches = 0
+        self.conversations = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.unbucketed_padded_tokens = 0
+        self.bucket_sizes = [0] * (len(boundaries) + 1)
+
+    def add(self, lengths, batches, unbucketed_batches):
+        with self.lock:
+            self.calls += 1
+            self.batches += len(batches)
+            self.conversations += len(lengths)
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += padded_tokens(lengths, batches)
+            self.unbucketed_padded_tokens += padded_tokens(lengths, unbucketed_batches)
+            for length in lengths:
+                self.bucket_sizes[bucket_of(length, self.boundaries)] += 1
+
+    def as_dict(self):
+        labels = [f"<={bound}" for bound in self.boundaries] + [f">{self.boundaries[-1]}"]
+        return {
+            "calls": self.calls,
+            "batches": self.batches,
+            "conversations": self.conversations,
+            "padding_efficiency": self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0,
+            "unbucketed_efficiency": (self.real_tokens / self.unbucketed_padded_tokens
+                                      if self.unbucketed_padded_tokens else 1.0),
+            "padded_tokens": self.padded_tokens,
+            "unbucketed_padded_tokens": self.unbucketed_padded_tokens,
+            "bucket_sizes": dict(zip(labels, self.bucket_sizes)),
+        }
+
+
+def length_scheduler(pipe):
+    '''
+    The LengthBucketedPipe of a pipeline stack (None without length buckets).
+    '''
+    while pipe is not None and not isinstance(pipe, LengthBucketedPipe):
+        pipe = getattr(pipe, "pipe", None)
+    return pipe
+
+
+def sort_by_length(entries, pipe):
+    '''
+    The requirements sorted by the prompt tokens of their text (stable), when the stack of
+    `pipe` has length buckets; otherwise unchanged. compact_jsonl restores the id order.
+    '''
+    scheduler = length_scheduler(pipe)
+    if scheduler is None:
+        return entries
+    return sorted(entries, key=lambda entry: scheduler.length([{"role": "user", "content": entry.get("Text", "")}]))
+
+
+class LengthBucketedPipe:
+    '''
+    Pipeline wrapper that runs the conversations of a call in length-bucketed batches
+    under `token_budget` padded prompt tokens (and at most `max_batch` conversations),
+    returning the outputs in the order of the call. `length` gives the prompt tokens of
+    a conversation. Single conversations go straight through.
+    '''
+
+    def __init__(self, pipe, length, token_budget=16384, max_batch=None, boundaries=BUCKET_BOUNDARIES):
+        self.pipe = pipe
+        self.length = length
+        self.token_budget = token_budget
+        self.max_batch = max_batch
+        self.boundaries = boundaries
+        self.stats = PaddingStats(boundaries)
+
+    def __call__(self, inputs, **gen_kwargs):
+        if not inputs or isinstance(inputs[0], dict):
+            return self.pipe(inputs, **gen_kwargs)
+
+        conversations = list(inputs)
+        # The fixed-count batches the call would have used, for the report
+        count = gen_kwargs.pop("batch_size", None) or self.max_batch or len(conversations)
+        lengths = [self.length(messages) for messages in conversations]
+        batches = plan_batches(lengths, self.token_budget, self.max_batch, self.boundaries)
+        unbucketed = [list(range(start, min(start + count, len(conversations))))
+                      for start in range(0, len(conversations), count)]
+        self.stats.add(lengths, batches, unbucketed)
+
+        results = [None] * len(conversations)
+        for batch in batches:
+            outputs = self.pipe([conversations[i] for i in batch], batch_size=len(batch), **gen_kwargs)
+            for index, output in zip(batch, outputs):
+                results[index] = output
+        return results
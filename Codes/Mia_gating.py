@@ -0,0 +1,299 @@
+## Pre-pass gating of the MIA agents (Multi_agent_8.py).
+## Trigger, Precondition and Purpose are empty for many requirements, but MIA always
+## pays for all 8 calls. A cheap lexical gate predicts, from the requirement text alone,
+## when one of these fields is almost certainly empty: its agent is skipped and the
+## field is set to [] directly.
+## The gate of a field is a set of cues (hand-written regexes plus words learned from
+## labelled requirements): the agent runs when any cue is present. Cues are added until
+## the gate keeps `recall` of the non-empty fields of the training set; a field is only
+## gated when the lower confidence bound (Wilson, one-sided, CONFIDENCE_Z) of its
+## cross-validated recall reaches `min_recall` (recall safeguard).
+##
+## The gates train on all the labelled requirements the repo ships (one record per text),
+## and are cross-fitted: a requirement of the training pool is gated by the gate of its
+## fold, which never saw its labels. So no requirement is gated with its own labels (the
+## "mia_gated" F1 stays honest), and the recall of a run on the pool is exactly the
+## cross-validated recall the safeguard checks. Requirements outside the pool get the gate
+## trained on the whole pool. Dataset_50 alone (50 records) is too small for the bound
+## to reach the minimum.
+##
+## Usage (from the repository root):
+##   python Codes/Mia_gating.py --eval Datasets/Dataset_250/requirements.json --recall 0.98
+
+import argparse
+import json
+import math
+import os
+import re
+import threading
+
+GATED_FIELDS = ["Trigger", "Precondition", "Purpose"]
+LABELLED_DATASETS = [
+    'Datasets/Dataset_250/requirements.json',
+    'Datasets/Dataset_50/cleaned_requirements_final.json',
+]
+RECALL = 0.98
+MIN_RECALL = 0.90
+FOLDS = 5
+CONFIDENCE_Z = 1.645 # One-sided 95% bound of the held-out recall
+MIN_SUPPORT = 3      # Non-empty fields a learned cue must cover (rarer words do not generalize)
+LONG_TEXT_WORDS = [15, 25, 40]
+
+# Hand-written cues (always part of the gate of their field)
+SEED_CUES = {
+    "Trigger": [r"\b(when|whenever|once|upon|after|as soon as|each time|every|if|in case|then)\b",
+                r"\b(as long as|until|while|during|within|press|presses|click|clicking|select)\b"],
+    "Precondition": [r"\b(if|only|unless|provided|given|before|after|prior|already|logged|while|as long as|when)\b",
+                     r"\d"],
+    "Purpose": [r"\bto [a-z]+", r"\b(so that|in order|allow|allows|allowing|enable|enables|ensure|ensures|such that)\b"],
+}
+
+WORD_RE = re.compile(r"[a-z]+")
+
+
+def training_files_for(input_file=None):
+    '''
+    The labelled datasets the gates of a run over `input_file` train on: LABELLED_DATASETS,
+    plus `input_file` itself when it is another labelled dataset (cross-fitted as well).
+    '''
+    paths = list(LABELLED_DATASETS)
+    if input_file is not None and os.path.abspath(input_file) not in map(os.path.abspath, paths):
+        paths.append(input_file)
+    return paths
+
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+def load_labelled(paths, fields=GATED_FIELDS):
+    '''
+    The labelled records of the files, one per requirement text (the first file wins).
+    Records without a label for every one of `fields` (unlabelled inputs) are skipped.
+    '''
+    records, seen = [], set()
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for record in json.load(f):
+                key = normalize_text(record.get("Text", ""))
+                if key in seen or not all(field in record for field in fields):
+                    continue
+                seen.add(key)
+                records.append(record)
+    return records
+
+
+def features(text, field):
+    '''
+    Cues present in a requirement: the seed cues of the field fired, its words, whether
+    it has a number and whether it is longer than each of LONG_TEXT_WORDS.
+    '''
+    lowered = text.lower()
+    words = WORD_RE.findall(lowered)
+    found = {f"seed:{i}" for i, pattern in enumerate(SEED_CUES.get(field, []))
+             if re.search(pattern, lowered)}
+    found |= {f"words>{n}" for n in LONG_TEXT_WORDS if len(words) > n}
+    if any(char.isdigit() for char in lowered):
+        found.add("number")
+    return found | set(words)
+
+
+class FieldGate:
+    '''
+    Runs the agent of a field when the requirement contains one of `cues`.
+    '''
+
+    def __init__(self, field, cues=None):
+        self.field = field
+        self.cues = set(cues) if cues is not None else {f"seed:{i}" for i in range(len(SEED_CUES.get(field, [])))}
+
+    def fit(self, records, recall=RECALL):
+        '''
+        Greedily adds the words that cover the most non-empty fields per empty field
+        they would fire on, until the training recall reaches `recall`.
+        '''
+        rows = [(features(r.get("Text", ""), self.field), bool(r.get(self.field))) for r in records]
+        positives = [f for f, label in rows if label]
+        negatives = [f for f, label in rows if not label]
+        if not positives:
+            return self
+
+        covered = [bool(f & self.cues) for f in positives]
+        fired = [bool(f & self.cues) for f in negatives]
+        while sum(covered) < recall * len(positives):
+            gains = {}
+            for f, done in zip(positives, covered):
+                if not done:
+                    for cue in f - self.cues:
+                        gains.setdefault(cue, [0, 0])[0] += 1
+            gains = {cue: gain for cue, gain in gains.items() if gain[0] >= MIN_SUPPORT}
+            if not gains:
+                break
+            for f, done in zip(negatives, fired):
+                if not done:
+                    for cue in f & gains.keys():
+                        gains[cue][1] += 1
+            cue = max(sorted(gains), key=lambda c: (gains[c][0] / (1 + gains[c][1]), gains[c][0]))
+            self.cues.add(cue)
+            covered = [done or cue in f for f, done in zip(positives, covered)]
+            fired = [done or cue in f for f, done in zip(negatives, fired)]
+        return self
+
+    def needed(self, text):
+        return bool(features(text, self.field) & self.cues)
+
+    def evaluate(self, records):
+        '''
+        Recall on the non-empty fields and share of calls skipped.
+        '''
+        positives = [r for r in records if r.get(self.field)]
+        kept = sum(1 for r in positives if self.needed(r.get("Text", "")))
+        skipped = sum(1 for r in records if not self.needed(r.get("Text", "")))
+        return {"recall": kept / len(positives) if positives else 1.0,
+                "skip_rate": skipped / len(records) if records else 0.0}
+
+
+def recall_lower_bound(kept, positives, z=CONFIDENCE_Z):
+    '''
+    Wilson score lower bound of a recall of kept / positives.
+    '''
+    if not positives:
+        return 0.0
+    p = kept / positives
+    denominator = 1 + z * z / positives
+    center = p + z * z / (2 * positives)
+    margin = z * math.sqrt(p * (1 - p) / positives + z * z / (4 * positives * positives))
+    return (center - margin) / denominator
+
+
+def fit_folds(records, field, recall=RECALL, folds=FOLDS):
+    '''
+    One gate per fold (record i is in fold i % folds), trained on the other folds.
+    '''
+    return [FieldGate(field).fit([r for i, r in enumerate(records) if i % folds != k], recall)
+            for k in range(folds)]
+
+
+def cross_validate(records, field, recall=RECALL, folds=FOLDS, gates=None):
+    '''
+    Recall (with its lower confidence bound) and skip rate of the gate of a field on
+    held-out folds (`gates`: the fold gates, if already fitted).
+    '''
+    gates = gates or fit_folds(records, field, recall, folds)
+    kept = positives = skipped = 0
+    for k, gate in enumerate(gates):
+        test = [r for i, r in enumerate(records) if i % len(gates) == k]
+        for r in test:
+            needed = gate.needed(r.get("Text", ""))
+            skipped += not needed
+            if r.get(field):
+                positives += 1
+                kept += needed
+    return {"recall": kept / positives if positives else 1.0,
+            "recall_lower": recall_lower_bound(kept, positives),
+            "positives": positives,
+            "skip_rate": skipped / len(records) if records else 0.0}
+
+
+class MiaGate:
+    '''
+    The gates of the MIA fields, with the count of the agent calls skipped.
+    A requirement of the training pool (`fold_of`: normalized text -> fold) is gated by
+    the gate of its fold (`fold_gates`), the others by the gate trained on the whole pool.
+    '''
+
+    def __init__(self, gates=None, fold_gates=None, fold_of=None, held_out=None):
+        self.gates = gates or {}
+        self.fold_gates = fold_gates or {}
+        self.fold_of = fold_of or {}
+        self.held_out = held_out or {}  # field -> cross-validated recall and skip rate
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.skipped = {field: 0 for field in self.gates}
+
+    @classmethod
+    def train(cls, records, fields=GATED_FIELDS, recall=RECALL, min_recall=MIN_RECALL, folds=FOLDS,
+              z=CONFIDENCE_Z):
+        gates, fold_gates, held_out = {}, {}, {}
+        for field in fields:
+            field_folds = fit_folds(records, field, recall, folds)
+            result = cross_validate(records, field, recall, folds, field_folds)
+            lower = recall_lower_bound(round(result["recall"] * result["positives"]), result["positives"], z)
+            if lower < min_recall:
+                print(f"Gating of {field} disabled: held-out recall {result['recall']:.2f} "
+                      f"(lower bound {lower:.2f} over {result['positives']} "
+                      f"non-empty fields) < {min_recall:.2f}")
+                continue
+            gates[field] = FieldGate(field).fit(records, recall)
+            fold_gates[field] = field_folds
+            held_out[field] = {**result, "recall_lower": lower}
+        fold_of = {normalize_text(r.get("Text", "")): i % folds for i, r in enumerate(records)}
+        return cls(gates, fold_gates, fold_of, held_out)
+
+    @classmethod
+    def from_files(cls, paths=LABELLED_DATASETS, **options):
+        return cls.train(load_labelled(paths), **options)
+
+    def gate_for(self, field, text):
+        fold = self.fold_of.get(normalize_text(text))
+        return self.gates[field] if fold is None else self.fold_gates[field][fold]
+
+    def fields_to_run(self, text, fields):
+        '''
+        The fields whose agent has to be called for a requirement.
+        '''
+        to_run = [field for field in fields
+                  if field not in self.gates or self.gate_for(field, text).needed(text)]
+        with self.lock:
+            self.calls += len(fields)
+            for field in fields:
+                if field not in to_run:
+                    self.skipped[field] += 1
+        return to_run
+
+    def stats(self):
+        saved = sum(self.skipped.values())
+        return {
+            "calls": self.calls,
+            "calls_saved": saved,
+            "saved_rate": saved / self.calls if self.calls else 0.0,
+            "saved_per_field": dict(self.skipped),
+            "held_out": dict(self.held_out),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and check the MIA gates.")
+    parser.add_argument("--train", nargs="+", default=LABELLED_DATASETS)
+    parser.add_argument("--eval", help="Labelled dataset to run the (cross-fitted) gates on")
+    parser.add_argument("--recall", type=float, default=RECALL)
+    parser.add_argument("--min-recall", type=float, default=MIN_RECALL)
+    parser.add_argument("--folds", type=int, default=FOLDS)
+    parser.add_argument("--z", type=float, default=CONFIDENCE_Z, help="Confidence of the recall bound")
+    args = parser.parse_args()
+
+    records = load_labelled(args.train)
+    print(f"{len(records)} labelled requirements")
+    print(f"{'field':<14} {'cv recall':>10} {'lower':>6} {'cv skipped':>11} {'cues':>5}")
+    for field in GATED_FIELDS:
+        held_out = cross_validate(records, field, args.recall, args.folds)
+        lower = recall_lower_bound(round(held_out["recall"] * held_out["positives"]), held_out["positives"], args.z)
+        gate = FieldGate(field).fit(records, args.recall)
+        print(f"{field:<14} {held_out['recall']:>10.2f} {lower:>6.2f} "
+              f"{held_out['skip_rate']:>11.1%} {len(gate.cues):>5}")
+
+    if args.eval:
+        with open(args.eval, 'r', encoding='utf-8') as f:
+            eval_records = json.load(f)
+        gate = MiaGate.train(records, recall=args.recall, min_recall=args.min_recall, folds=args.folds, z=args.z)
+        for field in gate.gates:
+            positives = [r for r in eval_records if r.get(field)]
+            kept = sum(1 for r in positives if field in gate.fields_to_run(r.get("Text", ""), [field]))
+            print(f"[{args.eval}] {field}: recall {kept / max(1, len(positives)):.2f}")
+        for r in eval_records:
+            gate.fields_to_run(r.get("Text", ""), GATED_FIELDS)
+        print(f"[{args.eval}] {gate.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,78 @@
-import torch
 import json
 import re
+from functools import partial
 from tqdm import tqdm
 import time
 
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    pipeline
-)
-
-from huggingface_hub import login
 from Multi_agent_3prompt import AGENT_ENTITY_PROMPT, AGENT_ACTION_PROMPT, AGENT_LOGIC_PROMPT
+from Backends import load_backend, build_pipeline_stack, pipeline_stats
+from Async_runner import AsyncRequirementRunner, make_runner_pipe
+from Results_writer import JsonlResultWriter, RunFingerprint, load_done_ids, compact_jsonl, read_run_records
+from Json_parsing import parse_first_json_object
+from Instrumentation import TRACER
+from Length_scheduler import sort_by_length
+from Span_dedup import dedup_spans
 
 HF_TOKEN = '< YOUR TOKEN >'
 
 MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 INPUT_FILE = 'Datasets/Dataset_250/requirements.json'
-OUTPUT_FILE = 'multi_agent_predictions.json'
-login(token=HF_TOKEN)
+OUTPUT_FILE = 'multi_agent_predictions_3.json' # Name read by Evaluation.ipynb / Evaluation_engine.py
+STREAM_FILE = 'multi_agent_predictions_3.jsonl' # Appended as requirements finish (resumable)
+FLUSH_EVERY = 8
+REQS_PER_WAVE = 8        # Requirements whose stage calls are batched together
+EXECUTION_MODE = "waves" # or "async" (MAX_IN_FLIGHT requirements at once)
+MAX_IN_FLIGHT = 16
+STAGE_LIMITS = {}        # Max concurrent calls per agent, e.g. {"action": 4}
+RATE_LIMIT = None        # Max model calls per second (None = unlimited)
+USE_PREFIX_CACHE = False # Reuse the agent-prompt KV-cache (decodes one request at a time)
+USE_PROMPT_LOOKUP = False # Speculative decoding with drafts copied from the prompt (greedy-exact)
+USE_COMPILED_TEMPLATES = False # Build the prompts from pre-tokenized system prompts (transformers/cpu)
+TOKEN_BUDGET = None        # Padded prompt tokens per batch, length-bucketed (None = fixed-count batches)
+USE_INFERENCE_CACHE = True # Answer unchanged calls from the on-disk cache
+NEAR_DUP_THRESHOLD = None  # Reuse the records of near-duplicate requirements (Near_duplicates.py, None = off)
+BACKEND = "transformers"   # or "cpu" (int8, no GPU), "gguf" (llama.cpp), "http" (OpenAI-compatible server), "daemon"
+SERVER_URL = "http://localhost:8000/v1"
+HTTP_CONCURRENCY = 32      # Requests in flight with the http backend
+CPU_THREADS = None         # Threads of the cpu/gguf backends (None = all cores)
+CPU_BATCH_SIZE = 4         # Conversations decoded together by the cpu backend
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+TRACE = False              # Per-agent timings, tokens and parse failures (Instrumentation.py)
+TRACE_FILE = 'multi_agent_trace_3.json'
+METRICS_FILE = 'multi_agent_metrics_3.prom'  # Prometheus textfile
 
 def load_model():
     '''
-    Load the LLaMA 3 model in 4-bit quantization.
+    Load the inference backend (LLaMA 3 in 4-bit on GPU, int8 or GGUF on CPU, or an
+    OpenAI-compatible server) and wrap it with the enabled caches.
     '''
-    print(f"Loading {MODEL_ID} in 4-bit...")
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, token=HF_TOKEN)
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        quantization_config=bnb_config,
-        device_map="auto",
-        token=HF_TOKEN)
-
-    return pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        max_new_tokens=1024,
-        do_sample=False,
-        return_full_text=False)
+    backend = load_backend(BACKEND, model_id=MODEL_ID, hf_token=HF_TOKEN, max_new_tokens=1024,
+                           base_url=SERVER_URL, max_concurrency=HTTP_CONCURRENCY,
+                           threads=CPU_THREADS, batch_size=CPU_BATCH_SIZE, model_path=GGUF_PATH)
+
+    wrap = None
+    if EXECUTION_MODE == "async":
+        # Calls are assigned to their agent by the system prompt
+        stages = {agent["prompt"]: name for name, agent in SCAP_AGENTS.items()}
+        wrap = partial(make_runner_pipe, coalesce=(BACKEND not in ("http", "daemon")),
+                       max_batch=REQS_PER_WAVE * 2, stages=stages,
+                       stage_limits=STAGE_LIMITS, rate=RATE_LIMIT)
+
+    return build_pipeline_stack(backend, "Multi_agent_3prompt", max_new_tokens=1024,
+                                prefix_cache=USE_PREFIX_CACHE,
+                                prompt_lookup=USE_PROMPT_LOOKUP,
+                                compiled_templates=USE_COMPILED_TEMPLATES,
+                                token_budget=TOKEN_BUDGET,
+                                inference_cache=USE_INFERENCE_CACHE,
+                                wrap=wrap,
+                                agents={agent["prompt"]: name for name, agent in SCAP_AGENTS.items()} if TRACE else None)
 
 def query_llm(pipe, messages):
     """Sends messages to the LLM pipeline and returns the output text."""
     output = pipe(messages)
     return output[0]['generated_text'].strip()
 
-def extract_clean_json(text_output):
+def extract_clean_json(text_output, agent="default"):
     """
     Extracts and parses the first valid JSON object found in a text string.
     Handles Markdown blocks, introductory text, and parsing errors.
@@ -63,6 +81,11 @@ def extract_clean_json(text_output):
         if not text_output:
             return {}
 
+        # 0. Generation stops at the closing brace: try the first complete object
+        data = parse_first_json_object(text_output)
+        if isinstance(data, dict):
+            return data
+
         # 1. Find the index of the first opening brace '{'
         start_idx = text_output.find('{')
 
@@ -71,6 +94,7 @@ def extract_clean_json(text_output):
 
         # If braces are not found, return empty dict
         if start_idx == -1 or end_idx == -1:
+            TRACER.count("parse_failures", agent=agent)
             return {}
 
         # 3. Extract only the substring containing the JSON
@@ -85,128 +109,230 @@ def extract_clean_json(text_output):
         print(f"JSON Decoding Error: {e}")
         # Print part of the text to understand what went wrong
         print(f"   Problematic text: {text_output[:100]}...")
+        TRACER.count("parse_failures", agent=agent)
         return {}
 
     except Exception as e:
         print(f"Unexpected Error: {e}")
+        TRACER.count("parse_failures", agent=agent)
         return {}
     
-# --- SMART FILTER (Deduplication + Atomic Protection) ---
-def smart_filter(string_list):
-    """
-    Removes redundant substrings but PROTECTS atomic values.
-    Rule: Delete string A if it is inside string B, UNLESS A contains a digit
-    and is short (e.g., '99%' or '10x10'), in which case keep it.
-    """
-    if not string_list: return []
-
-    # Sort by length (descending) to check longest phrases first
-    unique = sorted(list(set(string_list)), key=len, reverse=True)
-    final = []
+# --- SCAP STAGE GRAPH ---
+# Each agent declares the agents whose output it needs as context.
+# Agents without pending inputs run in the same wave.
 
-    for candidate in unique:
-        is_substring = False
-        for other in unique:
-            if candidate != other and candidate in other:
-                is_substring = True
-                break
+# Settings for deterministic output (Temp 0)
+GEN_CONFIG = {"max_new_tokens": 500, "do_sample": False}
 
-        # If it's unique, keep it. If it's a substring, check for "Atomic Protection"
-        if not is_substring:
-            final.append(candidate)
-
-    return final
-
-def process_requirements(req, id, pipe):
-    """
-    Runs the 3-Agent Pipeline: Entity -> Action -> Logic.
-    Applies Mirror Rule, Hierarchy Rule, and Smart Filtering.
-    """
+def entity_user_message(req, deps):
+    return f"Input: \"{req}\""
 
-    # Settings for deterministic output (Temp 0)
-    gen_config = {"max_new_tokens": 500, "do_sample": False}
+def action_user_message(req, deps):
+    res_entity = deps["entity"]
+    context = f"Actors: {res_entity.get('Main_actor')}, Entities: {res_entity.get('Entity')}"
+    return f"Input Req: \"{req}\"\nContext: {context}"
 
+def logic_user_message(req, deps):
+    return f"Input: \"{req}\""
 
+SCAP_AGENTS = {
     # A. ENTITY AGENT
-    msg1 = [{"role": "system", "content": AGENT_ENTITY_PROMPT},
-            {"role": "user", "content": f"Input: \"{req}\""}]
-    raw1 = pipe(msg1, **gen_config)[0]['generated_text']
-    res_entity = extract_clean_json(raw1) or {"Main_actor": [], "Entity": []}
-
+    "entity": {"prompt": AGENT_ENTITY_PROMPT, "inputs": [],
+               "user_message": entity_user_message,
+               "default": {"Main_actor": [], "Entity": []}},
     # B. ACTION AGENT (Context Injection)
-    context = f"Actors: {res_entity.get('Main_actor')}, Entities: {res_entity.get('Entity')}"
-    msg2 = [{"role": "system", "content": AGENT_ACTION_PROMPT},
-            {"role": "user", "content": f"Input Req: \"{req}\"\nContext: {context}"}]
-    raw2 = pipe(msg2, **gen_config)[0]['generated_text']
-    res_action = extract_clean_json(raw2) or {"Action": [], "System_response": [], "Purpose": []}
-
-    # C. LOGIC AGENT (Contrastive)
-    msg3 = [{"role": "system", "content": AGENT_LOGIC_PROMPT},
-            {"role": "user", "content": f"Input: \"{req}\""}]
-    raw3 = pipe(msg3, **gen_config)[0]['generated_text']
-    res_logic = extract_clean_json(raw3) or {"Trigger": [], "Precondition": [], "Condition": []}
-
-
-
+    "action": {"prompt": AGENT_ACTION_PROMPT, "inputs": ["entity"],
+               "user_message": action_user_message,
+               "default": {"Action": [], "System_response": [], "Purpose": []}},
+    # C. LOGIC AGENT (Contrastive, needs only the raw requirement)
+    "logic":  {"prompt": AGENT_LOGIC_PROMPT, "inputs": [],
+               "user_message": logic_user_message,
+               "default": {"Trigger": [], "Precondition": [], "Condition": []}},
+}
+
+def schedule_waves(agents):
+    """
+    Groups the agents into waves (topological levels of the dependency graph).
+    Every agent of a wave only depends on agents of earlier waves.
+    """
+    done = set()
+    waves = []
+    while len(done) < len(agents):
+        wave = [name for name, agent in agents.items()
+                if name not in done and all(dep in done for dep in agent["inputs"])]
+        if not wave:
+            raise ValueError(f"Cyclic or missing agent inputs: {sorted(set(agents) - done)}")
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+def merge_agent_outputs(req, id, res_entity, res_action, res_logic):
+    """
+    Combines the agent outputs into the final entry.
+    Applies Mirror Rule, Hierarchy Rule, and span deduplication (Span_dedup.py).
+    """
     all_entities = set(res_entity.get("Entity", [])) | set(res_entity.get("Main_actor", []))
     all_conditions = set(res_logic.get("Condition", [])) | set(res_logic.get("Trigger", [])) | set(res_logic.get("Precondition", []))
 
-    # Apply Smart Filter (Clean text, protect numbers)
+    # Drop contained spans, protect short numeric values
     final_entry = {
         "id": id,
         "Text": req,
         # Entity Section
-        "Main_actor": smart_filter(res_entity.get("Main_actor", [])),
-        "Entity":     smart_filter(list(all_entities)),
+        "Main_actor": dedup_spans(res_entity.get("Main_actor", [])),
+        "Entity":     dedup_spans(list(all_entities)),
         # Action Section
-        "Action":          smart_filter(res_action.get("Action", [])),
-        "System_response": smart_filter(res_action.get("System_response", [])),
-        "Purpose":         smart_filter(res_action.get("Purpose", [])),
+        "Action":          dedup_spans(res_action.get("Action", [])),
+        "System_response": dedup_spans(res_action.get("System_response", [])),
+        "Purpose":         dedup_spans(res_action.get("Purpose", [])),
         # Logic Section
-        "Trigger":      smart_filter(res_logic.get("Trigger", [])),
-        "Precondition": smart_filter(res_logic.get("Precondition", [])),
-        "Condition":    smart_filter(list(all_conditions))
+        "Trigger":      dedup_spans(res_logic.get("Trigger", [])),
+        "Precondition": dedup_spans(res_logic.get("Precondition", [])),
+        "Condition":    dedup_spans(list(all_conditions))
     }
 
     return final_entry
 
+def run_scap_waves(entries, pipe, agents=SCAP_AGENTS, batch_size=None):
+    """
+    Runs the 3-Agent Pipeline over many requirements, one wave at a time.
+    All the calls of a wave (every ready agent x every requirement) are sent
+    to the pipeline as one padded batch. If a wave fails, its requirements still get
+    the agent defaults but their records carry an "error" key (retried on resume).
+    """
+    outputs = [{} for _ in entries]
+    errors = {}
+
+    for wave in schedule_waves(agents):
+        jobs = []
+        conversations = []
+        for req_idx, entry in enumerate(entries):
+            req = entry.get("Text", "")
+            for name in wave:
+                agent = agents[name]
+                deps = {dep: outputs[req_idx][dep] for dep in agent["inputs"]}
+                jobs.append((req_idx, name))
+                conversations.append([
+                    {"role": "system", "content": agent["prompt"]},
+                    {"role": "user", "content": agent["user_message"](req, deps)}])
+
+        try:
+            raws = pipe(conversations, batch_size=batch_size or len(conversations), **GEN_CONFIG)
+            raws = [raw[0]['generated_text'] for raw in raws]
+        except Exception as e:
+            print(f"Error in wave {wave}: {e}")
+            raws = [""] * len(jobs)
+            for req_idx, _ in jobs:
+                errors.setdefault(req_idx, f"{'/'.join(wave)}: {e}")
+
+        for (req_idx, name), raw in zip(jobs, raws):
+            with TRACER.span("parse", agent=name):
+                parsed = extract_clean_json(raw, agent=name)
+            if not parsed:
+                TRACER.count("empty_fallbacks", agent=name)
+            outputs[req_idx][name] = parsed or dict(agents[name]["default"])
+
+    with TRACER.span("merge", agent="merge"):
+        records = [
+            merge_agent_outputs(entry.get("Text", ""), entry.get("id", "unknown"),
+                                out["entity"], out["action"], out["logic"])
+            for entry, out in zip(entries, outputs)
+        ]
+    for req_idx, error in errors.items():
+        records[req_idx]["error"] = error
+    return records
 
-# Load the model
-try:
-    pipe = load_model()
-except Exception as e:
-    print(f"Error with Model Loading: {e}")
+def process_requirements(req, id, pipe):
+    """
+    Runs the 3-Agent Pipeline (Entity -> Action, Logic) on a single requirement.
+    """
+    return run_scap_waves([{"Text": req, "id": id}], pipe)[0]
+
+def requirement_task(entry, pipe):
+    """
+    Task function of the async runner: one dataset entry -> one output record.
+    """
+    return process_requirements(entry.get("Text", ""), entry.get("id", "unknown"), pipe)
 
-    
-results = []
 
-with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-    dataset = json.load(f)
-    print(f"Processing {len(dataset)} requirements...")
+def main():
+    if TRACE:
+        TRACER.enable(strategy="scap")
+
+    # Load the model
+    try:
+        pipe = load_model()
+    except Exception as e:
+        print(f"Error with Model Loading: {e}")
+        return
+
+    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    # Skip the requirements already written by a previous (interrupted) run of the same
+    # strategy, prompts and requirement text
+    fingerprint = RunFingerprint("scap", "Multi_agent_3prompt")
+    expected = fingerprint.of_entries(dataset)
+    done_ids = load_done_ids(STREAM_FILE, expected)
+    pending = [entry for entry in dataset if entry.get("id", "unknown") not in done_ids]
+    print(f"Processing {len(pending)} requirements ({len(done_ids)} already done)...")
+
+    # Only the novel requirements go to the model, near-duplicates reuse their records
+    reuse = None
+    if NEAR_DUP_THRESHOLD is not None:
+        from Near_duplicates import ExtractionReuse  # numpy, only when turned on
+        reuse = ExtractionReuse(NEAR_DUP_THRESHOLD, read_run_records(STREAM_FILE, fingerprint))
+        pending, duplicates = reuse.split(pending)
+        print(f"Near-duplicates: {len(duplicates)} reused, {len(pending)} sent to the model")
+
+    # With length buckets, the chunks below hold requirements of similar length
+    pending = sort_by_length(pending, pipe)
 
     # --- Start Timer ---
     start_time = time.time()
 
-    # Processing Loop
-    for entry in tqdm(dataset):
-        req_text = entry.get("Text", "")
-        req_id = entry.get("id", "unknown")
-        prediction = process_requirements(req_text, req_id, pipe)
-
-        results.append({
-        **prediction
-        })
+    with JsonlResultWriter(STREAM_FILE, flush_every=FLUSH_EVERY, fingerprint=fingerprint) as stream:
+        writer = reuse.recording(stream) if reuse is not None else stream
+        if EXECUTION_MODE == "async":
+            # Many requirements in flight, records written as they finish
+            runner = AsyncRequirementRunner(partial(requirement_task, pipe=pipe),
+                                            max_in_flight=MAX_IN_FLIGHT)
+            print(f"Async runner: {runner.run_sync(pending, writer)}")
+        else:
+            # Processing Loop (stage waves over groups of requirements)
+            for start in tqdm(range(0, len(pending), REQS_PER_WAVE)):
+                batch = pending[start:start + REQS_PER_WAVE]
+                for prediction in run_scap_waves(batch, pipe):
+                    writer.write({
+                    **prediction
+                    })
+
+        if reuse is not None:
+            reused, waiting = reuse.adapt(duplicates)
+            for _, record in reused:
+                writer.write(record)
+            if waiting:
+                print(f"Near-duplicates left for the next run (no record for their match): {len(waiting)}")
 
     # --- End Timer ---
     end_time = time.time()
     total_duration = end_time - start_time
 
-# Save results to output file
-with open(OUTPUT_FILE, "w", encoding='utf-8') as f:
-    json.dump(results, f, indent=4)
+    # Save results to output file (compacted from the stream)
+    compact_jsonl(STREAM_FILE, OUTPUT_FILE, [entry.get("id", "unknown") for entry in dataset], expected)
+
+    print("-" * 30)
+    print(f"Processing Complete!")
+    print(f"Total Time: {total_duration:.2f} seconds")
+    print(f"File saved in: {OUTPUT_FILE}")
+    for layer, stats in pipeline_stats(pipe).items():
+        print(f"{layer}: {stats}")
+    if reuse is not None:
+        print(f"Near-duplicates: {reuse.stats()}")
+    if TRACE:
+        TRACER.export(TRACE_FILE, METRICS_FILE)
+    print("-" * 30)
+
 
-print("-" * 30)
-print(f"Processing Complete!")
-print(f"Total Time: {total_duration:.2f} seconds")
-print(f"File saved in: {OUTPUT_FILE}")
-print("-" * 30)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,106 @@
-import torch
 import json
 import re
 import os
+from functools import partial
 from tqdm import tqdm
 import time
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    Pipeline,
-    pipeline
-)
-from huggingface_hub import login
 from Multi_agent_8prompt import AGENT_PROMPTS
+from Backends import load_backend, build_pipeline_stack, pipeline_stats
+from Async_runner import AsyncRequirementRunner, make_runner_pipe
+from Results_writer import JsonlResultWriter, RunFingerprint, load_done_ids, compact_jsonl, read_run_records
+from Json_parsing import parse_first_json_object
+from Instrumentation import TRACER
+from Length_scheduler import sort_by_length
+from Span_dedup import dedup_record
+from Mia_gating import MiaGate, training_files_for
 
 
 HF_TOKEN = '< YOUR TOKEN >'
 
 MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 INPUT_FILE = 'Datasets/Dataset_250/requirements.json'
-OUTPUT_FILE = 'multi_agent_predictions1.json'
-login(token=HF_TOKEN)
+OUTPUT_FILE = 'multi_agent_predictions_8.json' # Name read by Evaluation.ipynb / Evaluation_engine.py
+STREAM_FILE = 'multi_agent_predictions_8.jsonl' # Appended as requirements finish (resumable)
+FLUSH_EVERY = 8
+EXECUTION_MODE = "batched" # or "sequential" (one call per agent), "async" (MAX_IN_FLIGHT requirements at once)
+REQS_PER_BATCH = 4         # Requirements fanned out together (x8 agent prompts)
+AGENT_BATCH_SIZE = 16      # Agent prompts decoded together (None = all the prompts of the call)
+MAX_IN_FLIGHT = 16
+STAGE_LIMITS = {}          # Max concurrent calls per agent, e.g. {"Purpose": 4}
+RATE_LIMIT = None          # Max model calls per second (None = unlimited)
+USE_PREFIX_CACHE = False # Reuse the agent-prompt KV-cache (decodes one request at a time)
+USE_PROMPT_LOOKUP = False # Speculative decoding with drafts copied from the prompt (greedy-exact)
+USE_COMPILED_TEMPLATES = False # Build the prompts from pre-tokenized system prompts (transformers/cpu)
+TOKEN_BUDGET = None        # Padded prompt tokens per batch, length-bucketed (None = fixed-count batches)
+USE_GATING = False         # Skip the Trigger/Precondition/Purpose agents when a lexical gate predicts an empty field
+# Labelled requirements the gates learn from (all of them, deduplicated). The gates are
+# cross-fitted: a requirement of these files is gated by a gate that never saw its labels
+GATING_TRAINING_FILES = training_files_for(INPUT_FILE)
+GATING_RECALL = 0.98       # Training recall of the gates
+GATING_MIN_RECALL = 0.90   # Fields whose cross-validated recall (lower bound) is lower are never gated
+GATING_CONFIDENCE_Z = 1.645 # One-sided z of that bound (1.645 = 95%)
+USE_INFERENCE_CACHE = True # Answer unchanged calls from the on-disk cache
+NEAR_DUP_THRESHOLD = None  # Reuse the records of near-duplicate requirements (Near_duplicates.py, None = off)
+BACKEND = "transformers"   # or "cpu" (int8, no GPU), "gguf" (llama.cpp), "http" (OpenAI-compatible server), "daemon"
+SERVER_URL = "http://localhost:8000/v1"
+HTTP_CONCURRENCY = 32      # Requests in flight with the http backend
+CPU_THREADS = None         # Threads of the cpu/gguf backends (None = all cores)
+CPU_BATCH_SIZE = 4         # Conversations decoded together by the cpu backend
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+TRACE = False              # Per-agent timings, tokens and parse failures (Instrumentation.py)
+TRACE_FILE = 'multi_agent_trace_8.json'
+METRICS_FILE = 'multi_agent_metrics_8.prom'  # Prometheus textfile
 
 def load_llama_model():
     '''
-    Load the Llama 3 model with 4-bit quantization for efficient inference.
+    Load the inference backend (Llama 3 in 4-bit on GPU, int8 or GGUF on CPU, or an
+    OpenAI-compatible server) and wrap it with the enabled caches.
     '''
-    print(f"Load the {MODEL_ID} in 4-bit...")
-
-    # 4-bit Quantization
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, token=HF_TOKEN)
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        quantization_config=bnb_config,
-        device_map="auto",
-        token=HF_TOKEN
-    )
-
-    text_pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        max_new_tokens=512,
-        #temperature=0.1,       # Low temperature for precision
-        do_sample=False,       # Deterministic
-        return_full_text=False
-    )
+    backend = load_backend(BACKEND, model_id=MODEL_ID, hf_token=HF_TOKEN, max_new_tokens=512,
+                           base_url=SERVER_URL, max_concurrency=HTTP_CONCURRENCY,
+                           threads=CPU_THREADS, batch_size=CPU_BATCH_SIZE, model_path=GGUF_PATH)
+
+    wrap = None
+    if EXECUTION_MODE == "async":
+        # Calls are assigned to their agent by the system prompt
+        stages = {prompt: field for field, prompt in AGENT_PROMPTS.items()}
+        wrap = partial(make_runner_pipe, coalesce=(BACKEND not in ("http", "daemon")),
+                       max_batch=REQS_PER_BATCH * len(AGENT_PROMPTS), stages=stages,
+                       stage_limits=STAGE_LIMITS, rate=RATE_LIMIT)
 
     print("Llama loaded")
-    return text_pipe
+    return build_pipeline_stack(backend, "Multi_agent_8prompt", max_new_tokens=512,
+                                prefix_cache=USE_PREFIX_CACHE,
+                                prompt_lookup=USE_PROMPT_LOOKUP,
+                                compiled_templates=USE_COMPILED_TEMPLATES,
+                                token_budget=TOKEN_BUDGET,
+                                inference_cache=USE_INFERENCE_CACHE,
+                                wrap=wrap,
+                                agents={prompt: field for field, prompt in AGENT_PROMPTS.items()} if TRACE else None)
 
-def process_multi_agent_requirement(req_text, pipe, prompts_dict):
+def build_agent_messages(req_text, prompt_template):
     """
-    Orchestrates 8 separate calls to the model, one for each extraction field.
+    Builds the chat messages for one field agent.
     """
-    final_extraction = {}
-
-    for field, prompt_template in prompts_dict.items():
-        messages = [
-            {"role": "system", "content": prompt_template},
-            {"role": "user", "content": req_text}
-        ]
+    return [
+        {"role": "system", "content": prompt_template},
+        {"role": "user", "content": req_text}
+    ]
 
+def parse_field_output(generated_text, field):
+    """
+    Extracts the list for a single field from the raw output of its agent.
+    """
+    with TRACER.span("parse", agent=field):
         try:
-            output = pipe(messages)
-            # Accessing generated_text from Llama 3 format
-            generated_text = output[0]['generated_text']
-
             # Basic cleaning of markdown
             clean_text = generated_text.replace("```json", "").replace("```", "").strip()
 
+            # First complete JSON object (generation stops right after it)
+            data_dict = parse_first_json_object(clean_text)
+            if isinstance(data_dict, dict):
+                return data_dict.get(field, [])
+
             # Extract JSON using regex (in case there is text before/after the { })
             json_match = re.search(r'\{.*\}', clean_text, re.DOTALL)
             if json_match:
@@ -86,57 +108,205 @@ def process_multi_agent_requirement(req_text, pipe, prompts_dict):
                 data_dict = json.loads(json_match.group())
 
                 # Use .get() on the dictionary, not the string
-                final_extraction[field] = data_dict.get(field, [])
-            else:
-                final_extraction[field] = []
+                return data_dict.get(field, [])
+            record_fallback(field, parse_failure=True)
+            return []
 
         except json.JSONDecodeError:
             print(f"Warning: Could not decode JSON for {field}. Setting to empty list.")
+            record_fallback(field, parse_failure=True)
+            return []
+        except Exception as e:
+            print(f"Error in {field}: {str(e)}")
+            record_fallback(field, parse_failure=True)
+            return []
+
+def record_fallback(field, parse_failure=False):
+    """
+    Counts a field set to an empty list because its call or its parsing failed.
+    """
+    TRACER.count("empty_fallbacks", agent=field)
+    if parse_failure:
+        TRACER.count("parse_failures", agent=field)
+
+def process_multi_agent_requirement(req_text, pipe, prompts_dict, gate=None):
+    """
+    Orchestrates 8 separate calls to the model, one for each extraction field
+    (fewer with a gate: the skipped fields are set to an empty list).
+    A failed call leaves its field empty and adds an "error" key, so a resumed run retries it.
+    """
+    final_extraction = {}
+    errors = []
+    to_run = gate.fields_to_run(req_text, list(prompts_dict)) if gate is not None else prompts_dict
+
+    for field, prompt_template in prompts_dict.items():
+        if field not in to_run:
             final_extraction[field] = []
+            continue
+        messages = build_agent_messages(req_text, prompt_template)
+
+        try:
+            output = pipe(messages)
+            # Accessing generated_text from Llama 3 format
+            generated_text = output[0]['generated_text']
+            final_extraction[field] = parse_field_output(generated_text, field)
+
         except Exception as e:
             print(f"Error in {field}: {str(e)}")
+            record_fallback(field)
             final_extraction[field] = []
+            errors.append(f"{field}: {e}")
+
+    if errors:
+        final_extraction["error"] = "; ".join(errors)
 
-    return final_extraction
+    # Drop contained spans, protect short numeric values (shared with SCAP)
+    return dedup_record(final_extraction)
 
-# Load the model
-try:
-    pipe = load_llama_model()
-except Exception as e:
-    print(f"Error loading model: {e}")
+def process_multi_agent_batch(req_texts, pipe, prompts_dict, gate=None, batch_size=AGENT_BATCH_SIZE):
+    """
+    Fans out every field agent for every requirement into a single call.
+    The agents are independent, so the prompts are decoded together in padded batches of
+    `batch_size` and the outputs are scattered back into one extraction dictionary per
+    requirement (daemon jobs can hold many requirements: the batch stays bounded).
+    Fields skipped by the gate (Mia_gating.py) are set to an empty list.
+    If the batched call fails, every requirement of the batch gets an "error" key
+    (retried on resume) instead of passing for an empty extraction.
+    """
+    jobs = []
+    conversations = []
+    for req_idx, req_text in enumerate(req_texts):
+        to_run = gate.fields_to_run(req_text, list(prompts_dict)) if gate is not None else prompts_dict
+        for field, prompt_template in prompts_dict.items():
+            if field in to_run:
+                jobs.append((req_idx, field))
+                conversations.append(build_agent_messages(req_text, prompt_template))
+
+    extractions = [{field: [] for field in prompts_dict} for _ in req_texts]
 
-results = []
+    try:
+        outputs = pipe(conversations, batch_size=batch_size or len(conversations)) if conversations else []
+    except Exception as e:
+        print(f"Error in batched call: {str(e)}")
+        outputs = [None] * len(jobs)
+        for req_idx in {req_idx for req_idx, _ in jobs}:
+            extractions[req_idx]["error"] = str(e)
 
-with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-    dataset = json.load(f)
-    print(f"Processing {len(dataset)} requirements...")
+    for (req_idx, field), output in zip(jobs, outputs):
+        if output is None:
+            record_fallback(field)
+            extractions[req_idx][field] = []
+            continue
+        extractions[req_idx][field] = parse_field_output(output[0]['generated_text'], field)
+
+    return [dedup_record(extraction) for extraction in extractions]
+
+def requirement_task(entry, pipe, prompts_dict=AGENT_PROMPTS, gate=None):
+    """
+    Task function of the async runner: one dataset entry -> one output record.
+    """
+    return {
+      "id": entry.get("id", "unknown"),
+      "Text": entry.get("Text", ""),
+      **process_multi_agent_requirement(entry.get("Text", ""), pipe, prompts_dict, gate)
+    }
+
+def main():
+    if TRACE:
+        TRACER.enable(strategy="mia")
+
+    # Load the model
+    try:
+        pipe = load_llama_model()
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        return
+
+    gate = None
+    if USE_GATING:
+        gate = MiaGate.from_files(GATING_TRAINING_FILES, recall=GATING_RECALL,
+                                  min_recall=GATING_MIN_RECALL, z=GATING_CONFIDENCE_Z)
+        print(f"Gated fields: {', '.join(gate.gates) or 'none'}")
+
+    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    # Skip the requirements already written by a previous (interrupted) run of the same
+    # strategy, prompts and requirement text
+    fingerprint = RunFingerprint("mia_gated" if USE_GATING else "mia", "Multi_agent_8prompt")
+    expected = fingerprint.of_entries(dataset)
+    done_ids = load_done_ids(STREAM_FILE, expected)
+    pending = [entry for entry in dataset if entry.get("id", "unknown") not in done_ids]
+    print(f"Processing {len(pending)} requirements ({len(done_ids)} already done)...")
+
+    # Only the novel requirements go to the model, near-duplicates reuse their records
+    reuse = None
+    if NEAR_DUP_THRESHOLD is not None:
+        from Near_duplicates import ExtractionReuse  # numpy, only when turned on
+        reuse = ExtractionReuse(NEAR_DUP_THRESHOLD, read_run_records(STREAM_FILE, fingerprint))
+        pending, duplicates = reuse.split(pending)
+        print(f"Near-duplicates: {len(duplicates)} reused, {len(pending)} sent to the model")
+
+    # With length buckets, the chunks below hold requirements of similar length
+    pending = sort_by_length(pending, pipe)
 
     # --- Start Timer ---
     start_time = time.time()
 
-    # Process each requirement
-    for entry in tqdm(dataset):
-        req_text = entry.get("Text", "")
-        req_id = entry.get("id", "unknown")
+    with JsonlResultWriter(STREAM_FILE, flush_every=FLUSH_EVERY, fingerprint=fingerprint) as stream:
+        writer = reuse.recording(stream) if reuse is not None else stream
+        if EXECUTION_MODE == "async":
+            # Many requirements in flight, records written as they finish
+            runner = AsyncRequirementRunner(partial(requirement_task, pipe=pipe, gate=gate),
+                                            max_in_flight=MAX_IN_FLIGHT)
+            print(f"Async runner: {runner.run_sync(pending, writer)}")
+        else:
+            # Process the requirements (all agents of a group in one batch)
+            step = REQS_PER_BATCH if EXECUTION_MODE == "batched" else 1
+            for start in tqdm(range(0, len(pending), step)):
+                batch = pending[start:start + step]
+                req_texts = [entry.get("Text", "") for entry in batch]
+
+                if EXECUTION_MODE == "batched":
+                    predictions = process_multi_agent_batch(req_texts, pipe, AGENT_PROMPTS, gate)
+                else:
+                    predictions = [process_multi_agent_requirement(req_texts[0], pipe, AGENT_PROMPTS, gate)]
 
-        prediction = process_multi_agent_requirement(req_text, pipe, AGENT_PROMPTS)
+                for entry, prediction in zip(batch, predictions):
+                    writer.write({
+                      "id": entry.get("id", "unknown"),
+                      "Text": entry.get("Text", ""),
+                      **prediction
+                    })
 
-        results.append({
-          "id": req_id,
-          "Text": req_text,
-          **prediction
-        })
+        if reuse is not None:
+            reused, waiting = reuse.adapt(duplicates)
+            for _, record in reused:
+                writer.write(record)
+            if waiting:
+                print(f"Near-duplicates left for the next run (no record for their match): {len(waiting)}")
 
     # --- End Timer ---
     end_time = time.time()
     total_duration = end_time - start_time
 
-# Salvataggio
-with open(OUTPUT_FILE, "w", encoding='utf-8') as f:
-    json.dump(results, f, indent=4)
+    # Salvataggio
+    compact_jsonl(STREAM_FILE, OUTPUT_FILE, [entry.get("id", "unknown") for entry in dataset], expected)
+
+    print("-" * 30)
+    print(f"Processing Complete!")
+    print(f"Total Time: {total_duration:.2f} seconds")
+    print(f"File saved in: {OUTPUT_FILE}")
+    for layer, stats in pipeline_stats(pipe).items():
+        print(f"{layer}: {stats}")
+    if reuse is not None:
+        print(f"Near-duplicates: {reuse.stats()}")
+    if gate is not None:
+        print(f"Gating: {gate.stats()}")
+    if TRACE:
+        TRACER.export(TRACE_FILE, METRICS_FILE)
+    print("-" * 30)
+
 
-print("-" * 30)
-print(f"Processing Complete!")
-print(f"Total Time: {total_duration:.2f} seconds")
-print(f"File saved in: {OUTPUT_FILE}")
-print("-" * 30)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+## Runs several extraction strategies in one job: the model is loaded once, the dataset
+## is read once, and the requests of all the strategies are interleaved so that the
+## batching and caching layers see as much concurrent work as possible.
+## Every strategy gets its own resumable JSONL stream and the prediction file the evaluation reads
+## (e.g. few_shot_predictions.json, multi_agent_predictions_3.json).
+##
+## Usage (from the repository root):
+##   python Codes/Multi_strategy_runner.py --strategies zero_shot one_shot few_shot scap mia \
+##       --input Datasets/Dataset_250/requirements.json --output-dir Datasets/Dataset_250
+
+import argparse
+import json
+import os
+import time
+
+from Async_runner import AsyncRequirementRunner
+from Backends import load_backend
+from Extraction_daemon import ExtractionService
+from Instrumentation import TRACER
+from Results_writer import JsonlResultWriter, RunFingerprint, load_done_ids, compact_jsonl, read_run_records
+from Strategies import STRATEGIES
+
+HF_TOKEN = '< YOUR TOKEN >'
+
+MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+INPUT_FILE = 'Datasets/Dataset_250/requirements.json'
+OUTPUT_DIR = '.'
+BACKEND = "transformers"   # or "cpu", "gguf", "http", "daemon" (see Backends.py)
+SERVER_URL = "http://localhost:8000/v1"
+HTTP_CONCURRENCY = 32
+CPU_THREADS = None
+CPU_BATCH_SIZE = 4
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+MAX_BATCH = 16             # Conversations (of any strategy) decoded together
+CHUNK_SIZE = 4             # Requirements per job
+MAX_IN_FLIGHT = 8          # Jobs running at once
+FLUSH_EVERY = 8
+USE_INFERENCE_CACHE = True
+TOKEN_BUDGET = None        # Padded prompt tokens per batch, length-bucketed (None = fixed-count batches)
+NEAR_DUP_THRESHOLD = None  # Reuse the records of near-duplicate requirements (Near_duplicates.py, None = off)
+
+
+class StrategyWriters:
+    '''
+    One JsonlResultWriter per strategy, fed with (strategy, records) results, stamping
+    the records with the RunFingerprint of their strategy (`fingerprints`).
+    The records are also added to the ExtractionReuse of their strategy, if any.
+    '''
+
+    def __init__(self, stream_files, flush_every=FLUSH_EVERY, reuse=None, fingerprints=None):
+        fingerprints = fingerprints or {}
+        self.writers = {strategy: JsonlResultWriter(path, flush_every, fingerprints.get(strategy))
+                        for strategy, path in stream_files.items()}
+        self.written = {strategy: 0 for strategy in stream_files}
+        self.reuse = reuse or {}
+
+    def write(self, result):
+        strategy, records = result
+        for record in records:
+            self.writers[strategy].write(record)
+        self.written[strategy] += len(records)
+        if strategy in self.reuse:
+            self.reuse[strategy].add_records(records)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def interleave_jobs(pending, chunk_size=CHUNK_SIZE):
+    '''
+    Splits the pending requirements of every strategy into chunks and orders them
+    round-robin (chunk 0 of every strategy, then chunk 1, ...).
+    '''
+    chunks = {strategy: [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+              for strategy, entries in pending.items()}
+    jobs = []
+    for index in range(max((len(c) for c in chunks.values()), default=0)):
+        for strategy, strategy_chunks in chunks.items():
+            if index < len(strategy_chunks):
+                chunk = strategy_chunks[index]
+                jobs.append({"id": f"{strategy}#{index}", "strategy": strategy, "requirements": chunk})
+    return jobs
+
+
+def run_strategies(service, dataset, strategies, output_dir=OUTPUT_DIR, prefix="",
+                   chunk_size=CHUNK_SIZE, max_in_flight=MAX_IN_FLIGHT, near_dup_threshold=None,
+                   input_file=None):
+    '''
+    Runs the strategies over the dataset and writes one prediction file per strategy.
+    `input_file` is the file of the dataset (mia_gated trains its gate on another one).
+    With `near_dup_threshold`, near-duplicate requirements reuse the records of their
+    match instead of going to the model (Near_duplicates.py).
+    Returns the runner statistics and the output paths.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {s: os.path.join(output_dir, prefix + STRATEGIES[s]["output_file"]) for s in strategies}
+    streams = {s: path + "l" for s, path in outputs.items()}
+
+    # Skip the requirements already written by a previous (interrupted) run of the same
+    # strategy, prompts and requirement text
+    fingerprints = {s: RunFingerprint(s, STRATEGIES[s]["prompt_module"]) for s in strategies}
+    expected = {s: fingerprint.of_entries(dataset) for s, fingerprint in fingerprints.items()}
+    pending = {}
+    for strategy in strategies:
+        done_ids = load_done_ids(streams[strategy], expected[strategy])
+        pending[strategy] = [entry for entry in dataset if entry.get("id", "unknown") not in done_ids]
+        print(f"{strategy}: {len(done_ids)} done, {len(pending[strategy])} to process")
+
+    reuse, duplicates = {}, {}
+    if near_dup_threshold is not None:
+        from Near_duplicates import ExtractionReuse  # numpy, only when turned on
+        for strategy in strategies:
+            reuse[strategy] = ExtractionReuse(near_dup_threshold,
+                                              read_run_records(streams[strategy], fingerprints[strategy]))
+            pending[strategy], duplicates[strategy] = reuse[strategy].split(pending[strategy])
+            print(f"{strategy}: {len(duplicates[strategy])} near-duplicates reused")
+
+    def job_task(job):
+        return job["strategy"], service.extract(job["strategy"], job["requirements"], input_file)
+
+    writers = StrategyWriters(streams, reuse=reuse, fingerprints=fingerprints)
+    try:
+        runner = AsyncRequirementRunner(job_task, max_in_flight=max_in_flight)
+        stats = runner.run_sync(interleave_jobs(pending, chunk_size), writers)
+        for strategy, strategy_reuse in reuse.items():
+            reused, _ = strategy_reuse.adapt(duplicates[strategy])
+            writers.write((strategy, [record for _, record in reused]))
+    finally:
+        writers.close()
+
+    id_order = [entry.get("id", "unknown") for entry in dataset]
+    for strategy in strategies:
+        compact_jsonl(streams[strategy], outputs[strategy], id_order, expected[strategy])
+    stats["records_per_strategy"] = writers.written
+    if reuse:
+        stats["near_duplicates"] = {strategy: r.stats() for strategy, r in reuse.items()}
+    return stats, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several extraction strategies with one model load.")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument("--input", default=INPUT_FILE)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--prefix", default="", help="Prefix of the prediction files (e.g. clean_)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--trace", help="Per-strategy/agent JSON trace of the run (Instrumentation.py)")
+    parser.add_argument("--metrics", help="Prometheus textfile of the run")
+    args = parser.parse_args()
+
+    if args.trace or args.metrics:
+        TRACER.enable()
+
+    # Load the model (once for all the strategies)
+    backend = load_backend(BACKEND, model_id=MODEL_ID, hf_token=HF_TOKEN, max_new_tokens=512,
+                           base_url=SERVER_URL, max_concurrency=HTTP_CONCURRENCY,
+                           threads=CPU_THREADS, batch_size=CPU_BATCH_SIZE, model_path=GGUF_PATH)
+    service = ExtractionService(backend, MAX_BATCH, inference_cache=USE_INFERENCE_CACHE,
+                                token_budget=TOKEN_BUDGET)
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    start_time = time.time()
+    stats, outputs = run_strategies(service, dataset, args.strategies, args.output_dir, args.prefix,
+                                    args.chunk_size, args.max_in_flight, NEAR_DUP_THRESHOLD, args.input)
+
+    print("-" * 30)
+    print(f"Total Time: {time.time() - start_time:.2f} seconds")
+    for strategy, path in outputs.items():
+        print(f"{strategy}: {stats['records_per_strategy'][strategy]} new records, file saved in: {path}")
+    print(f"Batching: {service.batcher.stats()}")
+    status = service.status()
+    if "length_buckets" in status:
+        print(f"Length buckets: {status['length_buckets']}")
+    if service.cache is not None:
+        print(f"Inference cache: {service.cache.stats()}")
+    if "near_duplicates" in stats:
+        print(f"Near-duplicates: {stats['near_duplicates']}")
+    TRACER.export(args.trace, args.metrics)
+    print("-" * 30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+## Reuse of the extractions of near-duplicate requirements.
+## Large, messy requirement sets repeat the same requirement with small edits (another
+## actor, a different number, a typo, extra spaces). Before a run, every pending
+## requirement is looked up in a MinHash/LSH index over the texts already extracted (the
+## records of the stream file) and over the novel requirements met so far: only the novel
+## ones are sent to the model. After the run, every near-duplicate gets the record of its
+## match, adapted to its own text (id, Text, and the spans rewritten where the two texts
+## differ word for word). Failed records are never reused: their near-duplicates wait
+## for a later run (or are extracted directly by extract_with_reuse).
+## Similarity is the Jaccard index of the character shingles of the normalized texts;
+## LSH only proposes the candidates, the similarity is computed exactly before a reuse.
+##
+## Usage (from the repository root), to see what a threshold would reuse on a dataset:
+##   python Codes/Near_duplicates.py --input Datasets/Dataset_250/requirements.json --threshold 0.8
+
+import argparse
+import copy
+import difflib
+import json
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from Span_dedup import FIELDS, dedup_record
+
+THRESHOLD = 0.8      # Minimum Jaccard similarity for a reuse
+SHINGLE_CHARS = 5
+NUM_PERM = 128
+BANDS = 32           # NUM_PERM / BANDS rows per band: pairs from ~0.45 similarity are candidates
+SEED = 1
+
+MERSENNE_PRIME = (1 << 31) - 1
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+def shingles(text, size=SHINGLE_CHARS):
+    text = normalize(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    '''
+    MinHash signatures of shingle sets: NUM_PERM random hash functions (a*x + b) mod p
+    over the CRC32 of the shingles.
+    '''
+
+    def __init__(self, num_perm=NUM_PERM, seed=SEED):
+        generator = np.random.RandomState(seed)
+        self.a = generator.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self.b = generator.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, shingle_set):
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) & MERSENNE_PRIME for s in shingle_set],
+                          dtype=np.int64)
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+
+class NearDuplicateIndex:
+    '''
+    LSH index of texts: the signature is cut into `bands`, and two texts sharing a
+    band are candidates. query() returns the most similar candidate at or above
+    `threshold` as (key, similarity), or None.
+    '''
+
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, bands=BANDS):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.buckets = [{} for _ in range(bands)]
+        self.shingles = {}  # key -> shingle set
+        self.exact = {}     # normalized text -> key
+
+    def _bands(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(len(self.buckets))]
+
+    def add(self, key, text):
+        shingle_set = shingles(text)
+        self.shingles[key] = shingle_set
+        self.exact.setdefault(normalize(text), key)
+        for bucket, band in zip(self.buckets, self._bands(self.hasher.signature(shingle_set))):
+            bucket.setdefault(band, []).append(key)
+
+    def query(self, text):
+        key = self.exact.get(normalize(text))
+        if key is not None:
+            return key, 1.0
+
+        shingle_set = shingles(text)
+        candidates = set()
+        for bucket, band in zip(self.buckets, self._bands(self.hasher.signature(shingle_set))):
+            candidates.update(bucket.get(band, ()))
+
+        best = None
+        for key in candidates:
+            similarity = jaccard(shingle_set, self.shingles[key])
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def __len__(self):
+        return len(self.shingles)
+
+
+def _tokens(text):
+    return [(m.group(), m.start(), m.end()) for m in TOKEN_RE.finditer(text)]
+
+
+def is_failed_record(record, fields=FIELDS):
+    '''
+    True for an error record (Single_agent) or a record without any span, which is what
+    SCAP/MIA write when their calls failed.
+    '''
+    return "error" in record or not any(record.get(field) for field in fields)
+
+
+def text_edits(old_text, new_text):
+    '''
+    The words replaced from old_text to new_text, as (start, end, new substring) with
+    old_text[start:end] the replaced words.
+    '''
+    old_tokens, new_tokens = _tokens(old_text), _tokens(new_text)
+    matcher = difflib.SequenceMatcher(None, [t[0].lower() for t in old_tokens],
+                                      [t[0].lower() for t in new_tokens], autojunk=False)
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "replace":
+            edits.append((old_tokens[i1][1], old_tokens[i2 - 1][2],
+                          new_text[new_tokens[j1][1]:new_tokens[j2 - 1][2]]))
+    return edits
+
+
+def adapt_span(span, old_text, new_text, edits):
+    '''
+    A span copied from old_text with the edits found inside it applied at their offsets,
+    or None when no occurrence of the span in old_text maps to a substring of new_text.
+    An occurrence that only partly covers an edit is not adapted.
+    '''
+    start = old_text.find(span)
+    while start != -1:
+        end = start + len(span)
+        adapted, partial = span, False
+        for edit_start, edit_end, new in reversed(edits):  # Right to left: offsets stay valid
+            if start <= edit_start and edit_end <= end:
+                adapted = adapted[:edit_start - start] + new + adapted[edit_end - start:]
+            elif edit_start < end and start < edit_end:
+                partial = True
+        if not partial and adapted in new_text:
+            return adapted
+        start = old_text.find(span, start + 1)
+    return None
+
+
+def adapt_record(record, old_text, entry, fields=FIELDS):
+    '''
+    The record extracted from old_text, moved to a near-duplicate dataset entry: the
+    replaced words are rewritten in the spans (where they were replaced, see adapt_span),
+    and the spans copied from old_text that are still not in the new text are dropped. Spans that were not copied from
+    old_text (reworded by the model) are kept as they are.
+    '''
+    new_text = entry.get("Text", "")
+    adapted = copy.deepcopy(record)
+    adapted["id"] = entry.get("id", "unknown")
+    adapted["Text"] = new_text
+    if old_text == new_text:
+        return adapted
+
+    edits = text_edits(old_text, new_text)
+    for field in fields:
+        spans = adapted.get(field)
+        if not isinstance(spans, list):
+            continue
+        kept = []
+        for span in spans:
+            if isinstance(span, str) and span in old_text:
+                span = adapt_span(span, old_text, new_text, edits)
+                if span is None:
+                    continue
+            kept.append(span)
+        adapted[field] = kept
+    return dedup_record(adapted, fields)
+
+
+class ExtractionReuse:
+    '''
+    Splits the requirements of a run into the novel ones (sent to the model) and the
+    near-duplicates, whose records are then adapted from the record of their match.
+    Seed it with the records already extracted; the records of the novel requirements
+    are added with add_records() (or by the writer returned by recording()).
+    Failed records are not added, so their near-duplicates stay waiting.
+    '''
+
+    def __init__(self, threshold=THRESHOLD, records=()):
+        self.index = NearDuplicateIndex(threshold)
+        self.lock = threading.Lock()
+        self.texts = []    # key -> text
+        self.records = {}  # key -> extracted record
+        self.keys = {}     # id of a novel requirement -> key
+        self.novel = 0
+        self.reused = 0
+        self.add_records(records)
+
+    def _add_text(self, text):
+        key = len(self.texts)
+        self.texts.append(text)
+        self.index.add(key, text)
+        return key
+
+    def add_records(self, records):
+        with self.lock:
+            for record in records:
+                if is_failed_record(record):
+                    continue
+                key = self.keys.get(record.get("id"))
+                if key is None or self.texts[key] != record.get("Text", ""):
+                    key = self._add_text(record.get("Text", ""))
+                self.records[key] = record
+
+    def split(self, entries):
+        '''
+        Returns (novel entries, near-duplicates as (entry, key of the match, similarity)).
+        A novel entry is indexed right away, so its own near-duplicates wait for its record.
+        '''
+        novel, duplicates = [], []
+        with self.lock:
+            for entry in entries:
+                match = self.index.query(entry.get("Text", ""))
+                if match is None:
+                    self.keys[entry.get("id", "unknown")] = self._add_text(entry.get("Text", ""))
+                    novel.append(entry)
+                else:
+                    duplicates.append((entry, *match))
+            self.novel += len(novel)
+        return novel, duplicates
+
+    def adapt(self, duplicates):
+        '''
+        Returns ([(entry, adapted record)], waiting): the near-duplicates whose match has
+        no record yet (still running, or failed) are left in `waiting`.
+        '''
+        reused, waiting = [], []
+        with self.lock:
+            for entry, key, similarity in duplicates:
+                if key in self.records:
+                    reused.append((entry, adapt_record(self.records[key], self.texts[key], entry)))
+                else:
+                    waiting.append((entry, key, similarity))
+            self.reused += len(reused)
+        return reused, waiting
+
+    def recording(self, writer):
+        return RecordingWriter(writer, self)
+
+    def stats(self):
+        calls = self.novel + self.reused
+        return {
+            "indexed": len(self.index),
+            "novel": self.novel,
+            "reused": self.reused,
+            "saved_rate": self.reused / calls if calls else 0.0,
+        }
+
+
+class RecordingWriter:
+    '''
+    Result writer that also adds the records it writes to an ExtractionReuse
+    (failed records are written, but not added).
+    '''
+
+    def __init__(self, writer, reuse):
+        self.writer = writer
+        self.reuse = reuse
+
+    def write(self, record):
+        self.writer.write(record)
+        self.reuse.add_records([record])
+
+
+def extract_with_reuse(reuse, entries, extract):
+    '''
+    Records of `entries` (in order) with extract(entries) -> records called on the novel
+    ones only. Near-duplicates of requirements still running elsewhere are extracted too.
+    '''
+    novel, duplicates = reuse.split(entries)
+    records = extract(novel) if novel else []
+    reuse.add_records(records)
+    reused, waiting = reuse.adapt(duplicates)
+    if waiting:
+        late = [entry for entry, _, _ in waiting]
+        reused += list(zip(late, extract(late)))
+
+    by_entry = {id(entry): record for entry, record in zip(novel, records)}
+    by_entry.update((id(entry), record) for entry, record in reused)
+    return [by_entry[id(entry)] for entry in entries]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate requirements of a dataset.")
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--show", type=int, default=10, help="Pairs printed")
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    index = NearDuplicateIndex(args.threshold)
+    pairs = []
+    for position, entry in enumerate(dataset):
+        match = index.query(entry.get("Text", ""))
+        if match is None:
+            index.add(position, entry.get("Text", ""))
+        else:
+            pairs.append((match[1], dataset[match[0]], entry))
+
+    print(f"{len(dataset)} requirements, {len(pairs)} near-duplicates at {args.threshold} "
+          f"({len(pairs) / len(dataset):.1%} of the model calls saved)")
+    for similarity, source, entry in sorted(pairs, key=lambda p: p[0])[:args.show]:
+        print(f"\n{similarity:.2f}  {source.get('id')}: {source.get('Text')}\n      {entry.get('id')}: {entry.get('Text')}")
+
+
+if __name__ == "__main__":
+    main()
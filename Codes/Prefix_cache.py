@@ -0,0 +1,142 @@
+## Prefix KV-cache shared by the inference scripts.
+## The system prompts (few-shot examples, agent prompts, SHARED_RULES) are the same
+## for every requirement: their past_key_values are computed once and reused, so only
+## the user turn has to be prefilled for each call.
+
+import copy
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+from Instrumentation import generation_output
+
+
+class PrefixKVCache:
+    '''
+    Drop-in replacement for the text-generation pipeline (same call signature and
+    output format) that reuses the KV-cache of the system prompt.
+    Entries are kept in LRU order and evicted when the entry count or the memory cap
+    is exceeded.
+    '''
+
+    def __init__(self, model, tokenizer, max_entries=16, max_memory_mb=2048, templates=None, **gen_kwargs):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.templates = templates  # Prompt_templates.TemplateCompiler (optional)
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.gen_kwargs = {"max_new_tokens": 512, "do_sample": False, **gen_kwargs}
+
+        self.entries = OrderedDict()  # system prompt -> (prefix_ids, past_key_values, nbytes)
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _bytes_per_token(self):
+        '''
+        Size of the keys and values stored for one token across all layers.
+        '''
+        cfg = self.model.config
+        num_heads = cfg.num_attention_heads
+        kv_heads = getattr(cfg, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // num_heads
+        dtype_size = torch.finfo(self.model.dtype).bits // 8
+        return 2 * cfg.num_hidden_layers * kv_heads * head_dim * dtype_size
+
+    def _tokenize(self, messages, add_generation_prompt):
+        if add_generation_prompt and self.templates is not None:
+            return torch.tensor([self.templates.encode(messages)])
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+        return self.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+
+    def _evict(self, incoming_bytes):
+        while self.entries and (len(self.entries) >= self.max_entries or
+                                self.memory_used + incoming_bytes > self.max_memory_bytes):
+            _, (_, _, nbytes) = self.entries.popitem(last=False)
+            self.memory_used -= nbytes
+
+    def get_prefix(self, system_prompt):
+        '''
+        Returns (prefix_ids, past_key_values) for a system prompt, computing them on a miss.
+        '''
+        if system_prompt in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(system_prompt)
+            prefix_ids, past, _ = self.entries[system_prompt]
+            return prefix_ids, past
+
+        self.misses += 1
+        prefix_ids = self._tokenize([{"role": "system", "content": system_prompt}], False)
+
+        with torch.no_grad():
+            out = self.model(input_ids=prefix_ids.to(self.model.device), use_cache=True)
+        past = out.past_key_values
+        if isinstance(past, tuple):
+            past = DynamicCache.from_legacy_cache(past)
+
+        nbytes = prefix_ids.shape[1] * self._bytes_per_token()
+        # Prefixes bigger than the whole cap are used once and not stored
+        if nbytes <= self.max_memory_bytes:
+            self._evict(nbytes)
+            self.entries[system_prompt] = (prefix_ids, past, nbytes)
+            self.memory_used += nbytes
+
+        return prefix_ids, past
+
+    def generate(self, messages, **gen_kwargs):
+        '''
+        Generates the answer for one conversation, prefilling only the tokens after
+        the cached system prompt.
+        '''
+        return self.generate_with_usage(messages, **gen_kwargs)[0]
+
+    def generate_with_usage(self, messages, **gen_kwargs):
+        '''
+        (answer, prompt tokens, generated tokens) of one conversation.
+        '''
+        config = {**self.gen_kwargs, **gen_kwargs}
+        config.pop("batch_size", None)
+
+        input_ids = self._tokenize(messages, True)
+        past = None
+
+        if messages and messages[0]["role"] == "system":
+            prefix_ids, cached = self.get_prefix(messages[0]["content"])
+            n = prefix_ids.shape[1]
+            # The cache is only valid if the full prompt starts with the same tokens
+            if input_ids.shape[1] > n and torch.equal(input_ids[0, :n], prefix_ids[0]):
+                # generate() extends the cache in place, so work on a copy
+                past = copy.deepcopy(cached)
+
+        input_ids = input_ids.to(self.model.device)
+        with torch.no_grad():
+            output_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **config)
+
+        new_ids = output_ids[0, input_ids.shape[1]:]
+        return (self.tokenizer.decode(new_ids, skip_special_tokens=True),
+                input_ids.shape[1], new_ids.shape[0])
+
+    def __call__(self, inputs, **gen_kwargs):
+        '''
+        Same output format as the pipeline: a single conversation returns
+        [{"generated_text": ...}], a list of conversations returns one such list each.
+        Conversations are decoded one at a time, reusing the cached prefixes.
+        '''
+        if inputs and isinstance(inputs[0], dict):
+            return [generation_output(*self.generate_with_usage(inputs, **gen_kwargs))]
+        return [[generation_output(*self.generate_with_usage(messages, **gen_kwargs))] for messages in inputs]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "memory_mb": self.memory_used / (1024 * 1024),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,174 @@
+## Prompt-lookup speculative decoding for the extractive agents.
+## The answers copy substrings of the requirement ("Extract the substring EXACTLY as it
+## appears in the text") inside a fixed JSON scaffold, so the next tokens can usually be
+## guessed by finding the last generated n-gram in the prompt and copying what follows it.
+## The draft is verified with one forward pass and only the prefix that greedy decoding
+## would have produced is kept, so the output is the same as with do_sample=False.
+
+import copy
+
+import torch
+from transformers import DynamicCache
+
+from Instrumentation import generation_output
+from Json_parsing import JsonObjectTracker
+
+
+class LookupStats:
+    '''
+    Counters of the draft proposals (acceptance rate = accepted / proposed).
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.steps = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "forward_passes": self.steps,
+            "draft_tokens_proposed": self.proposed,
+            "draft_tokens_accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed > 0 else 0,
+            "tokens_per_forward": self.generated / self.steps if self.steps > 0 else 0,
+        }
+
+
+def build_ngram_index(tokens, max_ngram=3):
+    '''
+    Maps every n-gram (n <= max_ngram) of the prompt to its last start position
+    that still has a continuation.
+    '''
+    index = {}
+    for n in range(1, max_ngram + 1):
+        for start in range(len(tokens) - n):
+            index[tuple(tokens[start:start + n])] = start
+    return index
+
+
+def find_draft(tokens, prompt, prompt_index, max_ngram=3, num_draft_tokens=10):
+    '''
+    Finds the longest suffix of `tokens` (down to 1 token) in the prompt, or else earlier
+    in the generated tokens, and returns the tokens that follow its last occurrence.
+    '''
+    for n in range(min(max_ngram, len(tokens)), 0, -1):
+        suffix = tokens[-n:]
+        start = prompt_index.get(tuple(suffix))
+        if start is not None:
+            return prompt[start + n:start + n + num_draft_tokens]
+
+        # Repeated patterns of the answer itself (e.g. '", "' between list items)
+        for start in range(len(tokens) - n - 1, -1, -1):
+            if tokens[start:start + n] == suffix:
+                return tokens[start + n:start + n + num_draft_tokens]
+    return []
+
+
+class PromptLookupDecoder:
+    '''
+    Greedy decoder with n-gram drafts taken from the prompt (requirement + JSON scaffold)
+    and from the tokens generated so far. Same call signature and output format as the
+    text-generation pipeline; conversations are decoded one at a time. If a PrefixKVCache
+    is given, the cached system prompt is reused and only the user turn is prefilled.
+    '''
+
+    def __init__(self, model, tokenizer, max_ngram=3, num_draft_tokens=10, stop_at_json=True,
+                 prefix_cache=None, max_new_tokens=512, templates=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_ngram = max_ngram
+        self.num_draft_tokens = num_draft_tokens
+        self.stop_at_json = stop_at_json
+        self.prefix_cache = prefix_cache
+        self.pipe = prefix_cache  # Layer underneath, for Backends.pipeline_stats
+        self.templates = templates  # Prompt_templates.TemplateCompiler (optional)
+        self.max_new_tokens = max_new_tokens
+        self.stats = LookupStats()
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_ids = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    def _prefill(self, messages):
+        if self.templates is not None:
+            input_ids = torch.tensor([self.templates.encode(messages)])
+        else:
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            input_ids = self.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+        input_ids = input_ids.to(self.model.device)
+
+        past = DynamicCache()
+        start = 0
+        if self.prefix_cache is not None and messages and messages[0]["role"] == "system":
+            prefix_ids, cached = self.prefix_cache.get_prefix(messages[0]["content"])
+            n = prefix_ids.shape[1]
+            if input_ids.shape[1] > n and torch.equal(input_ids[0, :n].cpu(), prefix_ids[0]):
+                past = copy.deepcopy(cached)
+                start = n
+
+        out = self.model(input_ids=input_ids[:, start:], past_key_values=past, use_cache=True)
+        return input_ids[0].tolist(), out.past_key_values, int(out.logits[0, -1].argmax())
+
+    def generate(self, messages, max_new_tokens=None, **_ignored):
+        return self.generate_with_usage(messages, max_new_tokens)[0]
+
+    @torch.no_grad()
+    def generate_with_usage(self, messages, max_new_tokens=None, **_ignored):
+        '''
+        (answer, prompt tokens, generated tokens) of one conversation.
+        '''
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        prompt, past, next_token = self._prefill(messages)
+        prompt_index = build_ngram_index(prompt, self.max_ngram)
+        self.stats.calls += 1
+        self.stats.steps += 1
+
+        generated = [next_token]
+        tracker = JsonObjectTracker() if self.stop_at_json else None
+        if tracker is not None:
+            tracker.feed(self.tokenizer.decode([next_token], skip_special_tokens=True))
+
+        while (len(generated) < max_new_tokens and generated[-1] not in self.eos_ids
+               and not (tracker is not None and tracker.done)):
+            draft = find_draft(generated, prompt, prompt_index, self.max_ngram,
+                               min(self.num_draft_tokens, max_new_tokens - len(generated)))
+
+            # The last accepted token is not in the cache yet: feed it with the draft
+            cache_len = past.get_seq_length()
+            candidate = torch.tensor([[generated[-1]] + draft], device=self.model.device)
+            out = self.model(input_ids=candidate, past_key_values=past, use_cache=True)
+            predictions = out.logits[0].argmax(dim=-1).tolist()
+            past = out.past_key_values
+
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predictions[accepted]:
+                accepted += 1
+            new_tokens = draft[:accepted] + [predictions[accepted]]
+
+            # Drop the cache entries of the rejected draft tokens
+            past.crop(cache_len + 1 + accepted)
+
+            self.stats.steps += 1
+            self.stats.proposed += len(draft)
+            self.stats.accepted += accepted
+
+            for token in new_tokens:
+                generated.append(token)
+                if tracker is not None:
+                    tracker.feed(self.tokenizer.decode([token], skip_special_tokens=True))
+                if (token in self.eos_ids or len(generated) >= max_new_tokens
+                        or (tracker is not None and tracker.done)):
+                    break
+
+        self.stats.generated += len(generated)
+        return self.tokenizer.decode(generated, skip_special_tokens=True), len(prompt), len(generated)
+
+    def __call__(self, inputs, **gen_kwargs):
+        gen_kwargs.pop("batch_size", None)
+        if inputs and isinstance(inputs[0], dict):
+            return [generation_output(*self.generate_with_usage(inputs, **gen_kwargs))]
+        return [[generation_output(*self.generate_with_usage(messages, **gen_kwargs))] for messages in inputs]
@@ -0,0 +1,154 @@
+## Pre-tokenized prompt templates.
+## Every call of the scripts is [system prompt, requirement]: the chat template and the
+## long system prompts (few-shot examples, agent prompts) are the same each time. They are
+## rendered and tokenized once per system prompt; a request is then built by joining the
+## cached token ids with the ids of the requirement text alone, and generation gets the
+## input_ids directly instead of going through the text-generation pipeline.
+
+from collections import OrderedDict
+
+import torch
+
+from Instrumentation import TRACER, PhaseTimer, generation_output
+
+# Stands in for the user turn when the template is split into the parts around it
+USER_SENTINEL = "@@REQUIREMENT@@"
+
+# User texts checked at compile time: joining the ids must give the full tokenization
+PROBE_TEXTS = [
+    "The system shall respond within 2 seconds.",
+    "When the user clicks 'Save', the form is stored (99% of the time) -> OK.",
+    "Ü-Übersicht: {\"a\": [1, 2]}\nSecond line",
+]
+
+
+class TemplateCompiler:
+    '''
+    Token ids of [system, user] conversations from cached pieces:
+    ids(template up to the user text) + ids(user text) + ids(rest of the template).
+    A system prompt whose template cannot be split this way exactly (checked with
+    PROBE_TEXTS) is always rendered in full, like any other conversation shape.
+    '''
+
+    def __init__(self, tokenizer, max_entries=64):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # system prompt -> (prefix_ids, suffix_ids) or None
+        self.hits = 0
+        self.misses = 0
+        self.full_renders = 0
+
+    def _render(self, messages):
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def _ids(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids if text else []
+
+    def compile(self, system_prompt):
+        '''
+        Returns the cached (prefix_ids, suffix_ids) of a system prompt, or None.
+        '''
+        if system_prompt in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(system_prompt)
+            return self.entries[system_prompt]
+
+        self.misses += 1
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_prompt}, {"role": "user", "content": USER_SENTINEL}],
+            tokenize=False, add_generation_prompt=True)
+
+        entry = None
+        if text.count(USER_SENTINEL) == 1:
+            prefix_text, suffix_text = text.split(USER_SENTINEL)
+            entry = (self._ids(prefix_text), self._ids(suffix_text))
+            for probe in PROBE_TEXTS:
+                messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": probe}]
+                if entry[0] + self._ids(probe) + entry[1] != self._render(messages):
+                    print("Warning: the chat template cannot be pre-tokenized for this system prompt")
+                    entry = None
+                    break
+
+        while len(self.entries) >= self.max_entries:
+            self.entries.popitem(last=False)
+        self.entries[system_prompt] = entry
+        return entry
+
+    def encode(self, messages):
+        '''
+        Token ids of the full prompt (with the assistant header) of a conversation.
+        '''
+        if (len(messages) == 2 and messages[0]["role"] == "system" and messages[1]["role"] == "user"):
+            user_text = messages[1]["content"]
+            # Templates may trim the turns: only join texts that trimming leaves unchanged
+            entry = self.compile(messages[0]["content"]) if user_text == user_text.strip() else None
+            if entry is not None:
+                return entry[0] + self._ids(user_text) + entry[1]
+
+        self.full_renders += 1
+        return self._render(messages)
+
+    def stats(self):
+        return {
+            "system_prompts": len(self.entries),
+            "compiled": sum(1 for entry in self.entries.values() if entry is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "full_renders": self.full_renders,
+        }
+
+
+class CompiledTemplatePipe:
+    '''
+    Drop-in replacement for the text-generation pipeline (same call signature and output
+    format) that builds the prompts with a TemplateCompiler and calls model.generate()
+    on left-padded input_ids, `batch_size` conversations at a time.
+    '''
+
+    def __init__(self, model, tokenizer, templates=None, max_new_tokens=512, stopping_criteria=None,
+                 batch_size=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.templates = templates or TemplateCompiler(tokenizer)
+        self.stopping_criteria = stopping_criteria
+        self.batch_size = batch_size
+        self.gen_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": False}
+
+    def generate_ids(self, prompts, **gen_kwargs):
+        '''
+        Generated texts for a list of prompts given as token id lists, with the number
+        of tokens generated for each.
+        '''
+        config = {**self.gen_kwargs, **gen_kwargs}
+        batch_size = config.pop("batch_size", None) or self.batch_size
+        if self.stopping_criteria is not None:
+            config.setdefault("stopping_criteria", self.stopping_criteria)
+        if TRACER.enabled:
+            config.setdefault("streamer", PhaseTimer(agent="batch"))
+
+        pad_id = self.tokenizer.pad_token_id
+        texts, generated = [], []
+        for start in range(0, len(prompts), batch_size):
+            chunk = prompts[start:start + batch_size]
+            width = max(len(ids) for ids in chunk)
+            input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in chunk])
+            attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in chunk])
+
+            with torch.no_grad():
+                output_ids = self.model.generate(input_ids=input_ids.to(self.model.device),
+                                                 attention_mask=attention_mask.to(self.model.device),
+                                                 pad_token_id=pad_id, **config)
+            new_ids = output_ids[:, width:]
+            texts.extend(self.tokenizer.batch_decode(new_ids, skip_special_tokens=True))
+            generated.extend((new_ids != pad_id).sum(dim=1).tolist())
+        return texts, generated
+
+    def __call__(self, inputs, **gen_kwargs):
+        single = bool(inputs) and isinstance(inputs[0], dict)
+        conversations = [inputs] if single else list(inputs)
+        prompts = [self.templates.encode(messages) for messages in conversations]
+        texts, generated = self.generate_ids(prompts, **gen_kwargs)
+        results = [[generation_output(text, len(ids), count)]
+                   for text, ids, count in zip(texts, prompts, generated)]
+        return results[0] if single else results
@@ -0,0 +1,171 @@
+## Streaming, resumable output for the inference scripts.
+## Each finished requirement is appended to a JSONL file right away, so a crash or a
+## Colab disconnect only loses the requirements in flight. A rerun skips the ids already
+## written, and compact_jsonl() produces the usual JSON array (indent=4) read by
+## load_predictions_json in Evaluation.ipynb.
+## Every record carries the fingerprint of the run that wrote it (strategy, prompt module
+## source, requirement text): a record only counts as done while its fingerprint matches,
+## so editing a prompt or a dataset entry (or switching strategy) extracts it again.
+
+import hashlib
+import json
+import os
+
+from Inference_cache import prompt_module_version
+
+RUN_KEY = "run"  # Fingerprint of the record's run, dropped by compact_jsonl()
+
+
+def _sha(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class RunFingerprint:
+    '''
+    fingerprint(text) -> short hash of (strategy, prompt module source, requirement text).
+    `strategy` can carry any other setting that changes the records (e.g. "mia_gated").
+    '''
+
+    def __init__(self, strategy, prompt_module):
+        self.prefix = f"{strategy}\0{prompt_module_version(prompt_module)}\0"
+
+    def __call__(self, text):
+        return _sha(self.prefix + text)
+
+    def of_entries(self, entries):
+        '''
+        Expected fingerprint of every dataset entry, by id (see load_done_ids).
+        '''
+        return {entry.get("id", "unknown"): self(entry.get("Text", "")) for entry in entries}
+
+    def matches(self, record):
+        '''
+        True when the record was written by this run for its own text.
+        '''
+        return record.get(RUN_KEY) == self(record.get("Text", ""))
+
+
+def _repair_tail(path):
+    '''
+    Truncates a partial last line left by a crash in the middle of a write.
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if not data or data.endswith(b"\n"):
+            return
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+def read_jsonl(path):
+    '''
+    Yields the records of a JSONL file, skipping lines that cannot be parsed.
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def read_run_records(path, fingerprint):
+    '''
+    Yields the records of a JSONL file written by the run of `fingerprint`.
+    '''
+    for record in read_jsonl(path):
+        if fingerprint.matches(record):
+            yield record
+
+
+def load_done_ids(path, expected=None):
+    '''
+    Returns the set of requirement ids already present in a JSONL output. Records with
+    an "error" key (failed calls) do not count, so a resumed run retries them; the
+    retried record is appended and replaces the error in compact_jsonl().
+    With `expected` ({id: fingerprint}, see RunFingerprint.of_entries), a record only
+    counts when it carries the expected fingerprint of its id.
+    '''
+    return {record.get("id") for record in read_jsonl(path)
+            if "error" not in record
+            and (expected is None or record.get(RUN_KEY) == expected.get(record.get("id")))}
+
+
+class JsonlResultWriter:
+    '''
+    Appends one JSON record per line and flushes (and fsyncs) every `flush_every` records.
+    With a `fingerprint` (RunFingerprint), every record is stamped with it under RUN_KEY.
+    Usable as a context manager.
+    '''
+
+    def __init__(self, path, flush_every=1, fingerprint=None):
+        self.path = path
+        self.flush_every = flush_every
+        self.fingerprint = fingerprint
+        self.pending = 0
+        self.written = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _repair_tail(path)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        if self.fingerprint is not None:
+            record = {**record, RUN_KEY: self.fingerprint(record.get("Text", ""))}
+        self.file.write(json.dumps(record) + "\n")
+        self.pending += 1
+        self.written += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def compact_jsonl(jsonl_path, json_path, id_order=None, expected=None):
+    '''
+    Writes the JSONL records as a single JSON array (the format of the prediction files).
+    Duplicated ids keep their last record; `id_order` (e.g. the dataset ids) sets the order.
+    With `expected` (as in load_done_ids), the records of other runs are left out.
+    '''
+    records = {}
+    for record in read_jsonl(jsonl_path):
+        if expected is not None and record.get(RUN_KEY) != expected.get(record.get("id")):
+            continue
+        record = dict(record)
+        record.pop(RUN_KEY, None)
+        records[record.get("id")] = record
+
+    if id_order is not None:
+        ordered = [records[rid] for rid in id_order if rid in records]
+        known = set(id_order)
+        ordered += [rec for rid, rec in records.items() if rid not in known]
+    else:
+        ordered = list(records.values())
+
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        json.dump(ordered, f, indent=4)
+    os.replace(tmp_path, json_path)
+
+    return len(ordered)
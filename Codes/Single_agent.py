@@ -1,126 +1,252 @@
 ## Single agent inference script using LLaMA 3 model with 4-bit quantization.
 
-import torch
 import json
 import os
+from functools import partial
 from tqdm import tqdm
 import time
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    pipeline
-)
-from huggingface_hub import login
 from Single_agent_prompt import PROMPT_VARIANTS
+from Backends import load_backend, build_pipeline_stack, pipeline_stats
+from Async_runner import AsyncRequirementRunner, make_runner_pipe
+from Results_writer import JsonlResultWriter, RunFingerprint, load_done_ids, compact_jsonl, read_run_records
+from Json_parsing import parse_first_json_object
+from Instrumentation import TRACER
+from Length_scheduler import sort_by_length
+from Span_dedup import dedup_record
 
 HF_TOKEN = '< YOUR TOKEN >'
 
 MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 INPUT_FILE = 'Datasets/Dataset_250/requirements.json'
-OUTPUT_FILE = 'one_shot_predictions.json'
-login(token=HF_TOKEN)
+STRATEGY = "one_shot" # or "few_shot", "zero_shot"
+OUTPUT_FILE = f'{STRATEGY}_predictions.json'
+STREAM_FILE = f'{STRATEGY}_predictions.jsonl' # Appended as requirements finish (resumable)
+FLUSH_EVERY = 8
+BATCH_SIZE = 8        # Requirements decoded together (1 = sequential)
+EXECUTION_MODE = "batched" # or "async" (MAX_IN_FLIGHT requirements at once)
+MAX_IN_FLIGHT = 16
+RATE_LIMIT = None          # Max model calls per second (None = unlimited)
+USE_PREFIX_CACHE = False # Reuse the system-prompt KV-cache (decodes one request at a time)
+USE_PROMPT_LOOKUP = False # Speculative decoding with drafts copied from the prompt (greedy-exact)
+USE_COMPILED_TEMPLATES = False # Build the prompts from pre-tokenized system prompts (transformers/cpu)
+TOKEN_BUDGET = None        # Padded prompt tokens per batch, length-bucketed (None = fixed-count batches)
+USE_INFERENCE_CACHE = True # Answer unchanged calls from the on-disk cache
+NEAR_DUP_THRESHOLD = None  # Reuse the records of near-duplicate requirements (Near_duplicates.py, None = off)
+BACKEND = "transformers"   # or "cpu" (int8, no GPU), "gguf" (llama.cpp), "http" (OpenAI-compatible server), "daemon"
+SERVER_URL = "http://localhost:8000/v1"
+HTTP_CONCURRENCY = 32      # Requests in flight with the http backend
+CPU_THREADS = None         # Threads of the cpu/gguf backends (None = all cores)
+CPU_BATCH_SIZE = 4         # Conversations decoded together by the cpu backend
+GGUF_PATH = 'models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf'
+TRACE = False              # Per-agent timings, tokens and parse failures (Instrumentation.py)
+TRACE_FILE = f'{STRATEGY}_trace.json'
+METRICS_FILE = f'{STRATEGY}_metrics.prom'  # Prometheus textfile
 
 def load_llama_model():
     '''
-    Load the LLaMA 3 model with 4-bit quantization for inference.
+    Load the inference backend (LLaMA 3 in 4-bit on GPU, int8 or GGUF on CPU, or an
+    OpenAI-compatible server) and wrap it with the enabled caches.
     '''
+    backend = load_backend(BACKEND, model_id=MODEL_ID, hf_token=HF_TOKEN, max_new_tokens=512,
+                           base_url=SERVER_URL, max_concurrency=HTTP_CONCURRENCY,
+                           threads=CPU_THREADS, batch_size=CPU_BATCH_SIZE, model_path=GGUF_PATH)
+
+    wrap = None
+    if EXECUTION_MODE == "async":
+        # In-process models get the concurrent calls merged into padded batches
+        wrap = partial(make_runner_pipe, coalesce=(BACKEND not in ("http", "daemon")),
+                       max_batch=BATCH_SIZE, rate=RATE_LIMIT)
+
+    return build_pipeline_stack(backend, "Single_agent_prompt", max_new_tokens=512,
+                                prefix_cache=USE_PREFIX_CACHE,
+                                prompt_lookup=USE_PROMPT_LOOKUP,
+                                compiled_templates=USE_COMPILED_TEMPLATES,
+                                token_budget=TOKEN_BUDGET,
+                                inference_cache=USE_INFERENCE_CACHE,
+                                wrap=wrap,
+                                agents={PROMPT_VARIANTS[STRATEGY]: "single"} if TRACE else None)
+
+def build_messages(text, strategy=STRATEGY, prompts=None):
+    '''
+    Build the chat messages for a requirement with the selected prompt variant
+    (`prompts` overrides PROMPT_VARIANTS, e.g. after a reload of the prompt module).
+    '''
+    prompts = prompts or PROMPT_VARIANTS
+    return [
+        {"role": "system", "content": prompts[strategy]},
+        {"role": "user", "content": text}
+    ]
 
-    print(f"Load the {MODEL_ID} in 4-bit...")
-
-    # 4-bit Quantization
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, token=HF_TOKEN)
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        quantization_config=bnb_config,
-        device_map="auto",
-        token=HF_TOKEN
-    )
-
-    text_pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        max_new_tokens=512,
-        #temperature=0.1,       # Low temperature for precision
-        do_sample=False,       # Deterministic
-        return_full_text=False
-    )
-
-    return text_pipe
+def parse_prediction(generated_text):
+    '''
+    Parse the raw model output into a dictionary (or an error record).
+    '''
+    with TRACER.span("parse", agent="single"):
+        # Generation stops at the closing brace: parse the first complete object
+        parsed = parse_first_json_object(generated_text)
+        if isinstance(parsed, dict):
+            return parsed
+
+        try:
+            clean_text = generated_text.replace("```json", "").replace("```", "").strip()
+            # Parsing JSON
+            return json.loads(clean_text)
+
+        except json.JSONDecodeError:
+            record_fallback(parse_failure=True)
+            return {"error": "Invalid JSON", "raw_output": generated_text}
+        except Exception as e:
+            record_fallback(parse_failure=True)
+            return {"error": str(e)}
+
+def record_fallback(parse_failure=False):
+    '''
+    Counts a requirement left without abstractions because its call or its parsing failed.
+    '''
+    TRACER.count("empty_fallbacks", agent="single")
+    if parse_failure:
+        TRACER.count("parse_failures", agent="single")
 
-def process_requirement(text, pipe):
+def process_requirement(text, pipe, strategy=STRATEGY, prompts=None):
     '''
     Process a single requirement text and return the extracted abstractions.
     '''
 
-    strategy = "one_shot" # or "few_shot", "zero_shot"
-    current_system_prompt = PROMPT_VARIANTS[strategy]
-    messages = [
-        {"role": "system", "content": current_system_prompt},
-        {"role": "user", "content": text}
-    ]
+    messages = build_messages(text, strategy, prompts)
 
     try:
         output = pipe(messages)
         generated_text = output[0]['generated_text']
+    except Exception as e:
+        record_fallback()
+        return {"error": str(e)}
+
+    return parse_prediction(generated_text)
 
-        clean_text = generated_text.replace("```json", "").replace("```", "").strip()
-        # Parsing JSON
-        return json.loads(clean_text)
+def process_requirements_batch(entries, pipe, strategy=STRATEGY, batch_size=BATCH_SIZE, prompts=None):
+    '''
+    Process a list of dataset entries through the pipeline in padded batches.
+    Returns a list of (id, prediction) pairs in input order, with errors captured per item.
+    '''
+    req_ids = [entry.get("id", "unknown") for entry in entries]
+    conversations = [build_messages(entry.get("Text", ""), strategy, prompts) for entry in entries]
 
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON", "raw_output": generated_text}
+    try:
+        outputs = pipe(conversations, batch_size=batch_size)
     except Exception as e:
-        return {"error": str(e)}
-    
+        for _ in req_ids:
+            record_fallback()
+        return [(req_id, {"error": str(e)}) for req_id in req_ids]
 
-# Load the model
-try:
-    pipe = load_llama_model()
-except Exception as e:
-    print(f"Error with Model Loading: {e}")
+    predictions = []
+    for req_id, output in zip(req_ids, outputs):
+        try:
+            predictions.append((req_id, parse_prediction(output[0]['generated_text'])))
+        except Exception as e:
+            predictions.append((req_id, {"error": str(e)}))
+
+    return predictions
+
+def build_record(req_id, req_text, prediction):
+    '''
+    Output record of a requirement (the first abstraction if the model returned a list).
+    '''
+    prediction_data = prediction
+    if "abstractions" in prediction and len(prediction["abstractions"]) > 0:
+      prediction_data = prediction["abstractions"][0]
+
+    # Drop contained spans, protect short numeric values (shared with MIA and SCAP)
+    return dedup_record({
+    "id": req_id,
+    "Text": req_text,
+    **prediction_data
+    })
+
+def requirement_task(entry, pipe, strategy=STRATEGY):
+    '''
+    Task function of the async runner: one dataset entry -> one output record.
+    '''
+    req_text = entry.get("Text", "")
+    return build_record(entry.get("id", "unknown"), req_text, process_requirement(req_text, pipe, strategy))
+    
 
-results = []
+def main():
+    if TRACE:
+        TRACER.enable(strategy=STRATEGY)
 
-with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-    dataset = json.load(f)
+    # Load the model
+    try:
+        pipe = load_llama_model()
+    except Exception as e:
+        print(f"Error with Model Loading: {e}")
+        return
+
+    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    # Skip the requirements already written by a previous (interrupted) run of the same
+    # strategy, prompts and requirement text
+    fingerprint = RunFingerprint(STRATEGY, "Single_agent_prompt")
+    expected = fingerprint.of_entries(dataset)
+    done_ids = load_done_ids(STREAM_FILE, expected)
+    pending = [entry for entry in dataset if entry.get("id", "unknown") not in done_ids]
+    print(f"Resuming: {len(done_ids)} done, {len(pending)} to process")
+
+    # Only the novel requirements go to the model, near-duplicates reuse their records
+    reuse = None
+    if NEAR_DUP_THRESHOLD is not None:
+        from Near_duplicates import ExtractionReuse  # numpy, only when turned on
+        reuse = ExtractionReuse(NEAR_DUP_THRESHOLD, read_run_records(STREAM_FILE, fingerprint))
+        pending, duplicates = reuse.split(pending)
+        print(f"Near-duplicates: {len(duplicates)} reused, {len(pending)} sent to the model")
+
+    # With length buckets, the chunks below hold requirements of similar length
+    pending = sort_by_length(pending, pipe)
 
     # Timer Start
     start_time = time.time()
 
-    # Process each requirement
-    for entry in tqdm(dataset):
-        req_text = entry.get("Text", "")
-        req_id = entry.get("id", "unknown")
-        prediction = process_requirement(req_text, pipe)
-
-        if "abstractions" in prediction and len(prediction["abstractions"]) > 0:
-          prediction_data = prediction["abstractions"][0]
-
-        results.append({
-        "id": req_id,
-        "Text": req_text,
-        **prediction_data
-        })
+    with JsonlResultWriter(STREAM_FILE, flush_every=FLUSH_EVERY, fingerprint=fingerprint) as stream:
+        writer = reuse.recording(stream) if reuse is not None else stream
+        if EXECUTION_MODE == "async":
+            # Many requirements in flight, records written as they finish
+            runner = AsyncRequirementRunner(partial(requirement_task, pipe=pipe, strategy=STRATEGY),
+                                            max_in_flight=MAX_IN_FLIGHT)
+            print(f"Async runner: {runner.run_sync(pending, writer)}")
+        else:
+            # Process the requirements in batches
+            for start in tqdm(range(0, len(pending), BATCH_SIZE)):
+                batch = pending[start:start + BATCH_SIZE]
+                predictions = process_requirements_batch(batch, pipe, STRATEGY, BATCH_SIZE)
+
+                for entry, (req_id, prediction) in zip(batch, predictions):
+                    writer.write(build_record(req_id, entry.get("Text", ""), prediction))
+
+        if reuse is not None:
+            reused, waiting = reuse.adapt(duplicates)
+            for _, record in reused:
+                writer.write(record)
+            if waiting:
+                print(f"Near-duplicates left for the next run (no record for their match): {len(waiting)}")
 
     #End Timer
     end_time = time.time()
     total_duration = end_time - start_time
 
-with open(OUTPUT_FILE, "w", encoding='utf-8') as f:
-    json.dump(results, f, indent=4)
+    # Compact the stream into the JSON array read by the evaluation
+    compact_jsonl(STREAM_FILE, OUTPUT_FILE, [entry.get("id", "unknown") for entry in dataset], expected)
+
+    print("-" * 30)
+    print(f"Total Time: {total_duration:.2f} seconds")
+    print(f"File saved in: {OUTPUT_FILE}")
+    for layer, stats in pipeline_stats(pipe).items():
+        print(f"{layer}: {stats}")
+    if reuse is not None:
+        print(f"Near-duplicates: {reuse.stats()}")
+    if TRACE:
+        TRACER.export(TRACE_FILE, METRICS_FILE)
+    print("-" * 30)
+
 
-print("-" * 30)
-print(f"Total Time: {total_duration:.2f} seconds")
-print(f"File saved in: {OUTPUT_FILE}")
-print("-" * 30)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
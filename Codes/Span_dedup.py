@@ -0,0 +1,134 @@
+## Span deduplication shared by all the pipelines (post-processing of every record).
+## A span is dropped when it is contained in another span of the same field, unless it is
+## an atomic value: a short string with a digit (e.g. '99%', '10x10', '5 seconds'), which
+## stays because the evaluation matches it on its own.
+## Containment is found with an Aho-Corasick automaton over the candidate spans: every
+## span is scanned once through the automaton, so a field costs about its total length
+## instead of the all-pairs `a in b` scan (quadratic in the number of spans). Below
+## AUTOMATON_MIN_SPANS the pairwise scan (in C) is still faster and is used instead.
+
+from collections import deque
+
+from Instrumentation import TRACER
+
+ATOMIC_MAX_CHARS = 12
+AUTOMATON_MIN_SPANS = 256  # Measured crossover of the two containment searches
+
+FIELDS = ["Main_actor", "Entity", "Action", "System_response",
+          "Condition", "Precondition", "Trigger", "Purpose"]
+
+
+class SpanAutomaton:
+    '''
+    Aho-Corasick automaton over a list of distinct, non-empty patterns.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.terminal = [-1]  # Index of the pattern ending at the node (-1 = none)
+
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                child = self.goto[node].get(char)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.terminal.append(-1)
+                    self.goto[node][char] = child
+                node = child
+            self.terminal[node] = index
+
+        # Failure links (longest proper suffix in the trie) and dictionary links
+        # (nearest terminal node on the failure chain), breadth first
+        self.fail = [0] * len(self.goto)
+        self.dict_link = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                target = self.goto[state].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                fail = self.fail[child]
+                self.dict_link[child] = fail if self.terminal[fail] >= 0 else self.dict_link[fail]
+
+    def contained(self):
+        '''
+        For every pattern, whether it occurs inside another pattern.
+        '''
+        marked = [False] * len(self.patterns)
+        for index, text in enumerate(self.patterns):
+            node = 0
+            for char in text:
+                while node and char not in self.goto[node]:
+                    node = self.fail[node]
+                node = self.goto[node].get(char, 0)
+
+                hit = node if self.terminal[node] >= 0 else self.dict_link[node]
+                while hit:
+                    pattern = self.terminal[hit]
+                    if pattern != index:
+                        # The suffixes of a marked pattern were marked with it
+                        if marked[pattern]:
+                            break
+                        marked[pattern] = True
+                    hit = self.dict_link[hit]
+        return marked
+
+
+def contained_pairwise(spans):
+    '''
+    Same result as SpanAutomaton(spans).contained(), comparing each span with the longer ones.
+    '''
+    order = sorted(range(len(spans)), key=lambda i: len(spans[i]), reverse=True)
+    marked = [False] * len(spans)
+    for position, index in enumerate(order):
+        span = spans[index]
+        marked[index] = any(span in spans[other] for other in order[:position]
+                            if len(spans[other]) > len(span))
+    return marked
+
+
+def is_atomic(span, max_chars=ATOMIC_MAX_CHARS):
+    '''
+    Short values with a digit (percentages, sizes, durations) are kept even when contained.
+    '''
+    span = span.strip()
+    return len(span) <= max_chars and any(char.isdigit() for char in span)
+
+
+def dedup_spans(spans, atomic_max_chars=ATOMIC_MAX_CHARS):
+    '''
+    Removes the duplicates and the spans contained in a longer span, except atomic values.
+    Returns the remaining spans longest first (ties in their original order); values that
+    are not strings are kept as they are.
+    '''
+    if not spans:
+        return []
+
+    unique = list(dict.fromkeys(s for s in spans if isinstance(s, str) and s))
+    others = [s for s in spans if not isinstance(s, str)]
+
+    if len(unique) >= AUTOMATON_MIN_SPANS:
+        inside = SpanAutomaton(unique).contained()
+    else:
+        inside = contained_pairwise(unique)
+    kept = [span for span, contained in zip(unique, inside)
+            if not contained or is_atomic(span, atomic_max_chars)]
+    return sorted(kept, key=len, reverse=True) + others
+
+
+def dedup_record(record, fields=FIELDS):
+    '''
+    Applies dedup_spans to the list fields of an output record (in place).
+    '''
+    with TRACER.span("dedup", agent="dedup"):
+        for field in fields:
+            if isinstance(record.get(field), list):
+                record[field] = dedup_spans(record[field])
+    return record
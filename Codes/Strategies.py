@@ -0,0 +1,148 @@
+## The extraction strategies behind a common interface, for the tools that serve several
+## of them from one loaded model (the daemon and the multi-strategy runner).
+## Each strategy maps a list of dataset entries to output records in the format of its
+## script, reusing the script functions. Prompts come from a PromptRegistry, so edited
+## prompt modules are picked up without restarting.
+
+import importlib
+import os
+import threading
+import types
+
+import Single_agent
+import Multi_agent_3
+import Multi_agent_8
+from Mia_gating import MiaGate, training_files_for
+
+# Name of the prompt constant of each SCAP agent in Multi_agent_3prompt
+SCAP_PROMPT_NAMES = {
+    "entity": "AGENT_ENTITY_PROMPT",
+    "action": "AGENT_ACTION_PROMPT",
+    "logic": "AGENT_LOGIC_PROMPT",
+}
+
+
+class PromptRegistry:
+    '''
+    Prompt modules, reloaded from disk when their file has changed since the last use.
+    get() returns a snapshot of the module's names taken under `lock` (shared with the
+    daemon's other state), so a reload from another thread never hands out a
+    half-updated module.
+    '''
+
+    def __init__(self, lock=None):
+        self.lock = lock or threading.Lock()
+        self.mtimes = {}
+        self.snapshots = {}
+
+    def _load(self, module_name, reload=False):
+        module = importlib.import_module(module_name)
+        if reload:
+            module = importlib.reload(module)
+        self.mtimes[module_name] = os.path.getmtime(module.__file__)
+        self.snapshots[module_name] = types.SimpleNamespace(**vars(module))
+
+    def get(self, module_name):
+        with self.lock:
+            module = importlib.import_module(module_name)
+            mtime = os.path.getmtime(module.__file__)
+            if module_name not in self.snapshots:
+                self._load(module_name)
+            elif mtime != self.mtimes[module_name]:
+                self._load(module_name, reload=True)
+                print(f"Reloaded prompt module {module_name}")
+            return self.snapshots[module_name]
+
+    def reload_all(self):
+        with self.lock:
+            for module_name in list(self.snapshots):
+                self._load(module_name, reload=True)
+            return list(self.snapshots)
+
+
+def single_agent_labels(strategy):
+    def labels(prompts):
+        return {prompts.PROMPT_VARIANTS[strategy]: "single"}
+    return labels
+
+
+def scap_labels(prompts):
+    return {getattr(prompts, prompt_name): name for name, prompt_name in SCAP_PROMPT_NAMES.items()}
+
+
+def mia_labels(prompts):
+    return {prompt: field for field, prompt in prompts.AGENT_PROMPTS.items()}
+
+
+def run_single_agent(strategy):
+    def run(entries, pipe, prompts):
+        predictions = Single_agent.process_requirements_batch(
+            entries, pipe, strategy, batch_size=max(1, len(entries)), prompts=prompts.PROMPT_VARIANTS)
+        return [Single_agent.build_record(req_id, entry.get("Text", ""), prediction)
+                for entry, (req_id, prediction) in zip(entries, predictions)]
+    return run
+
+
+def run_scap(entries, pipe, prompts):
+    agents = {name: {**agent, "prompt": getattr(prompts, SCAP_PROMPT_NAMES[name])}
+              for name, agent in Multi_agent_3.SCAP_AGENTS.items()}
+    return Multi_agent_3.run_scap_waves(entries, pipe, agents)
+
+
+def run_mia(entries, pipe, prompts, gate=None):
+    texts = [entry.get("Text", "") for entry in entries]
+    extractions = Multi_agent_8.process_multi_agent_batch(texts, pipe, prompts.AGENT_PROMPTS, gate)
+    return [{"id": entry.get("id", "unknown"), "Text": entry.get("Text", ""), **extraction}
+            for entry, extraction in zip(entries, extractions)]
+
+
+_gate_lock = threading.Lock()
+_mia_gates = {}  # training files -> MiaGate
+
+
+def gating_training_files(input_file=None, training_file=None):
+    '''
+    The labelled datasets the mia_gated gate of a job over `input_file` trains on: the
+    labelled datasets of the repo, the input (when labelled) and `training_file` if given.
+    The gates are cross-fitted, so the requirements of these files are never gated with
+    their own labels.
+    '''
+    paths = training_files_for(input_file)
+    if training_file is not None and os.path.abspath(training_file) not in map(os.path.abspath, paths):
+        paths.append(training_file)
+    return tuple(paths)
+
+
+def mia_gate(training_files):
+    '''
+    The MIA gate trained on `training_files` (on first use) with the settings of Multi_agent_8.py.
+    '''
+    with _gate_lock:
+        if training_files not in _mia_gates:
+            _mia_gates[training_files] = MiaGate.from_files(training_files,
+                                                            recall=Multi_agent_8.GATING_RECALL,
+                                                            min_recall=Multi_agent_8.GATING_MIN_RECALL,
+                                                            z=Multi_agent_8.GATING_CONFIDENCE_Z)
+        return _mia_gates[training_files]
+
+
+# "agents" maps the loaded prompt module to {system prompt: agent name} (instrumentation labels).
+# "gated" strategies get the gate of their job (mia_gate(gating_training_files(...))) as `gate`.
+# "output_file" is the name the scripts write and the evaluation (POTENTIAL_MODELS) reads.
+STRATEGIES = {
+    "zero_shot": {"prompt_module": "Single_agent_prompt", "run": run_single_agent("zero_shot"),
+                  "agents": single_agent_labels("zero_shot"),
+                  "max_new_tokens": 512, "output_file": "zero_shot_predictions.json"},
+    "one_shot":  {"prompt_module": "Single_agent_prompt", "run": run_single_agent("one_shot"),
+                  "agents": single_agent_labels("one_shot"),
+                  "max_new_tokens": 512, "output_file": "one_shot_predictions.json"},
+    "few_shot":  {"prompt_module": "Single_agent_prompt", "run": run_single_agent("few_shot"),
+                  "agents": single_agent_labels("few_shot"),
+                  "max_new_tokens": 512, "output_file": "few_shot_predictions.json"},
+    "scap":      {"prompt_module": "Multi_agent_3prompt", "run": run_scap, "agents": scap_labels,
+                  "max_new_tokens": 1024, "output_file": Multi_agent_3.OUTPUT_FILE},
+    "mia":       {"prompt_module": "Multi_agent_8prompt", "run": run_mia, "agents": mia_labels,
+                  "max_new_tokens": 512, "output_file": Multi_agent_8.OUTPUT_FILE},
+    "mia_gated": {"prompt_module": "Multi_agent_8prompt", "run": run_mia, "agents": mia_labels,
+                  "gated": True, "max_new_tokens": 512, "output_file": "multi_agent_predictions_8_gated.json"},
+}
@@ -0,0 +1,118 @@
+## Minimal OpenAI-compatible server for testing the http backend without a GPU.
+## Answers /v1/chat/completions with an empty extraction after a configurable delay, and
+## can fail a fraction of the requests (HTTP 503) to exercise the retry/backoff path.
+## The first `fail_first` requests answer 503 and the next `drop_first` ones close the
+## connection without an answer; the handler class counts the requests and the peak of
+## requests in flight (server.RequestHandlerClass).
+## Usage: python Stub_server.py --port 8000 --latency 0.2 --fail-rate 0.1
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMPTY_ANSWER = json.dumps({
+    "Main_actor": [], "Entity": [], "Action": [], "System_response": [],
+    "Condition": [], "Precondition": [], "Trigger": [], "Purpose": []
+})
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail_rate = 0.0
+    fail_first = 0
+    drop_first = 0
+    answer = staticmethod(lambda messages: EMPTY_ANSWER)
+    lock = threading.Lock()
+    requests = 0
+    in_flight = 0
+    peak_in_flight = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, {"error": "not found"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+            number = cls.requests
+            cls.in_flight += 1
+            cls.peak_in_flight = max(cls.peak_in_flight, cls.in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+        if number <= self.fail_first or random.random() < self.fail_rate:
+            self._send(503, {"error": "overloaded"})
+            return
+        if number <= self.fail_first + self.drop_first:
+            self.close_connection = True
+            return
+
+        content = self.answer(request.get("messages", []))
+        self._send(200, {
+            "id": "stub",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+        })
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Accept bursts of concurrent connections
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up (timeouts) close the connection before the answer
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_stub_server(port=0, latency=0.0, fail_rate=0.0, answer=None, fail_first=0, drop_first=0):
+    '''
+    Starts the server in a background thread; returns (server, base_url).
+    '''
+    handler = type("Handler", (StubHandler,), {
+        "latency": latency, "fail_rate": fail_rate, "fail_first": fail_first, "drop_first": drop_first,
+        "lock": threading.Lock(), "requests": 0, "in_flight": 0, "peak_in_flight": 0})
+    if answer is not None:
+        handler.answer = staticmethod(answer)
+    server = StubServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of HTTP 503 answers")
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args.port, args.latency, args.fail_rate)
+    print(f"Stub server listening on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,81 @@
+## Tiny Llama-architecture model with random weights for running the pipelines on CPU.
+## The answers are meaningless (the parsers turn them into empty extractions), but every
+## step - chat template, batching, stopping criteria, caches, writers - runs exactly as
+## with the real model, in seconds and without a GPU or a Hugging Face token.
+## Usage: python Codes/Tiny_model.py --out tiny_model, then BACKEND = "cpu" and
+## MODEL_ID = "tiny_model" in a script.
+
+import argparse
+import string
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<pad>", "<|begin_of_text|>", "<|eot_id|>", "<|start_header_id|>", "<|end_header_id|>"]
+
+# Same layout as the Llama 3 instruct template
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for m in messages %}"
+    "<|start_header_id|>{{ m['role'] }}<|end_header_id|>\n\n{{ m['content'] }}<|eot_id|>"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+
+
+def build_tiny_tokenizer():
+    '''
+    Character-level tokenizer (printable ASCII) with the Llama 3 special tokens.
+    '''
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + list(string.printable))}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token=" "))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|eot_id|>",
+        pad_token="<pad>",
+        additional_special_tokens=SPECIAL_TOKENS[3:])
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_tiny_model(hidden_size=64, num_layers=2, seed=0):
+    '''
+    Returns (model, tokenizer) with random weights.
+    '''
+    tokenizer = build_tiny_tokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id)
+
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config).eval()
+    return model, tokenizer
+
+
+def save_tiny_model(path="tiny_model", **kwargs):
+    model, tokenizer = build_tiny_model(**kwargs)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save a tiny random Llama model for CPU tests")
+    parser.add_argument("--out", default="tiny_model")
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"Tiny model saved in: {save_tiny_model(args.out, hidden_size=args.hidden_size, num_layers=args.layers)}")
@@ -0,0 +1,30 @@
+## Shared fixtures of the tests: the modules of Codes/ on the import path and a tiny
+## random Llama model (Tiny_model.py) saved once per session, so the reference-vs-optimized
+## checks run on CPU in seconds.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Codes"))
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    from Tiny_model import save_tiny_model
+    return save_tiny_model(str(tmp_path_factory.mktemp("tiny_model")))
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    from Tiny_model import build_tiny_model
+    model, tokenizer = build_tiny_model()
+    tokenizer.padding_side = "left"
+    return model, tokenizer
+
+
+@pytest.fixture(scope="session")
+def cpu_backend(tiny_model_dir):
+    from Backends import CpuBackend
+    return CpuBackend(tiny_model_dir, max_new_tokens=24, quantize=False, batch_size=4)
@@ -0,0 +1,260 @@
+## Concurrency layers of the async runner (Async_runner.py) with fake pipes and a fake
+## clock: the token-bucket rate, the per-stage limits of StagePipe, the batches of
+## CallBatcher and the in-flight bound and backpressure of AsyncRequirementRunner.
+
+import threading
+import time
+
+import pytest
+
+import Async_runner
+from Async_runner import AsyncRequirementRunner, CallBatcher, StagePipe, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def conversation(text, system="Extract."):
+    return [{"role": "system", "content": system}, {"role": "user", "content": text}]
+
+
+def echo(conversations):
+    return [[{"generated_text": messages[-1]["content"]}] for messages in conversations]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(Async_runner, "time", clock)
+    return clock
+
+
+def test_token_bucket_rate(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.now == 0  # The burst is free
+    bucket.acquire()
+    assert clock.now == pytest.approx(0.5)
+    for _ in range(10):
+        bucket.acquire()
+    assert clock.now == pytest.approx(0.5 + 10 / 2)
+
+
+def test_token_bucket_charges_oversized_batches(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    bucket.acquire(6)  # Larger than the bucket: waits for a full bucket, then owes 4 tokens
+    assert clock.now == 0
+    bucket.acquire()
+    assert clock.now == pytest.approx((1 + 4) / 2)
+    # The debt is paid by the next call: over time, the rate holds
+    bucket.acquire(8)
+    bucket.acquire()
+    assert clock.now == pytest.approx((6 + 1 + 8 + 1 - 2) / 2)
+
+
+class BlockingStagePipe:
+    '''
+    Fake pipe whose calls wait for `release`, counting the calls in flight per stage.
+    '''
+
+    def __init__(self, stage_of):
+        self.stage_of = stage_of
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.peak = {}
+        self.batch_sizes = []
+
+    def __call__(self, conversations, **gen_kwargs):
+        stage = self.stage_of[conversations[0][0]["content"]]
+        with self.lock:
+            self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+            self.peak[stage] = max(self.peak.get(stage, 0), self.in_flight[stage])
+            self.batch_sizes.append(gen_kwargs.get("batch_size"))
+        self.release.wait(5)
+        with self.lock:
+            self.in_flight[stage] -= 1
+        return echo(conversations)
+
+
+def test_stage_pipe_limits_each_stage():
+    stages = {"Entity prompt": "entity", "Action prompt": "action"}
+    fake = BlockingStagePipe(stages)
+    pipe = StagePipe(fake, stages, stage_limits={"entity": 2, "action": 1})
+
+    outputs = {}
+    threads = [threading.Thread(target=lambda k=k, prompt=prompt: outputs.__setitem__(
+                   (prompt, k), pipe([conversation(str(k), prompt)])))
+               for prompt in stages for k in range(5)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: fake.in_flight == {"entity": 2, "action": 1})
+    time.sleep(0.05)  # No other call gets in while the slots are taken
+    assert fake.in_flight == {"entity": 2, "action": 1}
+    fake.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert fake.peak == {"entity": 2, "action": 1}
+    assert outputs[("Action prompt", 3)] == [[{"generated_text": "3"}]]
+    assert pipe.stats() == {"calls_per_stage": {"entity": 5, "action": 5}}
+
+
+def test_stage_pipe_splits_mixed_batches_and_charges_them_in_full():
+    stages = {"Entity prompt": "entity", "Action prompt": "action"}
+    fake = BlockingStagePipe(stages)
+    fake.release.set()
+    charged = []
+    limiter = type("Limiter", (), {"acquire": lambda self, tokens=1: charged.append(tokens)})()
+    pipe = StagePipe(fake, stages, default_limit=1, rate_limiter=limiter)
+
+    batch = [conversation(str(k), "Entity prompt" if k % 3 else "Action prompt") for k in range(9)]
+    outputs = pipe(batch, batch_size=9)
+
+    assert outputs == echo(batch)  # In the order of the call
+    assert sorted(charged) == [3, 6]
+    assert sorted(fake.batch_sizes) == [3, 6]  # Each sub-batch is decoded as one batch
+
+
+class RecordingPipe:
+
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.fail_on = fail_on
+
+    def __call__(self, conversations, **gen_kwargs):
+        self.batches.append(([messages[-1]["content"] for messages in conversations], gen_kwargs))
+        if self.fail_on in self.batches[-1][0]:
+            raise RuntimeError("model failure")
+        return echo(conversations)
+
+
+def call_from_threads(pipe, calls):
+    '''
+    Runs pipe(*args, **kwargs) for each (args, kwargs) of `calls` in its own thread.
+    '''
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def run(i, args, kwargs):
+        try:
+            results[i] = pipe(*args, **kwargs)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i, args, kwargs)) for i, (args, kwargs) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_call_batcher_merges_concurrent_calls():
+    recording = RecordingPipe()
+    # A long wait: the batches only leave full
+    batcher = CallBatcher(recording, max_batch=4, max_wait=10)
+    results, errors = call_from_threads(batcher, [((conversation(str(k)),), {}) for k in range(8)])
+
+    assert errors == [None] * 8
+    assert results == [[{"generated_text": str(k)}] for k in range(8)]
+    assert [len(contents) for contents, _ in recording.batches] == [4, 4]
+    assert all(kwargs["batch_size"] == 4 for _, kwargs in recording.batches)
+    assert batcher.stats() == {"batches": 2, "conversations": 8, "mean_batch_size": 4.0}
+
+
+def test_call_batcher_keeps_generation_settings_apart():
+    recording = RecordingPipe()
+    batcher = CallBatcher(recording, max_batch=4, max_wait=0.05)
+    calls = [(([conversation(f"{t}-{k}") for k in range(2)],), {"temperature": t, "batch_size": 2})
+             for t in (0.1, 0.7)]
+    results, errors = call_from_threads(batcher, calls)
+
+    assert errors == [None, None]
+    assert results[1] == [[{"generated_text": "0.7-0"}], [{"generated_text": "0.7-1"}]]
+    for contents, kwargs in recording.batches:
+        assert {content.split("-")[0] for content in contents} == {str(kwargs["temperature"])}
+
+
+def test_call_batcher_reports_errors_to_every_caller_of_the_batch():
+    batcher = CallBatcher(RecordingPipe(fail_on="1"), max_batch=2, max_wait=10)
+    _, errors = call_from_threads(batcher, [((conversation(str(k)),), {}) for k in range(2)])
+    assert all(isinstance(error, RuntimeError) for error in errors)
+
+
+class ListWriter:
+
+    def __init__(self, release=None):
+        self.records = []
+        self.release = release
+
+    def write(self, record):
+        if self.release is not None:
+            self.release.wait(5)
+        self.records.append(record)
+
+
+def test_runner_bounds_the_requirements_in_flight():
+    lock = threading.Lock()
+    state = {"in_flight": 0, "peak": 0}
+    all_in = threading.Event()
+
+    def task(entry):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+            if state["in_flight"] == 3:
+                all_in.set()
+        all_in.wait(5)
+        with lock:
+            state["in_flight"] -= 1
+        if entry["id"] == 7:
+            raise ValueError("bad answer")
+        return {"id": entry["id"]}
+
+    writer = ListWriter()
+    runner = AsyncRequirementRunner(task, max_in_flight=3, progress=False)
+    stats = runner.run_sync([{"id": k} for k in range(20)], writer)
+
+    assert state["peak"] == 3
+    assert sorted(record["id"] for record in writer.records) == [k for k in range(20) if k != 7]
+    assert stats["completed"] == 19 and stats["failed"] == 1
+
+
+def test_runner_backpressure_stops_new_requirements():
+    started = []
+    release = threading.Event()
+    writer = ListWriter(release)
+    runner = AsyncRequirementRunner(lambda entry: started.append(entry["id"]) or {"id": entry["id"]},
+                                    max_in_flight=2, queue_size=2, progress=False)
+
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(runner.run_sync([{"id": k} for k in range(20)], writer)))
+    thread.start()
+    # One record in the (blocked) writer, two in the queue, one waiting in each worker
+    wait_until(lambda: len(started) == 5)
+    time.sleep(0.05)
+    assert len(started) == 5
+    release.set()
+    thread.join(5)
+
+    assert sorted(record["id"] for record in writer.records) == list(range(20))
+    assert result["completed"] == 20
+    assert result["max_queue_depth"] <= 2
@@ -0,0 +1,95 @@
+## AsyncHttpBackend (Backends.py) against the stub server (Stub_server.py): retries with
+## backoff on 503 answers and dropped connections, the max_concurrency bound (peak of the
+## requests in flight on the server), timeouts and the order of the outputs.
+
+import asyncio
+import random
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from Backends import AsyncHttpBackend
+from Stub_server import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    servers, backends = [], []
+
+    def start(backend_options=None, **server_options):
+        server, url = start_stub_server(**server_options)
+        servers.append(server)
+        backend = AsyncHttpBackend(url, model_id="stub", **{"backoff": 0.01, **(backend_options or {})})
+        backends.append(backend)
+        return server.RequestHandlerClass, backend
+
+    yield start
+    for backend in backends:
+        backend.close()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def conversation(text):
+    return [{"role": "user", "content": text}]
+
+
+def echo(messages):
+    return messages[-1]["content"]
+
+
+def test_retries_server_errors_with_backoff(stub):
+    handler, backend = stub(fail_first=3, answer=echo)
+    start = time.perf_counter()
+    assert backend.generate_batch([conversation("a")]) == ["a"]
+    assert handler.requests == 4
+    # Backoff of attempt k: at least backoff * 2^k
+    assert time.perf_counter() - start >= 0.01 * (1 + 2 + 4)
+
+
+def test_retries_dropped_connections(stub):
+    handler, backend = stub(drop_first=2, answer=echo)
+    assert backend.generate_batch([conversation("a")]) == ["a"]
+    assert handler.requests == 3
+
+
+def test_gives_up_after_max_retries(stub):
+    handler, backend = stub({"max_retries": 2}, fail_first=10)
+    with pytest.raises(RuntimeError, match="HTTP 503"):
+        backend.generate_batch([conversation("a")])
+    assert handler.requests == 3
+
+
+def test_timeout_is_retried_then_raised(stub):
+    handler, backend = stub({"timeout": 0.1, "max_retries": 1}, latency=0.5)
+    start = time.perf_counter()
+    with pytest.raises(asyncio.TimeoutError):
+        backend.generate_batch([conversation("a")])
+    assert handler.requests == 2
+    assert time.perf_counter() - start < 1.0
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 4])
+def test_max_concurrency_bounds_the_requests_in_flight(stub, max_concurrency):
+    handler, backend = stub({"max_concurrency": max_concurrency}, latency=0.02)
+    backend.generate_batch([conversation(str(i)) for i in range(24)])
+    assert handler.requests == 24
+    assert handler.peak_in_flight == max_concurrency
+
+
+def test_outputs_follow_the_request_order(stub):
+    rng = random.Random(0)
+    delays = {str(i): rng.uniform(0, 0.03) for i in range(32)}
+
+    def slow_echo(messages):
+        time.sleep(delays[messages[-1]["content"]])
+        return messages[-1]["content"]
+
+    _, backend = stub({"max_concurrency": 8}, answer=slow_echo)
+    conversations = [conversation(str(i)) for i in range(32)]
+    texts, usage = backend.generate_with_usage(conversations)
+    assert texts == [str(i) for i in range(32)]
+    assert usage == [(None, None)] * 32  # The stub sends no "usage"
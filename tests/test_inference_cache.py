@@ -0,0 +1,110 @@
+## Inference cache (Inference_cache.py): hits after misses, the parts of a call the key
+## depends on (and batch_size, which it ignores), and the LRU eviction under the size cap.
+
+import time
+
+import pytest
+
+from Inference_cache import CachedPipeline, InferenceCache, prompt_module_version
+
+
+class CountingPipe:
+
+    def __init__(self):
+        self.conversations = []
+
+    def __call__(self, inputs, **gen_kwargs):
+        self.conversations.extend(inputs)
+        return [[{"generated_text": f"answer to {messages[-1]['content']}"}] for messages in inputs]
+
+
+def conversation(text, system="Extract."):
+    return [{"role": "system", "content": system}, {"role": "user", "content": text}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = InferenceCache(str(tmp_path / "cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+def cached(cache, model_id="model", prompt_version="v1", **default_gen_kwargs):
+    pipe = CountingPipe()
+    return pipe, CachedPipeline(pipe, cache, model_id, prompt_version=prompt_version,
+                                **{"max_new_tokens": 64, **default_gen_kwargs})
+
+
+def test_hit_after_miss(cache):
+    pipe, cached_pipe = cached(cache)
+    first = cached_pipe([conversation("a"), conversation("b")])
+    second = cached_pipe([conversation("b"), conversation("a"), conversation("c")])
+
+    assert first == [[{"generated_text": "answer to a"}], [{"generated_text": "answer to b"}]]
+    assert second[:2] == first[::-1]
+    assert pipe.conversations == [conversation("a"), conversation("b"), conversation("c")]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 3
+    # A single conversation is answered like the pipeline does
+    assert cached_pipe(conversation("a")) == [{"generated_text": "answer to a"}]
+
+
+def test_key_changes_with_the_call():
+    base = dict(model_id="model", quantization=None, gen_kwargs={"max_new_tokens": 64},
+                messages=conversation("a"), prompt_version="v1")
+    key = InferenceCache.make_key(**base)
+    for change in [{"messages": conversation("a", system="Extract the actors.")},
+                   {"messages": conversation("b")},
+                   {"prompt_version": "v2"},
+                   {"model_id": "other"},
+                   {"quantization": {"load_in_8bit": True}},
+                   {"gen_kwargs": {"max_new_tokens": 128}},
+                   {"gen_kwargs": {"max_new_tokens": 64, "do_sample": True}}]:
+        assert InferenceCache.make_key(**{**base, **change}) != key
+    assert InferenceCache.make_key(**base) == key
+
+
+def test_stopping_and_model_are_part_of_the_key(cache):
+    pipe, plain = cached(cache, stopping=None)
+    plain([conversation("a")])
+    _, stopped = cached(cache, stopping="json_object")
+    stopped([conversation("a")])
+    _, other_model = cached(cache, model_id="other", stopping=None)
+    other_model([conversation("a")])
+    _, other_prompts = cached(cache, prompt_version="v2", stopping=None)
+    other_prompts([conversation("a")])
+    assert cache.stats()["misses"] == 4 and cache.stats()["hits"] == 0
+
+
+def test_batch_size_is_not_part_of_the_key(cache):
+    pipe, cached_pipe = cached(cache)
+    cached_pipe([conversation("a")], batch_size=1)
+    cached_pipe([conversation("a")], batch_size=8)
+    cached_pipe([conversation("a")])
+    assert len(pipe.conversations) == 1
+    assert cache.stats()["hits"] == 2
+
+
+def test_lru_eviction(tmp_path):
+    cache = InferenceCache(str(tmp_path / "cache.sqlite"), max_size_mb=1)
+    value = "x" * (300 * 1024)  # Three values fit under 1 MB, not four
+    try:
+        for key in ["a", "b", "c"]:
+            cache.put(key, value)
+            time.sleep(0.01)  # Distinct access times
+        assert cache.get("a") == value  # "a" is now more recent than "b"
+        time.sleep(0.01)
+        cache.put("d", value)
+        assert cache.get("b") is None
+        assert all(cache.get(key) == value for key in ["a", "c", "d"])
+        assert cache.stats()["entries"] == 3
+    finally:
+        cache.close()
+
+
+def test_prompt_module_version_follows_the_file(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "Edited_prompt.py").write_text("PROMPT = 'a'\n")
+    version = prompt_module_version("Edited_prompt")
+    assert version == prompt_module_version("Edited_prompt")
+    (tmp_path / "Edited_prompt.py").write_text("PROMPT = 'b'\n")
+    assert prompt_module_version("Edited_prompt") != version
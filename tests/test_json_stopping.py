@@ -0,0 +1,97 @@
+## JSON early stopping (Json_stopping.py) against json.JSONDecoder.raw_decode: the parser
+## on random objects with braces, quotes and escapes inside strings, and the stopping
+## criteria inside a real padded, batched generate() of the tiny model.
+
+import json
+import random
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+from Json_stopping import json_stopping_criteria, parse_first_json_object
+
+
+def reference_first_object(text):
+    start = text.find("{")
+    if start == -1:
+        return None, None
+    try:
+        value, end = json.JSONDecoder().raw_decode(text, start)
+    except json.JSONDecodeError:
+        return None, None
+    return value, end
+
+
+def random_value(rng, depth=0):
+    kind = rng.choice(["str", "num", "list", "obj"] if depth < 3 else ["str", "num"])
+    if kind == "str":
+        return "".join(rng.choice('ab{}[]"\\: ,') for _ in range(rng.randint(0, 6)))
+    if kind == "num":
+        return rng.randint(-5, 500)
+    if kind == "list":
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+    return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randint(0, 3))}
+
+
+def test_parse_first_json_object_matches_raw_decode():
+    rng = random.Random(0)
+    for _ in range(3000):
+        obj = {f"f{i}": random_value(rng) for i in range(rng.randint(0, 4))}
+        text = (rng.choice(["", "Sure: ", "```json\n", "text } \" "]) + json.dumps(obj)
+                + rng.choice(["", "\n```", " and {\"second\": 1}", "}}"]))
+        assert parse_first_json_object(text) == reference_first_object(text)[0] == obj
+
+
+class ScriptedLogits(LogitsProcessor):
+    '''
+    Forces row r to generate the tokens of scripts[r], then EOS.
+    '''
+
+    def __init__(self, scripts, prompt_len, eos_id):
+        self.scripts = scripts
+        self.prompt_len = prompt_len
+        self.eos_id = eos_id
+
+    def __call__(self, input_ids, scores):
+        step = input_ids.shape[1] - self.prompt_len
+        forced = torch.full_like(scores, -float("inf"))
+        for row, script in enumerate(self.scripts):
+            forced[row, script[step] if step < len(script) else self.eos_id] = 0
+        return forced
+
+
+def generate_scripted(model, tokenizer, prompts, texts, stopping):
+    encoded = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+    scripts = [tokenizer(text, add_special_tokens=False).input_ids for text in texts]
+    width = encoded.input_ids.shape[1]
+    with torch.no_grad():
+        output_ids = model.generate(**encoded, max_new_tokens=max(len(s) for s in scripts) + 2,
+                                    do_sample=False, pad_token_id=tokenizer.pad_token_id,
+                                    stopping_criteria=stopping,
+                                    logits_processor=LogitsProcessorList(
+                                        [ScriptedLogits(scripts, width, tokenizer.eos_token_id)]))
+    return tokenizer.batch_decode(output_ids[:, width:], skip_special_tokens=True)
+
+
+def expected_output(text):
+    _, end = reference_first_object(text)
+    return text if end is None else text[:end]
+
+
+def test_batched_generation_stops_at_the_closing_brace(tiny_model):
+    model, tokenizer = tiny_model
+    stopping = json_stopping_criteria(tokenizer)
+    texts = [
+        'Sure: {"a": ["x}"], "b": {"c": 1}} trailing {"d": 2}',
+        '{"q": "esc \\" }"} more text after the object',
+        'no json object in this answer',
+        '{"nested": {"deep": {"x": []}}}\n```',
+    ]
+    prompts = ["short", "a much longer prompt of the batch", "p", "medium prompt"]
+
+    outputs = generate_scripted(model, tokenizer, prompts, texts, stopping)
+    assert outputs == [expected_output(text) for text in texts]
+
+    # The same criteria object, reused by the next generate() call
+    outputs = generate_scripted(model, tokenizer, prompts[:2], ['{"x": 1} tail', 'x {"y": "}"} z'], stopping)
+    assert outputs == ['{"x": 1}', 'x {"y": "}"}']
@@ -0,0 +1,89 @@
+## Length-bucketed scheduling (Length_scheduler.py): every conversation is run exactly
+## once, batches respect the buckets and the token budget, and the outputs come back in
+## the order of the call (checked against the unscheduled pipe, fake backend).
+
+import random
+
+import pytest
+
+from Backends import FakeBackend, approx_tokens
+from Length_scheduler import BUCKET_BOUNDARIES, LengthBucketedPipe, bucket_of, plan_batches, sort_by_length
+
+
+class RecordingPipe:
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.calls = []
+
+    def __call__(self, inputs, **gen_kwargs):
+        self.calls.append(list(inputs))
+        return self.pipe(inputs, **gen_kwargs)
+
+
+def length(messages):
+    return sum(approx_tokens(m["content"]) for m in messages)
+
+
+def random_conversations(rng, count):
+    conversations = []
+    for k in range(count):
+        words = " ".join(f"w{k}x{i}" for i in range(rng.choice([3, 20, 200, 900, 2500])))
+        conversations.append([{"role": "system", "content": "Extract."}, {"role": "user", "content": words}])
+    return conversations
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_plan_batches_covers_every_index_within_budget(seed):
+    rng = random.Random(seed)
+    lengths = [rng.randint(1, 6000) for _ in range(rng.randint(1, 200))]
+    budget = rng.choice([512, 4096, 16384])
+    batches = plan_batches(lengths, budget, max_batch=8)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= 8
+        assert len({bucket_of(lengths[i], BUCKET_BOUNDARIES) for i in batch}) == 1
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= budget
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_outputs_come_back_in_call_order(seed):
+    rng = random.Random(seed)
+    conversations = random_conversations(rng, 40)
+    backend = FakeBackend(token_latency=0, prefill_latency=0)
+    recording = RecordingPipe(backend)
+    scheduled = LengthBucketedPipe(recording, length, token_budget=8192, max_batch=6)
+
+    assert scheduled(conversations, batch_size=6) == backend(conversations)
+    # The batches are not the arrival-order ones
+    assert recording.calls != [conversations[i:i + 6] for i in range(0, len(conversations), 6)]
+    assert sum(len(call) for call in recording.calls) == len(conversations)
+    stats = scheduled.stats.as_dict()
+    assert stats["padding_efficiency"] >= stats["unbucketed_efficiency"]
+
+    # A single conversation goes straight through
+    assert scheduled(conversations[0]) == backend(conversations[0])
+
+
+def test_sorted_pending_chunks_pad_less():
+    rng = random.Random(0)
+    entries = [{"id": k, "Text": conversation[1]["content"]}
+               for k, conversation in enumerate(random_conversations(rng, 48))]
+    backend = FakeBackend(token_latency=0, prefill_latency=0)
+    # The scheduler is found below the outer layers of the stack
+    stack = RecordingPipe(LengthBucketedPipe(backend, length, token_budget=8192, max_batch=8))
+    assert sort_by_length(entries, backend) is entries
+
+    def padding_efficiency(pending):
+        scheduler = LengthBucketedPipe(backend, length, token_budget=8192, max_batch=8)
+        for start in range(0, len(pending), 8):
+            scheduler([[{"role": "system", "content": "Extract."}, {"role": "user", "content": entry["Text"]}]
+                       for entry in pending[start:start + 8]], batch_size=8)
+        return scheduler.stats.as_dict()["padding_efficiency"]
+
+    pending = sort_by_length(entries, stack)
+    assert sorted(entry["id"] for entry in pending) == list(range(48))
+    assert [length([{"role": "user", "content": e["Text"]}]) for e in pending] == \
+        sorted(length([{"role": "user", "content": e["Text"]}]) for e in entries)
+    assert padding_efficiency(pending) > padding_efficiency(entries)
@@ -0,0 +1,55 @@
+## Vectorized matching of Evaluation_engine.py against the original per-cell loop of
+## Evaluation.ipynb (evaluate_single_prediction), on random cells.
+
+import random
+
+import numpy as np
+import pytest
+
+from Evaluation_engine import match_cell
+
+
+def reference_match(gt_list, pred_list, threshold, sim):
+    '''
+    The original evaluate_single_prediction, with sim[i][j] in place of the SBERT calls.
+    '''
+    gt_temp = list(range(len(gt_list)))
+    pred_temp = list(pred_list)
+    tp = 0
+    for i, p in enumerate(pred_list):
+        best_match_idx = -1
+        best_sim = -1
+        texts = [gt_list[j] for j in gt_temp]
+        if p in texts:
+            best_sim = 1.0
+            best_match_idx = texts.index(p)
+        else:
+            for k, j in enumerate(gt_temp):
+                if sim[i][j] > best_sim:
+                    best_sim = sim[i][j]
+                    best_match_idx = k
+        if best_sim >= threshold and best_match_idx != -1:
+            tp += 1
+            gt_temp.pop(best_match_idx)
+            pred_temp.remove(p)
+    return tp, len(pred_temp), len(gt_temp)
+
+
+def random_cell(rng):
+    vocabulary = [f"span {k}" for k in range(6)]
+    gt_list = [rng.choice(vocabulary) for _ in range(rng.randint(0, 5))]
+    pred_list = [rng.choice(vocabulary) for _ in range(rng.randint(0, 5))]
+    # Few distinct values, so that ties and thresholds equal to a similarity are common
+    levels = [0.2, 0.5, 0.7, 0.7, 0.9]
+    sim = np.array([[rng.choice(levels) for _ in gt_list] for _ in pred_list], dtype=np.float64)
+    return gt_list, pred_list, sim.reshape(len(pred_list), len(gt_list))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_cell_matches_reference_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        gt_list, pred_list, sim = random_cell(rng)
+        threshold = rng.choice([0.0, 0.5, 0.6, 0.7, 0.9, 1.0])
+        tp, fp, fn, _ = match_cell(gt_list, pred_list, threshold, sim)
+        assert (tp, fp, fn) == reference_match(gt_list, pred_list, threshold, sim)
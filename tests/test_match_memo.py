@@ -0,0 +1,65 @@
+## MatchMemo of Evaluation_engine.py: the memoized tables against matching every cell
+## again, and the keys taken from the file hashes recorded by the loaders.
+
+import json
+import random
+
+import numpy as np
+
+from Evaluation_engine import (TARGET_COLUMNS, MatchMemo, load_and_normalize_ground_truth,
+                               load_predictions_json, match_strings)
+
+
+class HashedStore:
+    '''
+    Embedding store stand-in: a fixed random vector per string, no SBERT model.
+    '''
+
+    def get_many(self, strings):
+        return np.stack([np.random.default_rng(sum(map(ord, s))).normal(size=8) for s in strings])
+
+
+def write_dataset(tmp_path, seed):
+    rng = random.Random(seed)
+    vocabulary = [f"span {k}" for k in range(8)]
+    gt = [{"id": k, "Text": f"req {k}", **{col: [rng.choice(vocabulary) for _ in range(rng.randint(0, 3))]
+                                             for col in TARGET_COLUMNS}} for k in range(12)]
+    preds = [{"id": k, "prediction": {col: [rng.choice(vocabulary) for _ in range(rng.randint(0, 3))]
+                                      for col in TARGET_COLUMNS}} for k in range(10)]
+    gt_path, pred_path = tmp_path / "gt.json", tmp_path / "preds.json"
+    gt_path.write_text(json.dumps(gt), encoding="utf-8")
+    pred_path.write_text(json.dumps(preds), encoding="utf-8")
+    return gt_path, pred_path
+
+
+def test_memo_matches_every_cell_and_reuses_tables(tmp_path):
+    gt_path, pred_path = write_dataset(tmp_path, 0)
+    gt_data = load_and_normalize_ground_truth(gt_path)
+    pred_data = load_predictions_json(pred_path)
+    store = HashedStore()
+    memo = MatchMemo(store)
+
+    table = memo.table(gt_data, pred_data, 0.3)
+    for (req_id, col), cell in table.items():
+        if req_id in pred_data:
+            assert cell == match_strings(store, gt_data[req_id][col], pred_data[req_id][col], 0.3)
+        else:
+            assert cell == (0, 0, len(gt_data[req_id][col]), [])
+
+    memo.totals(gt_data, pred_data, 0.3)
+    memo.totals(gt_data, pred_data, 0.3, ["Action"])
+    assert (memo.misses, memo.hits) == (1, 2)
+
+
+def test_memo_keys_follow_the_loaded_files(tmp_path):
+    gt_path, pred_path = write_dataset(tmp_path, 1)
+    memo = MatchMemo(HashedStore())
+    gt_data = load_and_normalize_ground_truth(gt_path)
+    memo.table(gt_data, load_predictions_json(pred_path), 0.3)
+
+    # Reloading the same file hits, a changed file misses
+    memo.table(gt_data, load_predictions_json(pred_path), 0.3)
+    assert (memo.misses, memo.hits) == (1, 1)
+    write_dataset(tmp_path, 2)
+    memo.table(gt_data, load_predictions_json(pred_path), 0.3)
+    assert memo.misses == 2
@@ -0,0 +1,70 @@
+## The MIA gates of the default setup of Multi_agent_8.py on the labelled datasets of the
+## repo: at least one field is gated, its held-out (cross-fitted) recall stays at or above
+## GATING_MIN_RECALL and the calls saved are reported.
+
+import json
+import os
+
+import pytest
+
+import Multi_agent_8
+from Mia_gating import GATED_FIELDS, MiaGate, load_labelled, normalize_text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def default_gate():
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        gate = MiaGate.from_files(Multi_agent_8.GATING_TRAINING_FILES, recall=Multi_agent_8.GATING_RECALL,
+                                  min_recall=Multi_agent_8.GATING_MIN_RECALL,
+                                  z=Multi_agent_8.GATING_CONFIDENCE_Z)
+        with open(Multi_agent_8.INPUT_FILE, 'r', encoding='utf-8') as f:
+            dataset = json.load(f)
+    finally:
+        os.chdir(cwd)
+    return gate, dataset
+
+
+def test_default_setup_gates_a_field(default_gate):
+    gate, _ = default_gate
+    assert gate.gates
+    for field, held_out in gate.held_out.items():
+        assert held_out["recall_lower"] >= Multi_agent_8.GATING_MIN_RECALL
+
+
+def test_held_out_recall_on_the_input(default_gate):
+    gate, dataset = default_gate
+    for field in gate.gates:
+        positives = [r for r in dataset if r.get(field)]
+        kept = sum(1 for r in positives if field in gate.fields_to_run(r["Text"], [field]))
+        assert kept / len(positives) >= Multi_agent_8.GATING_MIN_RECALL
+
+
+def test_input_is_gated_by_gates_that_never_saw_it(default_gate):
+    gate, dataset = default_gate
+    records = load_labelled([os.path.join(ROOT, path) for path in Multi_agent_8.GATING_TRAINING_FILES])
+    folds = len(next(iter(gate.fold_gates.values())))
+    for i, record in enumerate(records):
+        assert gate.fold_of[normalize_text(record["Text"])] == i % folds
+    for entry in dataset[:20]:
+        fold = gate.fold_of[normalize_text(entry["Text"])]
+        for field in gate.gates:
+            assert gate.gate_for(field, entry["Text"]) is gate.fold_gates[field][fold]
+    # Texts outside the labelled data get the gate trained on all of it
+    field = next(iter(gate.gates))
+    assert gate.gate_for(field, "An unseen requirement.") is gate.gates[field]
+
+
+def test_calls_saved_are_reported(default_gate):
+    trained, dataset = default_gate
+    gate = MiaGate(trained.gates, trained.fold_gates, trained.fold_of)  # fresh counters
+    for entry in dataset:
+        gate.fields_to_run(entry["Text"], GATED_FIELDS)
+    stats = gate.stats()
+    assert stats["calls"] == len(dataset) * len(GATED_FIELDS)
+    assert stats["calls_saved"] > 0
+    assert stats["calls_saved"] == sum(stats["saved_per_field"].values())
+    assert stats["saved_rate"] == pytest.approx(stats["calls_saved"] / stats["calls"])
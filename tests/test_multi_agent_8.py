@@ -0,0 +1,28 @@
+## Batched MIA calls (Multi_agent_8.py): the agent prompts of a call are decoded in
+## batches of the configured size, not in one batch of every prompt.
+
+import json
+
+from Multi_agent_8 import AGENT_PROMPTS, process_multi_agent_batch
+
+
+class RecordingPipe:
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, conversations, batch_size=None, **gen_kwargs):
+        self.batch_sizes.append(batch_size)
+        return [[{"generated_text": json.dumps({"Main_actor": ["system"]})}] for _ in conversations]
+
+
+def test_batch_size_is_configured():
+    texts = [f"The system shall log event {k}." for k in range(6)]
+    pipe = RecordingPipe()
+    extractions = process_multi_agent_batch(texts, pipe, AGENT_PROMPTS, batch_size=16)
+    assert pipe.batch_sizes == [16]
+    assert len(extractions) == 6
+
+    # None: one batch of every prompt of the call
+    process_multi_agent_batch(texts, pipe, AGENT_PROMPTS, batch_size=None)
+    assert pipe.batch_sizes[-1] == len(texts) * len(AGENT_PROMPTS)
@@ -0,0 +1,85 @@
+## Near-duplicate reuse (Near_duplicates.py): the spans of an adapted record against the
+## text of the near-duplicate (edits applied only where the words were replaced), and the
+## failed records, which must never be copied onto a near-duplicate.
+
+import random
+
+import pytest
+
+from Near_duplicates import ExtractionReuse, adapt_record, extract_with_reuse
+from Span_dedup import FIELDS
+
+OLD_TEXT = "The user shall export the users' data, and the username is shown to the user."
+NEW_TEXT = "The admin shall export the users' data, and the username is shown to the admin."
+
+
+def test_edits_are_applied_where_the_words_were_replaced():
+    record = {"id": 1, "Text": OLD_TEXT, "Main_actor": ["The user"], "Entity": ["the users' data", "the username"],
+              "Action": ["export the users' data"], "Purpose": ["shown to the user"], "Trigger": ["reworded span"]}
+    adapted = adapt_record(record, OLD_TEXT, {"id": 2, "Text": NEW_TEXT})
+
+    assert adapted["id"] == 2 and adapted["Text"] == NEW_TEXT
+    assert adapted["Main_actor"] == ["The admin"]
+    assert set(adapted["Entity"]) == {"the users' data", "the username"}
+    assert adapted["Action"] == ["export the users' data"]
+    assert adapted["Purpose"] == ["shown to the admin"]
+    assert adapted["Trigger"] == ["reworded span"]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_adapted_spans_copied_from_the_text_stay_in_the_new_text(seed):
+    rng = random.Random(seed)
+    words = [rng.choice(["user", "users", "username", "data", "the", "shall", "5", "s"]) for _ in range(14)]
+    old_text = " ".join(words)
+    edited = [rng.choice(["admin", "7", "x"]) if rng.random() < 0.25 else word for word in words]
+    new_text = " ".join(edited)
+    spans = list({" ".join(words[i:i + rng.randint(1, 4)]) for i in range(0, len(words), 2)})
+    adapted = adapt_record({"id": 1, "Action": spans}, old_text, {"id": 2, "Text": new_text})
+    assert all(span in new_text for span in adapted["Action"])
+
+
+def failed_records():
+    return [{"id": 1, "Text": OLD_TEXT, "error": "Invalid JSON", "raw_output": "{"},
+            {"id": 1, "Text": OLD_TEXT, **{field: [] for field in FIELDS}}]
+
+
+@pytest.mark.parametrize("failed", failed_records())
+def test_failed_records_are_not_reused(failed):
+    duplicate = {"id": 2, "Text": NEW_TEXT}
+
+    # Seeded from a stream: not indexed, the near-duplicate goes to the model
+    reuse = ExtractionReuse(0.5, [failed])
+    assert reuse.split([duplicate]) == ([duplicate], [])
+
+    # Written during the run, then extracted again
+    written = []
+
+    class ListWriter:
+        def write(self, record):
+            written.append(record)
+
+    reuse = ExtractionReuse(0.5)
+    novel, duplicates = reuse.split([{"id": 1, "Text": OLD_TEXT}, duplicate])
+    writer = reuse.recording(ListWriter())
+    writer.write(failed)
+    assert written == [failed]
+    assert reuse.adapt(duplicates) == ([], duplicates)
+
+    good = {"id": 1, "Text": OLD_TEXT, "Main_actor": ["The user"]}
+    writer.write(good)
+    reused, waiting = reuse.adapt(duplicates)
+    assert waiting == [] and reused[0][1]["Main_actor"] == ["The admin"]
+
+
+def test_extract_with_reuse_sends_the_duplicates_of_failures_to_the_model():
+    calls = []
+
+    def extract(entries):
+        calls.append([entry["id"] for entry in entries])
+        return [failed_records()[0] if entry["id"] == 1 else {"id": entry["id"], "Main_actor": ["ok"]}
+                for entry in entries]
+
+    entries = [{"id": 1, "Text": OLD_TEXT}, {"id": 2, "Text": NEW_TEXT}]
+    records = extract_with_reuse(ExtractionReuse(0.5), entries, extract)
+    assert calls == [[1], [2]]
+    assert records[1] == {"id": 2, "Main_actor": ["ok"]}
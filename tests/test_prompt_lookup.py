@@ -0,0 +1,51 @@
+## Prompt-lookup speculative decoding (Prompt_lookup.py) against plain greedy
+## model.generate() on the tiny model: the accepted drafts must not change the output,
+## with and without a PrefixKVCache entry to start from.
+
+import torch
+
+from Prefix_cache import PrefixKVCache
+from Prompt_lookup import PromptLookupDecoder
+
+SYSTEM_PROMPT = 'Extract the abstractions. Answer with {"Main_actor": [], "Action": [], "Entity": []}.'
+REQUIREMENTS = [
+    "The system shall respond within 2 seconds.",
+    "When the user clicks Save, the form is stored.",
+    "aaaa aaaa aaaa aaaa",
+]
+MAX_NEW_TOKENS = 40
+
+
+def greedy_reference(model, tokenizer, messages):
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    input_ids = tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids
+    with torch.no_grad():
+        output_ids = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                    max_new_tokens=MAX_NEW_TOKENS, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id)
+    return tokenizer.decode(output_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+
+def conversations():
+    return [[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": text}]
+            for text in REQUIREMENTS]
+
+
+def test_prompt_lookup_is_greedy_exact(tiny_model):
+    model, tokenizer = tiny_model
+    decoder = PromptLookupDecoder(model, tokenizer, stop_at_json=False, max_new_tokens=MAX_NEW_TOKENS)
+    outputs = decoder(conversations())
+    assert [o[0]["generated_text"] for o in outputs] == [greedy_reference(model, tokenizer, m)
+                                                          for m in conversations()]
+    assert decoder.stats.accepted > 0  # Drafts were accepted, not only rejected
+
+
+def test_prompt_lookup_from_prefix_cache_is_greedy_exact(tiny_model):
+    model, tokenizer = tiny_model
+    prefix_cache = PrefixKVCache(model, tokenizer, max_new_tokens=MAX_NEW_TOKENS)
+    decoder = PromptLookupDecoder(model, tokenizer, stop_at_json=False, max_new_tokens=MAX_NEW_TOKENS,
+                                  prefix_cache=prefix_cache)
+    outputs = decoder(conversations())
+    assert [o[0]["generated_text"] for o in outputs] == [greedy_reference(model, tokenizer, m)
+                                                          for m in conversations()]
+    assert prefix_cache.hits == len(REQUIREMENTS) - 1
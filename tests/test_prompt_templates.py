@@ -0,0 +1,47 @@
+## Pre-tokenized prompt templates (Prompt_templates.py) against apply_chat_template: the
+## joined token ids, and the generations of CompiledTemplatePipe against the
+## text-generation pipeline of the backend (tiny model, JSON stopping on).
+
+from Backends import build_pipeline_stack
+from Prompt_templates import PROBE_TEXTS, CompiledTemplatePipe, TemplateCompiler
+
+SYSTEM_PROMPTS = [
+    "You extract the abstractions of a requirement as JSON.",
+    'Example:\n{"Main_actor": ["the user"]}\n\nNow the requirement:',
+]
+USER_TEXTS = PROBE_TEXTS + [
+    "The system shall log every access.",
+    "  Leading and trailing spaces  ",
+    "Line one\n\nLine two",
+    "",
+]
+
+
+def render(tokenizer, messages):
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text, add_special_tokens=False).input_ids
+
+
+def test_encode_matches_the_full_rendering(cpu_backend):
+    tokenizer = cpu_backend.tokenizer
+    templates = TemplateCompiler(tokenizer)
+    for system_prompt in SYSTEM_PROMPTS:
+        for user_text in USER_TEXTS:
+            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_text}]
+            assert templates.encode(messages) == render(tokenizer, messages)
+
+    # Other conversation shapes are rendered in full
+    messages = [{"role": "user", "content": "only a user turn"}]
+    assert templates.encode(messages) == render(tokenizer, messages)
+    assert templates.stats()["compiled"] == len(SYSTEM_PROMPTS)
+
+
+def test_compiled_pipe_generates_like_the_pipeline(cpu_backend):
+    conversations = [[{"role": "system", "content": SYSTEM_PROMPTS[k % 2]}, {"role": "user", "content": text}]
+                     for k, text in enumerate(USER_TEXTS[:6])]
+    compiled = build_pipeline_stack(cpu_backend, None, max_new_tokens=24, inference_cache=False,
+                                    compiled_templates=True)
+    assert isinstance(compiled, CompiledTemplatePipe)
+    outputs = compiled(conversations)
+    expected = cpu_backend(conversations)
+    assert [o[0]["generated_text"] for o in outputs] == [e[0]["generated_text"] for e in expected]
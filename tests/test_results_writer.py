@@ -0,0 +1,125 @@
+## Resumable JSONL output (Results_writer.py): repair of a torn last line, the ids that
+## count as done (no errors, matching run and text fingerprints) and the compaction into
+## the JSON array, in dataset order and replaced atomically.
+
+import json
+import os
+
+import pytest
+
+import Results_writer
+from Results_writer import (RUN_KEY, JsonlResultWriter, RunFingerprint, _repair_tail, compact_jsonl,
+                            load_done_ids)
+
+
+@pytest.fixture
+def fingerprint(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "Writer_test_prompt.py").write_text("PROMPT = 'Extract.'\n")
+    return RunFingerprint("few_shot", "Writer_test_prompt")
+
+
+def write_lines(path, records, tail=""):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.write(tail)
+
+
+def test_repair_tail_drops_a_truncated_last_line(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write_lines(path, [{"id": 1}, {"id": 2}], tail='{"id": 3, "Te')
+    _repair_tail(path)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == '{"id": 1}\n{"id": 2}\n'
+
+    # Complete files are left alone, and the writer appends after the repaired tail
+    _repair_tail(path)
+    with JsonlResultWriter(path) as writer:
+        writer.write({"id": 3})
+    assert load_done_ids(path) == {1, 2, 3}
+
+
+def test_repair_tail_of_a_single_partial_line(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write_lines(path, [], tail='{"id": 1')
+    _repair_tail(path)
+    assert os.path.getsize(path) == 0
+
+
+def test_load_done_ids_skips_errors(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    write_lines(path, [{"id": 1, "Text": "a"}, {"id": 2, "Text": "b", "error": "timeout"},
+                       {"id": 3, "Text": "c"}])
+    assert load_done_ids(path) == {1, 3}
+    assert load_done_ids(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_load_done_ids_needs_the_expected_fingerprint(tmp_path, fingerprint):
+    path = str(tmp_path / "out.jsonl")
+    dataset = [{"id": 1, "Text": "a"}, {"id": 2, "Text": "b"}, {"id": 3, "Text": "c"}]
+    with JsonlResultWriter(path, fingerprint=fingerprint) as writer:
+        for entry in dataset:
+            writer.write(dict(entry))
+    with JsonlResultWriter(path, fingerprint=RunFingerprint("zero_shot", "Writer_test_prompt")) as writer:
+        writer.write({"id": 4, "Text": "d"})
+
+    expected = fingerprint.of_entries(dataset + [{"id": 4, "Text": "d"}])
+    assert load_done_ids(path, expected) == {1, 2, 3}
+    # Edited requirement text: its record is stale
+    edited = fingerprint.of_entries([{"id": 1, "Text": "a"}, {"id": 2, "Text": "b, edited"},
+                                     {"id": 3, "Text": "c"}])
+    assert load_done_ids(path, edited) == {1, 3}
+
+
+def test_load_done_ids_follows_the_prompt_file(tmp_path, fingerprint):
+    path = str(tmp_path / "out.jsonl")
+    dataset = [{"id": 1, "Text": "a"}]
+    with JsonlResultWriter(path, fingerprint=fingerprint) as writer:
+        writer.write(dict(dataset[0]))
+    (tmp_path / "Writer_test_prompt.py").write_text("PROMPT = 'Extract the actors.'\n")
+    edited = RunFingerprint("few_shot", "Writer_test_prompt")
+    assert load_done_ids(path, edited.of_entries(dataset)) == set()
+
+
+def test_compact_jsonl_orders_by_id_and_keeps_the_last_record(tmp_path, fingerprint):
+    path, output = str(tmp_path / "out.jsonl"), str(tmp_path / "out.json")
+    dataset = [{"id": k, "Text": f"t{k}"} for k in [3, 1, 2]]
+    with JsonlResultWriter(path, fingerprint=fingerprint) as writer:
+        writer.write({"id": 2, "Text": "t2", "error": "timeout"})
+        for entry in [dataset[1], dataset[2], dataset[0]]:
+            writer.write({**entry, "Main_actor": [entry["Text"]]})
+        writer.write({"id": 9, "Text": "t9"})  # Not in the dataset
+
+    count = compact_jsonl(path, output, [3, 1, 2], fingerprint.of_entries(dataset))
+    with open(output, encoding="utf-8") as f:
+        records = json.load(f)
+    assert count == 3
+    assert [record["id"] for record in records] == [3, 1, 2]
+    assert all(RUN_KEY not in record and "error" not in record for record in records)
+
+    # Without `expected`, ids missing from id_order come last
+    compact_jsonl(path, output, [3, 1, 2])
+    with open(output, encoding="utf-8") as f:
+        assert [record["id"] for record in json.load(f)] == [3, 1, 2, 9]
+
+
+def test_compact_jsonl_replaces_the_output_atomically(tmp_path, monkeypatch):
+    path, output = str(tmp_path / "out.jsonl"), str(tmp_path / "out.json")
+    write_lines(path, [{"id": 1, "Text": "a"}])
+    compact_jsonl(path, output, [1])
+    with open(output, encoding="utf-8") as f:
+        previous = f.read()
+    assert not os.path.exists(output + ".tmp")
+
+    def failing_dump(obj, f, **kwargs):
+        f.write("[{")
+        raise OSError("disk full")
+
+    write_lines(path, [{"id": 1, "Text": "a"}, {"id": 2, "Text": "b"}])
+    monkeypatch.setattr(Results_writer.json, "dump", failing_dump)
+    with pytest.raises(OSError):
+        compact_jsonl(path, output, [1, 2])
+    # The interrupted compaction leaves the previous output whole
+    with open(output, encoding="utf-8") as f:
+        assert f.read() == previous
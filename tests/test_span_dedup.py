@@ -0,0 +1,43 @@
+## Span deduplication (Span_dedup.py): the Aho-Corasick containment search and the
+## pairwise scan against the plain containment rule, and dedup_spans on both sides of
+## AUTOMATON_MIN_SPANS.
+
+import random
+
+import pytest
+
+from Span_dedup import AUTOMATON_MIN_SPANS, SpanAutomaton, contained_pairwise, dedup_spans, is_atomic
+
+
+def reference_contained(spans):
+    return [any(span in other for other in spans if len(other) > len(span)) for span in spans]
+
+
+def reference_dedup(spans):
+    unique = list(dict.fromkeys(s for s in spans if isinstance(s, str) and s))
+    kept = [span for span, inside in zip(unique, reference_contained(unique))
+            if not inside or is_atomic(span)]
+    return sorted(kept, key=len, reverse=True)
+
+
+def random_spans(rng, count):
+    # Small alphabet: many spans are substrings of others, suffixes included
+    return list(dict.fromkeys("".join(rng.choice("ab1 ") for _ in range(rng.randint(1, 8)))
+                              for _ in range(count)))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_containment_searches_match_the_rule(seed):
+    rng = random.Random(seed)
+    spans = random_spans(rng, rng.randint(1, 120))
+    expected = reference_contained(spans)
+    assert SpanAutomaton(spans).contained() == expected
+    assert contained_pairwise(spans) == expected
+
+
+@pytest.mark.parametrize("count", [40, AUTOMATON_MIN_SPANS * 2])
+def test_dedup_spans_matches_the_rule(count):
+    rng = random.Random(count)
+    spans = ["".join(rng.choice("abc 12") for _ in range(rng.randint(1, 14))) for _ in range(count)]
+    spans += spans[:10] + ["", 5]
+    assert dedup_spans(spans) == reference_dedup(spans) + [5]
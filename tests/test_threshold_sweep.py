@@ -0,0 +1,46 @@
+## Threshold step functions and ThresholdSweep of Evaluation_engine.py against the
+## per-threshold matching, including thresholds equal to a similarity value.
+
+import random
+
+import numpy as np
+import pytest
+
+from Evaluation_engine import ThresholdSweep, cell_threshold_steps, match_cell
+from test_match_cell import random_cell, reference_match
+
+
+def tp_from_steps(steps, threshold):
+    return max([tp for upper, tp in steps if upper >= threshold], default=0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_threshold_steps_are_exact(seed):
+    rng = random.Random(seed)
+    for _ in range(1000):
+        gt_list, pred_list, sim = random_cell(rng)
+        steps = cell_threshold_steps(gt_list, pred_list, sim)
+        # Every similarity value is a threshold where the step function may jump
+        for threshold in [0.0, 0.2, 0.35, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.01]:
+            tp, _, _, _ = match_cell(gt_list, pred_list, threshold, sim)
+            assert tp_from_steps(steps, threshold) == tp
+
+
+def test_threshold_sweep_counts():
+    rng = random.Random(7)
+    cells = [random_cell(rng) for _ in range(300)]
+    uppers, deltas = [], []
+    for gt_list, pred_list, sim in cells:
+        steps = cell_threshold_steps(gt_list, pred_list, sim)
+        for k, (upper, tp) in enumerate(steps):
+            uppers.append(upper)
+            deltas.append(tp - (steps[k + 1][1] if k + 1 < len(steps) else 0))
+    sweep = ThresholdSweep({"col": {"uppers": uppers, "deltas": deltas,
+                                    "total_gt": sum(len(c[0]) for c in cells),
+                                    "total_pred": sum(len(c[1]) for c in cells)}})
+
+    thresholds = [0.1, 0.2, 0.5, 0.65, 0.7, 0.9, 0.95]
+    tp, fp, fn = sweep.counts(thresholds)
+    for k, threshold in enumerate(thresholds):
+        expected = np.sum([reference_match(g, p, threshold, s) for g, p, s in cells], axis=0)
+        assert (tp[k], fp[k], fn[k]) == tuple(expected)